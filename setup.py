@@ -42,6 +42,7 @@ setuptools.setup(
             sources=[
                 "src/viztracer/modules/util.c",
                 "src/viztracer/modules/eventnode.c",
+                "src/viztracer/modules/prefixtrie.c",
                 "src/viztracer/modules/snaptrace.c"
             ],
             extra_link_args=["-lpthread"]
@@ -0,0 +1,268 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
+
+import json
+import os
+import struct
+from typing import Any, Dict, List, Tuple
+from . import __version__
+
+
+# The binary trace format written by Tracer.dump(). All numbers are in
+# the byte order of the machine that generated the file
+#   header: b"VTB\0", u32 0x01020304(byte order mark), u32 version, i64 pid
+#   records, each starts with a one byte type
+#     S: string table entry, u32 id, u32 length, utf-8 bytes. A later
+#        entry with the same id replaces the earlier one
+#     X: FEE event, i64 ts(ns), i64 dur(ns), u64 tid, u32 name id,
+#        i32 caller_lineno(-1 if unavailable), u32 length, json args
+#     J: any other event, u32 length, json of the event. Length 0 means
+#        the event could not be encoded and should be skipped
+# Version 1 is the same except ts and dur of X are f64
+MAGIC = b"VTB\0"
+VERSION = 2
+EXTENSION = ".vtb"
+
+# The buffer file that the circular buffer is mapped to with buffer_file.
+# It's the memory of the tracer, so it's only readable on the same kind of
+# machine, and only the function entries can be recovered from it
+#   header(64 bytes): b"VTR\0", u32 byte order mark, u32 version,
+#     u32 node size, i64 pid, i64 buffer size, i64 head index,
+#     i64 tail index, u32 pointer size, 12 bytes reserved
+#   nodes, buffer size * node size bytes, the live ones are from the head
+#     index to the tail index. A function entry has i64 ts(ns) at 0,
+#     u32 tid index at 8, u8 node type at 12 and then at 16
+#     u64 code/method pointer, u64 module/type pointer, i64 dur(ns),
+#     u32 payload, u8 trace type
+#   records, each starts with a one byte type
+#     N: function name, u64 code/method pointer, u64 module/type pointer,
+#        u32 length, utf-8 bytes
+#     T: tid, u32 index, u64 tid
+BUFFER_FILE_MAGIC = b"VTR\0"
+BUFFER_FILE_VERSION = 1
+BUFFER_FILE_EXTENSION = ".vtbuf"
+
+
+class BinaryTraceError(Exception):
+    pass
+
+
+def is_binary_trace(path: str) -> bool:
+    return path.endswith(EXTENSION) or path.endswith(BUFFER_FILE_EXTENSION)
+
+
+def get_endian(buf: bytes, path: str) -> str:
+    if struct.unpack_from("<I", buf, 4)[0] == 0x01020304:
+        return "<"
+    elif struct.unpack_from(">I", buf, 4)[0] == 0x01020304:
+        return ">"
+    raise BinaryTraceError(f"Unable to decode the byte order of {path}")
+
+
+def load(path: str, integer_ts: bool = False) -> Dict[str, Any]:
+    """
+    Load a binary trace file to a Chrome Trace Event Format object.
+    With integer_ts, ts and dur of the events are int in ns instead of
+    float in us
+    """
+    with open(path, "rb") as f:
+        buf = f.read()
+
+    if buf[:4] == BUFFER_FILE_MAGIC:
+        return load_buffer_file(buf, path, integer_ts)
+
+    if buf[:4] != MAGIC:
+        raise BinaryTraceError(f"{path} is not a VizTracer binary trace file")
+
+    endian = get_endian(buf, path)
+
+    version, pid = struct.unpack_from(endian + "Iq", buf, 8)
+    if version == VERSION:
+        fee_entry = struct.Struct(endian + "qqQIiI")
+    elif version == 1:
+        fee_entry = struct.Struct(endian + "ddQIiI")
+    else:
+        raise BinaryTraceError(f"Unsupported binary trace version {version}")
+
+    string_entry = struct.Struct(endian + "II")
+    length_entry = struct.Struct(endian + "I")
+
+    names: Dict[int, str] = {}
+    events: List[Dict[str, Any]] = []
+    offset = 20
+    size = len(buf)
+    while offset < size:
+        record_type = buf[offset:offset + 1]
+        offset += 1
+        if record_type == b"X":
+            ts, dur, tid, name_id, caller_lineno, length = fee_entry.unpack_from(buf, offset)
+            offset += fee_entry.size
+            event = {
+                "pid": pid,
+                "tid": tid,
+                "ts": int(ts) if integer_ts else ts / 1000,
+                "dur": int(dur) if integer_ts else dur / 1000,
+                "name": names[name_id],
+                "ph": "X",
+                "cat": "FEE"
+            }
+            if caller_lineno >= 0:
+                event["caller_lineno"] = caller_lineno
+            if length > 0:
+                event["args"] = json.loads(buf[offset:offset + length])
+                offset += length
+            events.append(event)
+        elif record_type == b"S":
+            name_id, length = string_entry.unpack_from(buf, offset)
+            offset += string_entry.size
+            names[name_id] = buf[offset:offset + length].decode("utf-8")
+            offset += length
+        elif record_type == b"J":
+            length, = length_entry.unpack_from(buf, offset)
+            offset += length_entry.size
+            if length == 0:
+                continue
+            event = json.loads(buf[offset:offset + length])
+            event.setdefault("pid", pid)
+            if integer_ts:
+                for key in ("ts", "dur"):
+                    if key in event:
+                        event[key] = round(event[key] * 1000)
+            offset += length
+            events.append(event)
+        else:
+            raise BinaryTraceError(f"Unknown record type {record_type!r} at offset {offset - 1}")
+
+    metadata = {"version": __version__}
+    if integer_ts:
+        metadata["ts_unit"] = "ns"
+    return {
+        "traceEvents": events,
+        "viztracer_metadata": metadata
+    }
+
+
+def load_buffer_file(buf: bytes, path: str, integer_ts: bool = False) -> Dict[str, Any]:
+    """
+    Recover the function entries from a buffer file, usually left by a
+    process that crashed before it could save the report
+    """
+    endian = get_endian(buf, path)
+    version, node_size, pid, size, head_idx, tail_idx, pointer_size = struct.unpack_from(endian + "IIqqqqI", buf, 8)
+    if version != BUFFER_FILE_VERSION:
+        raise BinaryTraceError(f"Unsupported buffer file version {version}")
+    if pointer_size != 8:
+        raise BinaryTraceError(f"Unable to read the buffer file {path} from a {pointer_size * 8}-bit process")
+
+    node_entry = struct.Struct(endian + "qIB3xQQqIB")
+    name_entry = struct.Struct(endian + "QQI")
+    tid_entry = struct.Struct(endian + "IQ")
+
+    nodes_offset = 64
+    offset = nodes_offset + size * node_size
+    names: Dict[Tuple[int, int], str] = {}
+    tids: Dict[int, int] = {}
+    while offset < len(buf):
+        record_type = buf[offset:offset + 1]
+        offset += 1
+        if record_type == b"N":
+            if offset + name_entry.size > len(buf):
+                break
+            key, owner, length = name_entry.unpack_from(buf, offset)
+            offset += name_entry.size
+            names[(key, owner)] = buf[offset:offset + length].decode("utf-8", errors="replace")
+            offset += length
+        elif record_type == b"T":
+            if offset + tid_entry.size > len(buf):
+                break
+            idx, tid = tid_entry.unpack_from(buf, offset)
+            offset += tid_entry.size
+            tids[idx] = tid
+        else:
+            # The process could die in the middle of a record
+            break
+
+    if tail_idx >= head_idx:
+        live = range(head_idx, tail_idx)
+    else:
+        live = range(head_idx, tail_idx + size)
+
+    events: List[Dict[str, Any]] = []
+    for idx in live:
+        ts, tid_idx, node_type, key, owner, dur, _, trace_type = \
+            node_entry.unpack_from(buf, nodes_offset + (idx % size) * node_size)
+        # FEE_NODE, the other nodes need the objects in the dead process
+        if node_type != 1:
+            continue
+        if trace_type in (0, 3):
+            # Python functions are keyed by the code object only
+            owner = 0
+        name = names.get((key, owner))
+        # The node could be cleared, or the process died before the name
+        if name is None or tid_idx not in tids:
+            continue
+        events.append({
+            "pid": pid,
+            "tid": tids[tid_idx],
+            "ts": ts if integer_ts else ts / 1000,
+            "dur": dur if integer_ts else dur / 1000,
+            "name": name,
+            "ph": "X",
+            "cat": "FEE"
+        })
+
+    metadata = {"version": __version__}
+    if integer_ts:
+        metadata["ts_unit"] = "ns"
+    return {
+        "traceEvents": events,
+        "viztracer_metadata": metadata
+    }
+
+
+def dump(data: Dict[str, Any], path: str) -> None:
+    """
+    Write a Chrome Trace Event Format object, like VizTracer.data, to
+    a binary trace file. This is the fallback when the buffer is already
+    parsed, Tracer.dump() writes the file directly from the buffer
+    """
+    events = data["traceEvents"]
+    pid = next((event["pid"] for event in events if "pid" in event), os.getpid())
+    name_ids: Dict[str, int] = {}
+    chunks: List[bytes] = [MAGIC, struct.pack("=IIq", 0x01020304, VERSION, pid)]
+    fee_entry = struct.Struct("=qqQIiI")
+    # X records are in ns, J records are in us like the report
+    integer_ts = data.get("viztracer_metadata", {}).get("ts_unit") == "ns"
+    ns_scale = 1 if integer_ts else 1000
+
+    def json_record(obj: Any) -> Tuple[bytes, bytes]:
+        if integer_ts:
+            obj = {key: value / 1000 if key in ("ts", "dur") else value for key, value in obj.items()}
+        encoded = json.dumps(obj).encode("utf-8")
+        return struct.pack("=I", len(encoded)), encoded
+
+    for event in events:
+        if event["ph"] == "X" and event.get("cat") == "FEE":
+            name = event["name"]
+            if name not in name_ids:
+                name_ids[name] = len(name_ids) + 1
+                encoded_name = name.encode("utf-8")
+                chunks.append(b"S" + struct.pack("=II", name_ids[name], len(encoded_name)) + encoded_name)
+            if "args" in event:
+                args = json.dumps(event["args"]).encode("utf-8")
+            else:
+                args = b""
+            chunks.append(b"X" + fee_entry.pack(
+                round(event["ts"] * ns_scale),
+                round(event["dur"] * ns_scale),
+                event["tid"],
+                name_ids[name],
+                event.get("caller_lineno", -1),
+                len(args)
+            ) + args)
+        else:
+            chunks.append(b"J")
+            chunks.extend(json_record(event))
+
+    with open(path, "wb") as f:
+        f.write(b"".join(chunks))
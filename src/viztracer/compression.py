@@ -0,0 +1,136 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
+
+import collections
+import gzip
+import io
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Deque, Optional
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame  # type: ignore
+except ImportError:
+    lz4 = None
+
+
+COMPRESSED_EXTENSIONS = (".gz", ".zst", ".lz4")
+
+
+def is_compressed(path: str) -> bool:
+    return path.endswith(COMPRESSED_EXTENSIONS)
+
+
+def _deflate_block(block: bytes, compresslevel: int, last: bool) -> bytes:
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends the raw deflate stream on a byte boundary without
+    # marking it final, so the next block can simply follow it
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    """
+    Write a gzip file like pigz does. The data is cut into blocks that are
+    deflated independently by a thread pool, zlib releases the GIL, and
+    the results are written in order as one gzip member, so any gzip
+    reader can read it
+    """
+    def __init__(
+            self,
+            path: str,
+            compresslevel: int = 6,
+            block_size: int = 1 << 20,
+            workers: Optional[int] = None):
+        super().__init__()
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        workers = workers or os.cpu_count() or 1
+        self._file = open(path, "wb")
+        self._executor = ThreadPoolExecutor(workers)
+        # Bound the compressed blocks waiting to be written
+        self._max_pending = workers * 2
+        self._pending: Deque[Future] = collections.deque()
+        self._buffer = bytearray()
+        self._crc = 0
+        self._size = 0
+        # magic, deflate, no flags, mtime, no extra flags, unknown os
+        self._file.write(struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, int(time.time()), 0, 255))
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            view = memoryview(self._buffer)
+            offset = 0
+            while len(self._buffer) - offset >= self.block_size:
+                self._submit(bytes(view[offset:offset + self.block_size]), last=False)
+                offset += self.block_size
+            view.release()
+            del self._buffer[:offset]
+        return len(data)
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(self._executor.submit(_deflate_block, block, self.compresslevel, last))
+        while len(self._pending) > self._max_pending:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            self._file.write(struct.pack("<II", self._crc, self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+            super().close()
+
+
+def _require(module: Any, name: str, path: str) -> None:
+    if module is None:
+        raise Exception(f"{path} needs {name}, install it with \"pip install {name}\"")
+
+
+def open_compressed(path: str, mode: str = "rt") -> Any:
+    """
+    Open a .gz, .zst or .lz4 file. mode is one of rt, rb, wt and wb
+    """
+    binary: Any
+    if path.endswith(".gz"):
+        if mode.startswith("r"):
+            return gzip.open(path, mode, encoding=None if mode == "rb" else "utf-8")
+        binary = ParallelGzipWriter(path)
+    elif path.endswith(".zst"):
+        _require(zstandard, "zstandard", path)
+        if mode.startswith("r"):
+            binary = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        else:
+            # threads=-1 compresses with all the cores
+            compressor = zstandard.ZstdCompressor(threads=-1)
+            binary = compressor.stream_writer(open(path, "wb"), closefd=True)
+    elif path.endswith(".lz4"):
+        _require(lz4, "lz4", path)
+        return lz4.frame.open(path, mode, encoding=None if mode.endswith("b") else "utf-8")
+    else:
+        raise ValueError(f"{path} is not a compressed file")
+
+    if mode.endswith("b"):
+        return binary
+    return io.TextIOWrapper(binary, encoding="utf-8")
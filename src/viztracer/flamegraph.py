@@ -1,19 +1,22 @@
 # Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
 # For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
 
+import math
 import os
 import queue
+from concurrent.futures import ProcessPoolExecutor
 try:
     import orjson as json  # type: ignore
 except ImportError:
     import json  # type: ignore
+from operator import itemgetter
 from string import Template
-from typing import Any, Dict, List, Optional, Tuple
-
-from .functree import FuncTree, FuncTreeNode
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 
 class _FlameNode:
+    __slots__ = ("name", "value", "count", "parent", "children")
+
     def __init__(self, parent: Optional["_FlameNode"], name: str):
         self.name: str = name
         self.value: float = 0
@@ -21,62 +24,149 @@ class _FlameNode:
         self.parent: Optional["_FlameNode"] = parent
         self.children: Dict[str, "_FlameNode"] = {}
 
-    def get_child(self, child: FuncTreeNode) -> None:
-        if child.fullname not in self.children:
-            self.children[child.fullname] = _FlameNode(self, child.fullname)
-        self.children[child.fullname].value += child.end - child.start
-        self.children[child.fullname].count += 1
-        for grandchild in child.children:
-            self.children[child.fullname].get_child(grandchild)
-
-    def json(self) -> Dict[str, Any]:
+    def json(self, ts_scale: int = 1) -> Dict[str, Any]:
         return {
             "name": self.name,
-            "value": self.value,
-            "children": [child.json() for child in self.children.values()]
+            "value": self.value / ts_scale,
+            "children": [child.json(ts_scale) for child in self.children.values()]
         }
 
 
 class _FlameTree:
-    def __init__(self, func_tree: FuncTree):
+    def __init__(self) -> None:
         self.root: _FlameNode = _FlameNode(None, "__root__")
-        self.parse(func_tree)
 
-    def parse(self, func_tree: FuncTree):
-        self.root = _FlameNode(None, "__root__")
-        for child in func_tree.root.children:
-            self.root.get_child(child)
+    def json(self, ts_scale: int = 1) -> Dict[str, Any]:
+        return self.root.json(ts_scale)
 
-    def json(self) -> Dict[str, Any]:
-        return self.root.json()
+    def add_calls(self, calls: Iterable[Tuple[float, float, str]]) -> None:
+        """
+        Aggregate the calls of a thread, (start, dur, name) in the order of
+        the start. A stack keeps the calls that are not finished, so only
+        the stack paths are kept, no matter how many calls there are. A call
+        is nested in another one if it starts after and ends before it
+        """
+        # (start, end, node) of the unfinished calls, the root covers all
+        stack: List[Tuple[float, float, _FlameNode]] = [(-math.inf, math.inf, self.root)]
+        for start, dur, name in calls:
+            end = start + dur
+            parent_start, parent_end, parent = stack[-1]
+            while not (parent_start < start and parent_end > end):
+                stack.pop()
+                parent_start, parent_end, parent = stack[-1]
+            try:
+                node = parent.children[name]
+            except KeyError:
+                node = parent.children[name] = _FlameNode(parent, name)
+            node.value += end - start
+            node.count += 1
+            stack.append((start, end, node))
+
+    def flatten(self) -> List[Tuple[int, str, float, int]]:
+        """
+        Return the nodes in preorder as (index of the parent, name, value,
+        count), the root is not included and its index is -1. It's much
+        smaller than the tree to send to another process
+        """
+        ret: List[Tuple[int, str, float, int]] = []
+        stack: List[Tuple[_FlameNode, int]] = [(child, -1) for child in reversed(self.root.children.values())]
+        while stack:
+            node, parent = stack.pop()
+            idx = len(ret)
+            ret.append((parent, node.name, node.value, node.count))
+            stack.extend((child, idx) for child in reversed(node.children.values()))
+        return ret
+
+    @classmethod
+    def from_flat(cls, flat: List[Tuple[int, str, float, int]]) -> "_FlameTree":
+        tree = cls()
+        nodes: List[_FlameNode] = []
+        for parent_idx, name, value, count in flat:
+            parent = nodes[parent_idx] if parent_idx >= 0 else tree.root
+            node = parent.children[name] = _FlameNode(parent, name)
+            node.value = value
+            node.count = count
+            nodes.append(node)
+        return tree
+
+
+def _build_flame_tree(events: List[Dict[str, Any]]) -> _FlameTree:
+    tree = _FlameTree()
+    # Stable, the calls that start at the same time stay in the recorded order
+    events = sorted(events, key=itemgetter("ts"))
+    tree.add_calls((event["ts"], event["dur"], event["name"]) for event in events)
+    return tree
+
+
+def _build_flat_flame_tree(calls: List[Tuple[float, float, str]]) -> List[Tuple[int, str, float, int]]:
+    # Runs in the process pool, only what the flamegraph needs is sent
+    tree = _FlameTree()
+    calls.sort(key=itemgetter(0))
+    tree.add_calls(calls)
+    return tree.flatten()
 
 
 class FlameGraph:
-    def __init__(self, trace_data: Optional[Dict[str, Any]] = None):
+    # The threads with fewer function events are not worth sending to
+    # another process
+    parallel_min_events = 10000
+
+    def __init__(self, trace_data: Optional[Dict[str, Any]] = None, processes: Optional[int] = None):
         self.trees: Dict[str, _FlameTree] = {}
+        # The trees keep the unit of the trace, the output is always in us
+        self.ts_scale: int = 1
+        # The number of processes to build the trees of the threads,
+        # None for the number of the cores
+        self.processes = processes
         if trace_data:
             self.parse(trace_data)
 
     def parse(self, trace_data: Dict[str, Any]) -> None:
-        func_trees: Dict[str, FuncTree] = {}
+        if trace_data.get("viztracer_metadata", {}).get("ts_unit") == "ns":
+            self.ts_scale = 1000
+        else:
+            self.ts_scale = 1
+        thread_events: Dict[str, List[Dict[str, Any]]] = {}
         for data in trace_data["traceEvents"]:
             key = "p{}_t{}".format(data["pid"], data["tid"])
-            if key in func_trees:
-                tree = func_trees[key]
+            if key in thread_events:
+                events = thread_events[key]
             else:
-                tree = FuncTree(data["pid"], data["tid"])
-                func_trees[key] = tree
+                events = thread_events[key] = []
 
             if data["ph"] == "X":
-                tree.add_event(data)
-
-        for key, tree in func_trees.items():
-            self.trees[key] = _FlameTree(tree)
+                events.append(data)
+
+        # The threads are independent, the big ones are built in a process
+        # pool while the small ones are built here
+        threads = list(thread_events)
+        big_threads = [key for key, events in thread_events.items() if len(events) >= self.parallel_min_events]
+        processes = min(self.processes or os.cpu_count() or 1, len(big_threads))
+        trees: Dict[str, _FlameTree] = {}
+        if processes > 1:
+            with ProcessPoolExecutor(processes) as executor:
+                futures = {
+                    key: executor.submit(
+                        _build_flat_flame_tree,
+                        [(event["ts"], event["dur"], event["name"]) for event in thread_events.pop(key)]
+                    )
+                    for key in big_threads
+                }
+                for key, events in thread_events.items():
+                    trees[key] = _build_flame_tree(events)
+                for key, future in futures.items():
+                    trees[key] = _FlameTree.from_flat(future.result())
+        else:
+            for key, events in thread_events.items():
+                trees[key] = _build_flame_tree(events)
+
+        # In the order the threads appear in the trace
+        self.trees = {key: trees[key] for key in threads}
 
     def dump_to_json(self) -> Dict[str, Any]:
         ret = {}
         for key in self.trees:
-            ret[key] = self.trees[key].json()
+            ret[key] = self.trees[key].json(self.ts_scale)
         return ret
 
     def load(self, input_file: str) -> None:
@@ -132,8 +222,8 @@ class FlameGraph:
                     "parentId": parent,
                     "depth": depth,
                     "name": node.name,
-                    "totalSize": node.value,
-                    "selfSize": node.value - sum((n.value for n in node.children.values())),
+                    "totalSize": node.value / self.ts_scale,
+                    "selfSize": (node.value - sum((n.value for n in node.children.values()))) / self.ts_scale,
                     "mapping": f"{node.count}",
                     "merged": False,
                     "highlighted": False
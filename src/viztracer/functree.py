@@ -1,42 +1,85 @@
 # Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
 # For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
 
-import copy
 import bisect
+import gc
 import re
-from typing import Any, Dict, Generator, List, Optional
+from typing import Any, Dict, Generator, Iterable, List, Optional
 
 
-class FuncTreeNode:
-    name_regex = r"(.*) \((.*?):([0-9]+)\)"
+class FuncInfo:
+    """
+    The function of the nodes, parsed from the name once and shared by
+    all the calls of it
+    """
+    __slots__ = ("fullname", "funcname", "filename", "lineno", "is_python")
+    name_regex = re.compile(r"(.*) \((.*?):([0-9]+)\)")
 
-    def __init__(self, event: Optional[Dict[str, Any]] = None):
+    def __init__(self, fullname: str):
+        self.fullname: str = fullname
+        self.funcname: Optional[str] = None
         self.filename: Optional[str] = None
         self.lineno: Optional[int] = None
-        self.caller_lineno: int = -1
-        self.is_python: Optional[bool] = False
-        self.funcname: Optional[str] = None
+        self.is_python: bool = False
+        m = self.name_regex.match(fullname)
+        if m:
+            self.is_python = True
+            self.funcname = m.group(1)
+            self.filename = m.group(2)
+            self.lineno = int(m.group(3))
+
+
+_root_func = FuncInfo("__ROOT__")
+
+
+class FuncTreeNode:
+    __slots__ = ("func", "parent", "children", "start", "end", "event")
+
+    def __init__(self, event: Optional[Dict[str, Any]] = None, func: Optional[FuncInfo] = None):
         self.parent: Optional[FuncTreeNode] = None
         self.children: List[FuncTreeNode] = []
-        self.start: float = - (2 ** 64)
-        self.end: float = 2 ** 64
-        self.event: Dict[str, Any] = {}
+        self.event: Dict[str, Any]
+        self.start: float
+        self.end: float
+        self.func: FuncInfo
         if event is None:
             self.event = {"name": "__ROOT__"}
-            self.fullname = "__ROOT__"
+            self.func = _root_func
+            self.start = - (2 ** 64)
+            self.end = 2 ** 64
         else:
-            self.event = copy.copy(event)
-            self.start = self.event["ts"]
-            self.end = self.event["ts"] + self.event["dur"]
-            self.fullname = self.event["name"]
-            m = re.match(self.name_regex, self.fullname)
-            if m:
-                self.is_python = True
-                self.funcname = m.group(1)
-                self.filename = m.group(2)
-                self.lineno = int(m.group(3))
-            if "caller_lineno" in self.event:
-                self.caller_lineno = self.event["caller_lineno"]
+            # The event is shared with the trace, it's never changed here
+            self.event = event
+            self.func = func if func is not None else FuncInfo(event["name"])
+            self.start = event["ts"]
+            self.end = self.start + event["dur"]
+
+    @property
+    def fullname(self) -> str:
+        return self.func.fullname
+
+    @property
+    def funcname(self) -> Optional[str]:
+        return self.func.funcname
+
+    @property
+    def filename(self) -> Optional[str]:
+        return self.func.filename
+
+    @property
+    def lineno(self) -> Optional[int]:
+        return self.func.lineno
+
+    @property
+    def is_python(self) -> bool:
+        return self.func.is_python
+
+    @property
+    def caller_lineno(self) -> int:
+        return self.event.get("caller_lineno", -1)
+
+    def add_child(self, node: "FuncTreeNode") -> None:
+        self.children.append(node)
 
     def is_ancestor(self, other: "FuncTreeNode") -> bool:
         return self.start < other.start and self.end > other.end
@@ -95,21 +138,68 @@ class FuncTreeNode:
 
 
 class FuncTree:
-    def __init__(self, pid: int = 0, tid: int = 0):
+    def __init__(self, pid: int = 0, tid: int = 0, func_table: Optional[Dict[str, FuncInfo]] = None):
         self.root: FuncTreeNode = FuncTreeNode()
         self.curr: FuncTreeNode = self.root
         self.pid: int = pid
         self.tid: int = tid
+        # From the name of the function to its FuncInfo, it could be shared
+        # by the trees of a trace
+        self.func_table: Dict[str, FuncInfo] = func_table if func_table is not None else {}
+
+    def get_func_info(self, name: str) -> FuncInfo:
+        try:
+            return self.func_table[name]
+        except KeyError:
+            func = self.func_table[name] = FuncInfo(name)
+            return func
 
     def is_same(self, other: "FuncTree") -> bool:
         return self.root.is_same(other.root)
 
     def add_event(self, event: Dict[str, Any]) -> None:
-        node = FuncTreeNode(event)
+        node = FuncTreeNode(event, self.get_func_info(event["name"]))
 
         self.curr.adopt(node)
         self.curr = node
 
+    def add_events(self, events: Iterable[Dict[str, Any]]) -> None:
+        """
+        Add the events of the thread all at once. They are sorted by the
+        start, so a parent always comes before its children and the tree is
+        built in one pass with a stack, instead of finding the place of
+        every event with adopt(). The sort is stable, the events that start
+        at the same time are siblings in the order they are recorded, like
+        add_event() does
+        """
+        if self.root.children:
+            # The tree is not empty, the new events could go anywhere
+            for event in events:
+                self.add_event(event)
+            return
+
+        sorted_events = sorted(events, key=lambda e: e["ts"])
+        stack = [self.root]
+        # Nothing is garbage here, but the garbage collector would go
+        # through all the new nodes again and again
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for event in sorted_events:
+                node = FuncTreeNode(event, self.get_func_info(event["name"]))
+                parent = stack[-1]
+                # The root is the ancestor of everything
+                while not parent.is_ancestor(node):
+                    stack.pop()
+                    parent = stack[-1]
+                node.parent = parent
+                parent.add_child(node)
+                stack.append(node)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.curr = stack[-1]
+
     def first_ts(self) -> float:
         return self.root.children[0].event["ts"]
 
@@ -12,9 +12,9 @@ import platform
 import signal
 import shutil
 from typing import Any, Dict, List, NoReturn, Optional, Tuple, Union
-from . import VizTracer, FlameGraph, __version__
+from . import VizTracer, FlameGraph, __version__, binary_trace
 from .code_monkey import CodeMonkey
-from .report_builder import ReportBuilder
+from .report_builder import ReportBuilder, StreamingReportBuilder
 from .patch import patch_multiprocessing, patch_subprocess
 from .util import time_str_to_us
 
@@ -29,6 +29,7 @@ class VizUI:
         self.args: List[str] = []
         self._exiting: bool = False
         self.multiprocess_output_dir: str = f"./viztracer_multiprocess_tmp_{os.getpid()}_{int(time.time())}"
+        self.multiprocess_output_name: str = "result.json"
         self.is_main_process: bool = False
         self.cwd: str = os.getcwd()
 
@@ -38,12 +39,36 @@ class VizUI:
                             help="show version of viztracer")
         parser.add_argument("--tracer_entries", nargs="?", type=int, default=1000000,
                             help="size of circular buffer. How many entries can it store")
+        parser.add_argument("--per_thread_buffer", action="store_true", default=False,
+                            help="give every thread its own circular buffer of tracer_entries entries")
+        parser.add_argument("--spill_to_disk", action="store_true", default=False,
+                            help="save the oldest entries to a temp file instead of dropping them when buffer is full")
+        parser.add_argument("--use_monitoring", action="store_true", default=False,
+                            help="use sys.monitoring instead of a profile function to trace, requires python 3.12+")
+        parser.add_argument("--sample_rate", nargs="?", type=float, default=0,
+                            help="sample the stacks at this rate(Hz) instead of tracing every function call")
+        parser.add_argument("--call_budget", nargs="?", type=int, default=0,
+                            help="only log the first N calls of every function, the rest are counted")
+        parser.add_argument("--call_sample_ratio", nargs="?", type=int, default=0,
+                            help="with --call_budget, still log one of every K calls over the budget")
+        parser.add_argument("--collect_stats", action="store_true", default=False,
+                            help="collect call count and total/self/min/max time of every function to the report")
+        parser.add_argument("--stats_only", action="store_true", default=False,
+                            help="only collect the function stats, do not log any function entry")
+        parser.add_argument("--clock", nargs="?", choices=["monotonic", "monotonic_raw", "tsc"], default="monotonic",
+                            help="the clock to take the timestamps with, tsc is the fastest if available")
+        parser.add_argument("--buffer_file", nargs="?", default=None,
+                            help="map the circular buffer to this file so a crashed process can be recovered, "
+                                 "{pid} in the path is replaced by the pid")
         parser.add_argument("--output_file", "-o", nargs="?", default=None,
-                            help="output file path. End with .json or .html or .gz")
+                            help="output file path. End with .json or .html or .gz or .zst or .lz4 or .vtb")
         parser.add_argument("--output_dir", nargs="?", default=None,
                             help="output directory. Should only be used when --pid_suffix is used")
         parser.add_argument("--file_info", action="store_true", default=False,
                             help=argparse.SUPPRESS)
+        parser.add_argument("--source_bundle", nargs="?", default=None,
+                            help="keep the source code of the report in this file instead of the report, "
+                                 "the reports saved with the same bundle share the source code")
         parser.add_argument("--quiet", action="store_true", default=False,
                             help="stop VizTracer from printing anything")
         parser.add_argument("--trace_self", action="store_true", default=False,
@@ -92,10 +117,12 @@ class VizUI:
                             help=argparse.SUPPRESS)
         parser.add_argument("--log_multiprocess", action="store_true", default=False,
                             help="log multiprocesses")
+        parser.add_argument("--multiprocess_shm", action="store_true", default=False,
+                            help="hand the data of the processes to the main process as binary traces in shared memory")
         parser.add_argument("--log_async", action="store_true", default=False,
                             help="log as async format")
         parser.add_argument("--minimize_memory", action="store_true", default=False,
-                            help="Use json.dump to dump chunks to file to save memory")
+                            help="write the report to file in smaller chunks to save memory")
         parser.add_argument("--vdb", action="store_true", default=False,
                             help="Instrument for vdb, will increase the overhead")
         parser.add_argument("--pid_suffix", action="store_true", default=False,
@@ -154,10 +181,19 @@ class VizUI:
                 os.mkdir(options.output_dir)
             self.ofile = os.path.join(options.output_dir, self.ofile)
 
+        if options.multiprocess_shm:
+            # The processes dump their buffers straight to binary traces.
+            # The function entries are fixed size records, only the args
+            # and the other events are kept as json in them.
+            # /dev/shm is memory, the traces never touch the disk
+            self.multiprocess_output_name = "result" + binary_trace.EXTENSION
+            if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+                self.multiprocess_output_dir = os.path.join("/dev/shm", os.path.basename(self.multiprocess_output_dir))
+
         if options.log_subprocess:
             if not options.subprocess_child:
                 self.args += ["--subprocess_child", "--output_dir", self.multiprocess_output_dir,
-                              "-o", "result.json", "--pid_suffix"]
+                              "-o", self.multiprocess_output_name, "--pid_suffix"]
             patch_subprocess(self)
 
         if options.log_async:
@@ -190,7 +226,18 @@ class VizUI:
             "register_global": True,
             "plugins": options.plugins,
             "trace_self": options.trace_self,
-            "min_duration": min_duration
+            "min_duration": min_duration,
+            "per_thread_buffer": options.per_thread_buffer,
+            "spill_to_disk": options.spill_to_disk,
+            "use_monitoring": options.use_monitoring,
+            "sample_rate": options.sample_rate,
+            "call_budget": options.call_budget,
+            "call_sample_ratio": options.call_sample_ratio,
+            "collect_stats": options.collect_stats,
+            "stats_only": options.stats_only,
+            "clock": options.clock,
+            "buffer_file": os.path.abspath(options.buffer_file) if options.buffer_file else None,
+            "source_bundle": os.path.abspath(options.source_bundle) if options.source_bundle else None
         }
 
         return True, None
@@ -318,7 +365,10 @@ class VizUI:
 
     def run_combine(self, files: List[str], align: bool = False) -> Tuple[bool, Optional[str]]:
         options = self.options
-        builder = ReportBuilder(files, align=align, minimize_memory=options.minimize_memory)
+        # The reports are loaded by a process pool and streamed to the
+        # output, so we never hold all of them in memory
+        source_bundle = os.path.abspath(options.source_bundle) if options.source_bundle else None
+        builder = StreamingReportBuilder(files, align=align, source_bundle=source_bundle)
         if options.output_file:
             ofile = options.output_file
         else:
@@ -372,16 +422,18 @@ class VizUI:
         if options.log_subprocess or options.log_multiprocess:
             tracer.pid_suffix = True
             if self.is_main_process:
+                # The file_info is built once for the combined report
                 tracer.save(
-                    output_file=os.path.join(self.multiprocess_output_dir, "result.json"),
-                    file_info=True,
+                    output_file=os.path.join(self.multiprocess_output_dir, self.multiprocess_output_name),
+                    file_info=False,
                     minimize_memory=options.minimize_memory
                 )
 
                 builder = ReportBuilder(
                     [os.path.join(self.multiprocess_output_dir, f)
                         for f in os.listdir(self.multiprocess_output_dir)],
-                    minimize_memory=options.minimize_memory)
+                    minimize_memory=options.minimize_memory,
+                    source_bundle=tracer.source_bundle)
                 builder.save(output_file=ofile)
                 shutil.rmtree(self.multiprocess_output_dir)
             else:  # pragma: no cover
@@ -4,38 +4,79 @@
 #include <stdio.h>
 #include "eventnode.h"
 
+#define FEE_PAYLOAD_POOL_INIT_CAPACITY 1024
+
+// All the tracers share the pool, it's only used with the GIL held.
+// Index 0 is never used so 0 can mean no payload
+struct FEEPayload* fee_payload_pool = NULL;
+static uint32_t fee_payload_capacity = 0;
+static uint32_t fee_payload_free = 0;
+
+uint32_t new_fee_payload(void)
+{
+    uint32_t idx = 0;
+    struct FEEPayload* payload = NULL;
+
+    if (!fee_payload_free) {
+        uint32_t capacity = fee_payload_capacity ? fee_payload_capacity * 2 : FEE_PAYLOAD_POOL_INIT_CAPACITY;
+        fee_payload_pool = PyMem_Realloc(fee_payload_pool, capacity * sizeof(struct FEEPayload));
+        if (!fee_payload_pool) {
+            printf("Out of memory!\n");
+            exit(1);
+        }
+        // Chain the new ones to the free list, skip 0
+        for (uint32_t i = capacity - 1; i >= fee_payload_capacity && i > 0; i--) {
+            fee_payload_pool[i].next_free = fee_payload_free;
+            fee_payload_free = i;
+        }
+        fee_payload_capacity = capacity;
+    }
+
+    idx = fee_payload_free;
+    payload = fee_payload_pool + idx;
+    fee_payload_free = payload->next_free;
+    payload->args = NULL;
+    payload->retval = NULL;
+    payload->asyncio_task = NULL;
+    payload->caller_lineno = -1;
+    payload->next_free = 0;
+
+    return idx;
+}
+
+static void free_fee_payload(uint32_t idx)
+{
+    struct FEEPayload* payload = fee_payload_pool + idx;
+    Py_XDECREF(payload->args);
+    Py_XDECREF(payload->retval);
+    Py_XDECREF(payload->asyncio_task);
+    payload->args = NULL;
+    payload->retval = NULL;
+    payload->asyncio_task = NULL;
+    payload->next_free = fee_payload_free;
+    fee_payload_free = idx;
+}
+
 void clear_node(struct EventNode* node) {
     switch (node->ntype) {
     case FEE_NODE:
         if (node->data.fee.type == PyTrace_CALL || node->data.fee.type == PyTrace_RETURN) {
-            Py_DECREF(node->data.fee.co_filename);
-            Py_DECREF(node->data.fee.co_name);
-            node->data.fee.co_firstlineno = 0;
-            if (node->data.fee.args) {
-                Py_DECREF(node->data.fee.args);
-                node->data.fee.args = NULL;
-            }
-            if (node->data.fee.retval) {
-                Py_DECREF(node->data.fee.retval);
-                node->data.fee.retval = NULL;
-            }
+            Py_DECREF(node->data.fee.code);
+            node->data.fee.code = NULL;
         } else {
             node->data.fee.ml_name = NULL;
-            if (node->data.fee.m_module) {
+            if (node->data.fee.in_module) {
                 // The function belongs to a module
                 Py_DECREF(node->data.fee.m_module);
                 node->data.fee.m_module = NULL;
             } else {
                 // The function is a class method
-                if (node->data.fee.tp_name) {
-                    // It's not a static method, has __self__
-                    node->data.fee.tp_name = NULL;
-                }
+                node->data.fee.tp_name = NULL;
             }
         }
-        if (node->data.fee.asyncio_task != NULL) {
-            Py_DECREF(node->data.fee.asyncio_task);
-            node->data.fee.asyncio_task = NULL;
+        if (node->data.fee.payload) {
+            free_fee_payload(node->data.fee.payload);
+            node->data.fee.payload = 0;
         }
         break;
     case INSTANT_NODE:
@@ -70,57 +111,157 @@ void clear_node(struct EventNode* node) {
     }
 }
 
-// This will return a PyUnicode object to the caller
-// The caller is responsible to decrease the reference
-//   name_set is an initialized set to keep
-//   formatted names to save memory
-PyObject* get_name_from_fee_node(struct EventNode* node, PyObject* name_dict)
+#define FUNC_NAME_TABLE_INIT_CAPACITY 256
+
+static inline Py_ssize_t func_name_slot(struct FuncNameTable* table, const void* key, const void* owner)
 {
-    assert(PyDict_Check(name_dict));
+    size_t hash = ((size_t)key >> 4) ^ ((size_t)owner >> 3);
+    return (hash * 11400714819323198485ULL) & (table->capacity - 1);
+}
 
-    PyObject* name = NULL;
-    PyObject* ret = NULL;
+static void func_name_table_alloc(struct FuncNameTable* table, Py_ssize_t capacity)
+{
+    table->entries = (struct FuncNameEntry*) PyMem_Calloc(capacity, sizeof(struct FuncNameEntry));
+    if (!table->entries) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    table->capacity = capacity;
+    table->size = 0;
+}
+
+static struct FuncNameEntry* func_name_table_find(struct FuncNameTable* table, const void* key, const void* owner)
+{
+    Py_ssize_t idx = func_name_slot(table, key, owner);
+    while (table->entries[idx].name) {
+        if (table->entries[idx].key == key && table->entries[idx].owner == owner) {
+            break;
+        }
+        idx = (idx + 1) & (table->capacity - 1);
+    }
+    // Either the entry of the key or an empty one
+    return table->entries + idx;
+}
+
+static void func_name_table_grow(struct FuncNameTable* table)
+{
+    struct FuncNameEntry* entries = table->entries;
+    Py_ssize_t capacity = table->capacity;
+    Py_ssize_t size = table->size;
+
+    func_name_table_alloc(table, capacity * 2);
+    for (Py_ssize_t i = 0; i < capacity; i++) {
+        if (entries[i].name) {
+            *func_name_table_find(table, entries[i].key, entries[i].owner) = entries[i];
+        }
+    }
+    table->size = size;
+    PyMem_FREE(entries);
+}
+
+void func_name_table_init(struct FuncNameTable* table)
+{
+    table->entries = NULL;
+    table->capacity = 0;
+    table->size = 0;
+}
+
+void func_name_table_clear(struct FuncNameTable* table)
+{
+    if (table->entries) {
+        for (Py_ssize_t i = 0; i < table->capacity; i++) {
+            Py_XDECREF(table->entries[i].ref);
+            Py_XDECREF(table->entries[i].name);
+        }
+        PyMem_FREE(table->entries);
+    }
+    func_name_table_init(table);
+}
+
+struct FuncNameEntry* get_func_name_entry(struct EventNode* node, struct FuncNameTable* table)
+{
+    const void* key = NULL;
+    const void* owner = NULL;
+    PyObject* ref = NULL;
+    struct FuncNameEntry* entry = NULL;
+
+    if (node->data.fee.type == PyTrace_CALL || node->data.fee.type == PyTrace_RETURN) {
+        key = node->data.fee.code;
+        ref = (PyObject*) node->data.fee.code;
+    } else {
+        key = node->data.fee.ml_name;
+        if (node->data.fee.in_module) {
+            owner = node->data.fee.m_module;
+            ref = node->data.fee.m_module;
+        } else {
+            owner = node->data.fee.tp_name;
+        }
+    }
+
+    if (!table->entries) {
+        func_name_table_alloc(table, FUNC_NAME_TABLE_INIT_CAPACITY);
+    }
+
+    entry = func_name_table_find(table, key, owner);
+    if (entry->name) {
+        return entry;
+    }
+
+    // Keep the load factor under 1/2 so the probing stays short
+    if ((table->size + 1) * 2 > table->capacity) {
+        func_name_table_grow(table);
+        entry = func_name_table_find(table, key, owner);
+    }
 
-    // We create the name first. However, this name might already exists
-    // before. To save memory usage, we check if this name exists in name_dict
-    // If it does, we use the one in name_dict and delete this one.
-    // This way, for entries that has the same name, we won't create multiple
-    // string instances
     if (node->data.fee.type == PyTrace_CALL || node->data.fee.type == PyTrace_RETURN) {
-        name = PyUnicode_FromFormat("%s (%s:%d)",
-               PyUnicode_AsUTF8(node->data.fee.co_name),
-               PyUnicode_AsUTF8(node->data.fee.co_filename),
-               node->data.fee.co_firstlineno);
+        PyCodeObject* code = node->data.fee.code;
+        entry->name = PyUnicode_FromFormat("%s (%s:%d)",
+                      PyUnicode_AsUTF8(code->co_name),
+                      PyUnicode_AsUTF8(code->co_filename),
+                      code->co_firstlineno);
     } else {
-        if (node->data.fee.m_module) {
+        if (node->data.fee.in_module) {
             // The function belongs to a module
-            name = PyUnicode_FromFormat("%s.%s",
-                   PyUnicode_AsUTF8(node->data.fee.m_module),
-                   node->data.fee.ml_name);
+            entry->name = PyUnicode_FromFormat("%s.%s",
+                          PyUnicode_AsUTF8(node->data.fee.m_module),
+                          node->data.fee.ml_name);
         } else {
             // The function is a class method
             if (node->data.fee.tp_name) {
                 // It's not a static method, has __self__
-                name = PyUnicode_FromFormat("%s.%s",
-                       node->data.fee.tp_name,
-                       node->data.fee.ml_name);
+                entry->name = PyUnicode_FromFormat("%s.%s",
+                              node->data.fee.tp_name,
+                              node->data.fee.ml_name);
             } else {
                 // It's a static method, does not have __self__
-                name = PyUnicode_FromFormat("%s",
-                       node->data.fee.ml_name);
+                entry->name = PyUnicode_FromFormat("%s",
+                              node->data.fee.ml_name);
             }
         }
     }
 
-    if (PyDict_Contains(name_dict, name)) {
-        ret = PyDict_GetItem(name_dict, name);
-        Py_DECREF(name);
-        Py_INCREF(ret);
-    } else {
-        // return name, so don't DECREF it
-        PyDict_SetItem(name_dict, name, name);
-        ret = name;
-    }
+    entry->key = key;
+    entry->owner = owner;
+    entry->ref = ref;
+    Py_XINCREF(ref);
+    entry->id = 0;
+    entry->calls = 0;
+    entry->dropped = 0;
+    entry->dropped_dur = 0;
+    entry->last_dropped_ts = 0;
+    entry->total_dur = 0;
+    entry->self_dur = 0;
+    entry->min_dur = 0;
+    entry->max_dur = 0;
+    entry->active_calls = 0;
+    table->size += 1;
 
-    return ret;
-}
\ No newline at end of file
+    return entry;
+}
+
+PyObject* get_name_from_fee_node(struct EventNode* node, struct FuncNameTable* table)
+{
+    PyObject* name = get_func_name_entry(node, table)->name;
+    Py_INCREF(name);
+    return name;
+}
@@ -4,6 +4,7 @@
 #ifndef __EVENTNODE_H__
 #define __EVENTNODE_H__
 
+#include <stdint.h>
 #include <Python.h>
 
 typedef enum _NodeType {
@@ -15,25 +16,34 @@ typedef enum _NodeType {
     RAW_NODE = 5
 } NodeType;
 
-struct FEEData {
+// The optional data of a FEE node. Most of the nodes don't have any, so
+// they are kept in a separate pool and the nodes only keep an index
+struct FEEPayload {
     PyObject* args;
     PyObject* retval;
+    PyObject* asyncio_task;
+    int caller_lineno;
+    // The next free payload in the pool
+    uint32_t next_free;
+};
+
+struct FEEData {
     union {
-        struct {
-            PyObject* m_module;
-            const char* ml_name;
-            const char* tp_name;
-        };
-        struct {
-            PyObject* co_name;
-            PyObject* co_filename;
-            int co_firstlineno;
-        };
+        // The name is built from the code when loading
+        PyCodeObject* code;
+        const char* ml_name;
     };
-    int type;
-    int caller_lineno;
-    double dur;
-    PyObject* asyncio_task;
+    // Only for C functions, which one it is depends on in_module
+    union {
+        PyObject* m_module;
+        // NULL for static methods, they don't have __self__
+        const char* tp_name;
+    };
+    int64_t dur;
+    // Index of the payload in the pool, 0 if there's none
+    uint32_t payload;
+    uint8_t type;
+    uint8_t in_module;
 };
 
 struct InstantData {
@@ -54,9 +64,10 @@ struct ObjectData {
 };
 
 struct EventNode {
-    NodeType ntype;
-    double ts;
-    unsigned long tid;
+    int64_t ts;
+    // Index of the thread in the tid table of the tracer
+    uint32_t tid_idx;
+    uint8_t ntype;
     union {
         struct FEEData fee;
         struct InstantData instant;
@@ -66,11 +77,70 @@ struct EventNode {
     } data;
 };
 
+// A hash table of the names of the functions in FEE nodes, so the name
+// of a function is only built once no matter how many times it's called
+struct FuncNameEntry {
+    // The code object for python functions, or ml_name for C functions
+    const void* key;
+    // The module or the type name for C functions
+    const void* owner;
+    // We hold a reference to the key object so it can't be reused
+    PyObject* ref;
+    PyObject* name;
+    // Free for the user of the table, initialized to 0
+    uint32_t id;
+    // Used by the tracer to enforce the call budget, initialized to 0
+    uint64_t calls;
+    uint64_t dropped;
+    int64_t dropped_dur;
+    int64_t last_dropped_ts;
+    // Used by the tracer to collect stats, calls is the call count
+    int64_t total_dur;
+    int64_t self_dur;
+    int64_t min_dur;
+    int64_t max_dur;
+    // The frames of the function that have not returned
+    uint32_t active_calls;
+};
+
+struct FuncNameTable {
+    struct FuncNameEntry* entries;
+    Py_ssize_t capacity;
+    Py_ssize_t size;
+};
+
 // ==== Functions ====
 
 // Clear the node, release reference 
 void clear_node(struct EventNode* node);
 
-// get name from FEE node, passing in a dictionary for name cache
-PyObject* get_name_from_fee_node(struct EventNode* node, PyObject* name_dict);
+// Get a cleared payload from the pool, caller_lineno is -1
+uint32_t new_fee_payload(void);
+
+extern struct FEEPayload* fee_payload_pool;
+
+// The pointer is only valid until the next new_fee_payload()
+static inline struct FEEPayload* get_fee_payload(uint32_t idx)
+{
+    return fee_payload_pool + idx;
+}
+
+// Get the payload of the FEE node, allocate one if there's none
+static inline struct FEEPayload* ensure_fee_payload(struct EventNode* node)
+{
+    if (!node->data.fee.payload) {
+        node->data.fee.payload = new_fee_payload();
+    }
+    return get_fee_payload(node->data.fee.payload);
+}
+
+void func_name_table_init(struct FuncNameTable* table);
+void func_name_table_clear(struct FuncNameTable* table);
+
+// Get the entry of the function of the FEE node, the entry is only valid
+// until the next call
+struct FuncNameEntry* get_func_name_entry(struct EventNode* node, struct FuncNameTable* table);
+
+// Get the name of the function of the FEE node, new reference
+PyObject* get_name_from_fee_node(struct EventNode* node, struct FuncNameTable* table);
 #endif
@@ -0,0 +1,104 @@
+// Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+// For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
+
+#include <Python.h>
+#include "prefixtrie.h"
+
+// Windows path has double slashes and case-insensitive, so we store the
+// prefix normalized and normalize the target the same way when matching
+static inline int next_char(const char** s, char* prev)
+{
+#if _WIN32
+    if (**s == '\\' && *prev == '\\') {
+        *s += 1;
+    }
+    *prev = **s;
+    if (**s >= 'A' && **s <= 'Z') {
+        return **s - 'A' + 'a';
+    }
+#endif
+    return **s;
+}
+
+static void free_children(struct PrefixTrieNode* node)
+{
+    struct PrefixTrieNode* child = node->child;
+    while (child) {
+        struct PrefixTrieNode* sibling = child->sibling;
+        free_children(child);
+        PyMem_FREE(child);
+        child = sibling;
+    }
+    node->child = NULL;
+}
+
+struct PrefixTrie* prefix_trie_new(void)
+{
+    struct PrefixTrie* trie = (struct PrefixTrie*) PyMem_Calloc(1, sizeof(struct PrefixTrie));
+    if (!trie) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    return trie;
+}
+
+void prefix_trie_free(struct PrefixTrie* trie)
+{
+    free_children(&trie->root);
+    PyMem_FREE(trie);
+}
+
+void prefix_trie_insert(struct PrefixTrie* trie, const char* prefix)
+{
+    struct PrefixTrieNode* node = &trie->root;
+    char prev = 0;
+
+    while (*prefix) {
+        char c = next_char(&prefix, &prev);
+        struct PrefixTrieNode* child = node->child;
+        if (c == 0) {
+            break;
+        }
+        while (child && child->c != c) {
+            child = child->sibling;
+        }
+        if (!child) {
+            child = (struct PrefixTrieNode*) PyMem_Calloc(1, sizeof(struct PrefixTrieNode));
+            if (!child) {
+                printf("Out of memory!\n");
+                exit(1);
+            }
+            child->c = c;
+            child->sibling = node->child;
+            node->child = child;
+        }
+        node = child;
+        prefix++;
+    }
+
+    node->terminal = 1;
+}
+
+int prefix_trie_match(struct PrefixTrie* trie, const char* target)
+{
+    struct PrefixTrieNode* node = &trie->root;
+    char prev = 0;
+
+    while (!node->terminal) {
+        char c = next_char(&target, &prev);
+        struct PrefixTrieNode* child = node->child;
+        if (c == 0) {
+            return 0;
+        }
+        while (child && child->c != c) {
+            child = child->sibling;
+        }
+        if (!child) {
+            return 0;
+        }
+        node = child;
+        target++;
+    }
+
+    return 1;
+}
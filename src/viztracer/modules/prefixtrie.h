@@ -0,0 +1,31 @@
+// Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+// For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
+
+#ifndef __SNAPTRACE_PREFIXTRIE_H__
+#define __SNAPTRACE_PREFIXTRIE_H__
+
+// A trie of path prefixes, so we can check whether a file name starts
+// with any of the prefixes in one pass of the file name
+
+struct PrefixTrieNode {
+    char c;
+    int terminal;
+    struct PrefixTrieNode* child;
+    struct PrefixTrieNode* sibling;
+};
+
+struct PrefixTrie {
+    struct PrefixTrieNode root;
+};
+
+struct PrefixTrie* prefix_trie_new(void);
+void prefix_trie_free(struct PrefixTrie* trie);
+
+// prefix has to be NULL-terminated
+void prefix_trie_insert(struct PrefixTrie* trie, const char* prefix);
+
+// Return 1 if target starts with any prefix in trie, it has the same
+// semantics as startswith() in util.h
+int prefix_trie_match(struct PrefixTrie* trie, const char* target);
+
+#endif
@@ -3,6 +3,7 @@
 
 #define PY_SSIZE_T_CLEAN
 #include <stdlib.h>
+#include <stdint.h>
 #include <Python.h>
 #include <frameobject.h>
 #include <time.h>
@@ -14,11 +15,72 @@
 #include <pthread.h>
 #include <sys/syscall.h>
 #endif
+#if _WIN32
+#include <io.h>
+#else
+#include <sys/mman.h>
+#include <unistd.h>
+#endif
 
 #include "snaptrace.h"
 #include "util.h"
 #include "eventnode.h"
 
+// PyFrame_GetCode() and PyFrame_GetBack() are available since 3.9, and
+// since 3.11 they are the only way to get them. Provide them for older
+// versions so the tracer only uses one API
+#if PY_VERSION_HEX < 0x030900B1
+static inline PyCodeObject* PyFrame_GetCode(PyFrameObject* frame)
+{
+    Py_INCREF(frame->f_code);
+    return frame->f_code;
+}
+
+static inline PyFrameObject* PyFrame_GetBack(PyFrameObject* frame)
+{
+    Py_XINCREF(frame->f_back);
+    return frame->f_back;
+}
+#endif
+
+#if PY_VERSION_HEX < 0x030900B1
+static inline PyFrameObject* PyThreadState_GetFrame(PyThreadState* tstate)
+{
+    Py_XINCREF(tstate->frame);
+    return tstate->frame;
+}
+
+static inline PyInterpreterState* PyThreadState_GetInterpreter(PyThreadState* tstate)
+{
+    return tstate->interp;
+}
+#endif
+
+// The extra slots of code objects are unstable API since 3.12, with the
+// same functions as before
+#if PY_VERSION_HEX < 0x030C0000
+#define PyUnstable_Eval_RequestCodeExtraIndex _PyEval_RequestCodeExtraIndex
+#define PyUnstable_Code_GetExtra _PyCode_GetExtra
+#define PyUnstable_Code_SetExtra _PyCode_SetExtra
+#endif
+
+#if PY_VERSION_HEX < 0x030B0000
+static inline PyObject* PyCode_GetVarnames(PyCodeObject* code)
+{
+    Py_INCREF(code->co_varnames);
+    return code->co_varnames;
+}
+#endif
+
+// The frame holds a reference to its code, so the code is valid as long
+// as the frame is
+static inline PyCodeObject* get_frame_code(PyFrameObject* frame)
+{
+    PyCodeObject* code = PyFrame_GetCode(frame);
+    Py_DECREF(code);
+    return code;
+}
+
 // Function declarations
 
 int snaptrace_tracefunc(PyObject* obj, PyFrameObject* frame, int what, PyObject* arg);
@@ -29,6 +91,8 @@ static PyObject* snaptrace_stop(TracerObject* self, PyObject* args);
 static PyObject* snaptrace_pause(PyObject* self, PyObject* args);
 static PyObject* snaptrace_resume(PyObject* self, PyObject* args);
 static PyObject* snaptrace_load(TracerObject* self, PyObject* args);
+static PyObject* snaptrace_loadcolumnar(TracerObject* self, PyObject* args);
+static PyObject* snaptrace_dump(TracerObject* self, PyObject* args);
 static PyObject* snaptrace_clear(TracerObject* self, PyObject* args);
 static PyObject* snaptrace_cleanup(TracerObject* self, PyObject* args);
 static PyObject* snaptrace_setpid(TracerObject* self, PyObject* args);
@@ -41,9 +105,17 @@ static PyObject* snaptrace_addfunctionarg(TracerObject* self, PyObject* args);
 static PyObject* snaptrace_getfunctionarg(TracerObject* self, PyObject* args);
 static PyObject* snaptrace_getts(TracerObject* self, PyObject* args);
 static PyObject* snaptrace_setcurrstack(TracerObject* self, PyObject* args);
+static PyObject* snaptrace_setspill(TracerObject* self, PyObject* args);
+static PyObject* snaptrace_setbufferfile(TracerObject* self, PyObject* args);
+static PyObject* snaptrace_getstats(TracerObject* self, PyObject* args);
 static void snaptrace_threaddestructor(void* key);
 static struct ThreadInfo* snaptrace_createthreadinfo(TracerObject* self);
 static void log_func_args(struct FunctionNode* node, PyFrameObject* frame);
+static int spill_event_buffer(TracerObject* self, struct EventBuffer* buffer);
+static int start_sampler(TracerObject* self);
+static void stop_sampler(TracerObject* self);
+static void add_thread_metadata(TracerObject* self, unsigned long tid, PyObject* name);
+static void note_buffer_file_node(TracerObject* self, struct EventNode* node);
 
 TracerObject* curr_tracer = NULL;
 PyObject* threading_module = NULL;
@@ -51,10 +123,42 @@ PyObject* multiprocessing_module = NULL;
 PyObject* asyncio_module = NULL;
 PyObject* asyncio_tasks_module = NULL;
 PyObject* asyncio_tasks_current_task = NULL;
+PyObject* json_dumps = NULL;
 
-#if _WIN32
-extern LARGE_INTEGER qpc_freq; 
-#endif
+// Read the clock only once per event, and only fix up the timestamps
+// within the thread, other threads don't care. All the events recorded
+// from the thread use it, so an event logged in a function is always in it
+static inline int64_t get_thread_ts(struct ThreadInfo* info)
+{
+    int64_t ts = get_clock_ts();
+    if (ts <= info->prev_ts) {
+        // Same as get_ts(), 20 ns is about how long reading the clock takes
+        ts = info->prev_ts + 20;
+    }
+    info->prev_ts = ts;
+    return ts;
+}
+
+// Get the index of the tid in the tid table, add it if it's not there.
+// The table is tiny, there's one entry per thread
+static uint32_t get_tid_index(TracerObject* self, unsigned long tid)
+{
+    for (uint32_t i = 0; i < self->tid_count; i++) {
+        if (self->tids[i] == tid) {
+            return i;
+        }
+    }
+    if (self->tid_count == self->tid_capacity) {
+        self->tid_capacity = self->tid_capacity ? self->tid_capacity * 2 : 16;
+        self->tids = PyMem_Realloc(self->tids, self->tid_capacity * sizeof(unsigned long));
+        if (!self->tids) {
+            printf("Out of memory!\n");
+            exit(1);
+        }
+    }
+    self->tids[self->tid_count] = tid;
+    return self->tid_count++;
+}
 
 static struct ThreadInfo* get_thread_info(TracerObject* self)
 {
@@ -69,34 +173,166 @@ static struct ThreadInfo* get_thread_info(TracerObject* self)
 }
 
 
-static inline struct EventNode* get_next_node(TracerObject* self)
+// The nodes are mapped instead of allocated, so a page only takes memory
+// once the buffer reaches it. A huge tracer_entries is free until used
+static struct EventNode* alloc_event_nodes(long size)
+{
+    void* nodes = NULL;
+#if _WIN32
+    nodes = VirtualAlloc(NULL, size * sizeof(struct EventNode), MEM_RESERVE | MEM_COMMIT, PAGE_READWRITE);
+#else
+    nodes = mmap(NULL, size * sizeof(struct EventNode), PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (nodes == MAP_FAILED) {
+        nodes = NULL;
+    }
+#endif
+    if (!nodes) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    return (struct EventNode*) nodes;
+}
+
+static void free_event_nodes(struct EventNode* nodes, long size)
+{
+#if _WIN32
+    VirtualFree(nodes, 0, MEM_RELEASE);
+#else
+    munmap(nodes, size * sizeof(struct EventNode));
+#endif
+}
+
+static struct EventBuffer* new_event_buffer(long size)
+{
+    struct EventBuffer* buffer = (struct EventBuffer*) PyMem_Calloc(1, sizeof(struct EventBuffer));
+    if (!buffer) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    buffer->nodes = alloc_event_nodes(size);
+    buffer->size = size;
+    buffer->head_idx = 0;
+    buffer->tail_idx = 0;
+    buffer->header = NULL;
+    buffer->next = NULL;
+    return buffer;
+}
+
+// info is NULL for the events that are not logged by the thread itself,
+// like the samples, they always go to the shared buffer
+static struct EventBuffer* get_event_buffer(TracerObject* self, struct ThreadInfo* info)
+{
+    if (!info || !CHECK_FLAG(self->check_flags, SNAPTRACE_PER_THREAD_BUFFER)) {
+        return &self->buffer;
+    }
+
+    if (!info->buffer) {
+        // Allocate lazily so threads that never log anything cost nothing
+        info->buffer = new_event_buffer(self->buffer_size);
+        info->buffer->next = self->thread_buffers;
+        self->thread_buffers = info->buffer;
+    }
+
+    return info->buffer;
+}
+
+// The header of a buffer file, followed by the nodes of the buffer and then
+// the names they need. See binary_trace.py for the whole format
+struct BufferFileHeader {
+    char magic[4];
+    uint32_t bom;
+    uint32_t version;
+    uint32_t node_size;
+    int64_t pid;
+    int64_t size;
+    int64_t head_idx;
+    int64_t tail_idx;
+    uint32_t pointer_size;
+    uint32_t reserved[3];
+};
+
+// The state of the buffer file, see "Map the buffer to a file" below
+struct BufferFile {
+    char* filename;
+    FILE* fptr;
+    struct BufferFileHeader* header;
+    size_t map_size;
+#if _WIN32
+    HANDLE mapping;
+#endif
+    // The buffer mapped to the file, NULL in a forked child
+    struct EventBuffer* buffer;
+    // The functions that already have their names in the file
+    struct FuncNameTable names;
+    // The first tid_count tids of the tracer are already in the file
+    uint32_t tid_count;
+    // The live nodes copied out for the child while forking
+    struct EventNode* fork_copy;
+    struct BufferFile* next;
+};
+
+static inline void sync_buffer_header(struct EventBuffer* buffer)
+{
+    if (buffer->header) {
+        buffer->header->head_idx = buffer->head_idx;
+        buffer->header->tail_idx = buffer->tail_idx;
+    }
+}
+
+static inline struct EventNode* get_next_node(TracerObject* self, struct ThreadInfo* info)
 {
+    struct EventBuffer* buffer = get_event_buffer(self, info);
     struct EventNode* node = NULL;
 
-    node = self->buffer + self->buffer_tail_idx;
+    node = buffer->nodes + buffer->tail_idx;
     // This is actually faster than modulo
-    self->buffer_tail_idx = self->buffer_tail_idx + 1;
-    if (self->buffer_tail_idx >= self->buffer_size) {
-        self->buffer_tail_idx = 0;
-    }
-    if (self->buffer_tail_idx == self->buffer_head_idx) {
-        self->buffer_head_idx = self->buffer_head_idx + 1;
-        if (self->buffer_head_idx >= self->buffer_size) {
-            self->buffer_head_idx = 0;
+    buffer->tail_idx = buffer->tail_idx + 1;
+    if (buffer->tail_idx >= buffer->size) {
+        buffer->tail_idx = 0;
+    }
+    if (buffer->tail_idx == buffer->head_idx) {
+        // The buffer is full. Spill the oldest events to disk if we can,
+        // otherwise overwrite the oldest one
+        if (!self->spill || spill_event_buffer(self, buffer) < 0) {
+            buffer->head_idx = buffer->head_idx + 1;
+            if (buffer->head_idx >= buffer->size) {
+                buffer->head_idx = 0;
+            }
+            clear_node(buffer->nodes + buffer->tail_idx);
         }
-        clear_node(self->buffer + self->buffer_tail_idx);
-    } else {
-        self->total_entries += 1;
     }
+    sync_buffer_header(buffer);
 
     return node;
 }
 
+static inline long event_buffer_count(struct EventBuffer* buffer)
+{
+    if (buffer->tail_idx >= buffer->head_idx) {
+        return buffer->tail_idx - buffer->head_idx;
+    }
+    return buffer->tail_idx + buffer->size - buffer->head_idx;
+}
+
+static void clear_event_buffer(struct EventBuffer* buffer)
+{
+    struct EventNode* curr = buffer->nodes + buffer->head_idx;
+    while (curr != buffer->nodes + buffer->tail_idx) {
+        clear_node(curr);
+        curr = curr + 1;
+        if (curr == buffer->nodes + buffer->size) {
+            curr = buffer->nodes;
+        }
+    }
+    buffer->tail_idx = buffer->head_idx;
+    sync_buffer_header(buffer);
+}
+
 static void log_func_args(struct FunctionNode* node, PyFrameObject* frame)
 {
     PyObject* func_arg_dict = PyDict_New();
-    PyCodeObject* code = frame->f_code;
-    PyObject* names = code->co_varnames;
+    PyCodeObject* code = get_frame_code(frame);
+    PyObject* names = PyCode_GetVarnames(code);
     PyObject* locals = PyEval_GetLocals();
 
     int idx = 0;
@@ -129,6 +365,7 @@ static void log_func_args(struct FunctionNode* node, PyFrameObject* frame)
 
     PyDict_SetItemString(node->args, "func_args", func_arg_dict);
     Py_DECREF(func_arg_dict);
+    Py_DECREF(names);
 }
 
 static void verbose_printf(TracerObject* self, int v, const char* fmt, ...)
@@ -161,6 +398,8 @@ static PyMethodDef Tracer_methods[] = {
     {"start", (PyCFunction)snaptrace_start, METH_VARARGS, "start profiling"},
     {"stop", (PyCFunction)snaptrace_stop, METH_VARARGS, "stop profiling"},
     {"load", (PyCFunction)snaptrace_load, METH_VARARGS, "load buffer"},
+    {"loadcolumnar", (PyCFunction)snaptrace_loadcolumnar, METH_VARARGS, "load buffer to columns"},
+    {"dump", (PyCFunction)snaptrace_dump, METH_VARARGS, "dump buffer to a binary file"},
     {"clear", (PyCFunction)snaptrace_clear, METH_VARARGS, "clear buffer"},
     {"cleanup", (PyCFunction)snaptrace_cleanup, METH_VARARGS, "free the memory allocated"},
     {"setpid", (PyCFunction)snaptrace_setpid, METH_VARARGS, "set fixed pid"},
@@ -173,6 +412,9 @@ static PyMethodDef Tracer_methods[] = {
     {"getfunctionarg", (PyCFunction)snaptrace_getfunctionarg, METH_VARARGS, "get current function arg"},
     {"getts", (PyCFunction)snaptrace_getts, METH_VARARGS, "get timestamp"},
     {"setcurrstack", (PyCFunction)snaptrace_setcurrstack, METH_VARARGS, "set current stack depth"},
+    {"setspill", (PyCFunction)snaptrace_setspill, METH_VARARGS, "set the file to spill the buffer to"},
+    {"setbufferfile", (PyCFunction)snaptrace_setbufferfile, METH_VARARGS, "set the file to map the buffer to"},
+    {"getstats", (PyCFunction)snaptrace_getstats, METH_VARARGS, "get the stats of the functions"},
     {"pause", (PyCFunction)snaptrace_pause, METH_VARARGS, "pause profiling"},
     {"resume", (PyCFunction)snaptrace_resume, METH_VARARGS, "resume profiling"},
     {NULL, NULL, 0, NULL}
@@ -194,6 +436,195 @@ static struct PyModuleDef snaptracemodule = {
     Snaptrace_methods
 };
 
+// The extra slot of the code objects for the verdict of
+// check_code_ignored(), -1 if there's no slot left. The verdict is a
+// number, (tag << 1) | ignore, so the slot doesn't keep anything alive and
+// it's gone with the code object
+static Py_ssize_t code_verdict_index = -1;
+// The last verdict tag. Every config of every tracer gets a new one, so
+// the verdicts of the other configs are never used
+static uintptr_t code_verdict_tag = 0;
+
+// Whether to ignore the python function with code and everything it
+// calls, because it's VizTracer itself, it's filtered by include_files or
+// exclude_files, or it's frozen. The verdict only depends on the code and
+// the config, so it's cached in the code object
+static inline int check_code_ignored(TracerObject* self, PyCodeObject* code)
+{
+    int ignore = 0;
+    const char* file_name = NULL;
+    void* verdict = NULL;
+
+    if (code_verdict_index >= 0) {
+        if (PyUnstable_Code_GetExtra((PyObject*)code, code_verdict_index, &verdict) < 0) {
+            PyErr_Clear();
+        } else if (verdict && ((uintptr_t)verdict >> 1) == self->verdict_tag) {
+            return (uintptr_t)verdict & 1;
+        }
+    }
+
+    file_name = PyUnicode_AsUTF8(code->co_filename);
+    if (!file_name) {
+        PyErr_Clear();
+        file_name = "";
+    }
+
+    if (!CHECK_FLAG(self->check_flags, SNAPTRACE_TRACE_SELF) &&
+            self->lib_file_path && startswith(file_name, self->lib_file_path)) {
+        ignore = 1;
+    } else if (CHECK_FLAG(self->check_flags, SNAPTRACE_INCLUDE_FILES | SNAPTRACE_EXCLUDE_FILES)) {
+        int matched = prefix_trie_match(self->file_trie, file_name);
+        if (CHECK_FLAG(self->check_flags, SNAPTRACE_INCLUDE_FILES)) {
+            ignore = !matched;
+        } else {
+            ignore = matched;
+        }
+    }
+
+    if (!ignore && CHECK_FLAG(self->check_flags, SNAPTRACE_IGNORE_FROZEN)) {
+        ignore = startswith(file_name, "<frozen");
+    }
+
+    if (code_verdict_index >= 0) {
+        verdict = (void*)((self->verdict_tag << 1) | (uintptr_t)ignore);
+        if (PyUnstable_Code_SetExtra((PyObject*)code, code_verdict_index, verdict) < 0) {
+            PyErr_Clear();
+        }
+    }
+
+    return ignore;
+}
+
+// Build the trie from include_files or exclude_files, whichever is in
+// use. The verdict cache is always invalidated because the config changed
+static void update_code_filter(TracerObject* self)
+{
+    PyObject* files = NULL;
+
+    self->verdict_tag = ++code_verdict_tag;
+    if (self->file_trie) {
+        prefix_trie_free(self->file_trie);
+        self->file_trie = NULL;
+    }
+
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_INCLUDE_FILES)) {
+        files = self->include_files;
+    } else if (CHECK_FLAG(self->check_flags, SNAPTRACE_EXCLUDE_FILES)) {
+        files = self->exclude_files;
+    } else {
+        return;
+    }
+
+    self->file_trie = prefix_trie_new();
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(files); i++) {
+        const char* prefix = PyUnicode_AsUTF8(PyList_GET_ITEM(files, i));
+        if (prefix) {
+            prefix_trie_insert(self->file_trie, prefix);
+        } else {
+            PyErr_Clear();
+        }
+    }
+}
+
+// Set the function of a FEE node from the profile event, no reference is
+// taken. For C functions, arg is the PyCFunctionObject
+static inline void set_fee_function(struct EventNode* node, int what, PyCodeObject* code, PyObject* arg)
+{
+    node->data.fee.type = what;
+    if (what == PyTrace_CALL || what == PyTrace_RETURN) {
+        node->data.fee.code = code;
+    } else {
+        PyCFunctionObject* cfunc = (PyCFunctionObject*) arg;
+        node->data.fee.ml_name = cfunc->m_ml->ml_name;
+        if (cfunc->m_module) {
+            // The function belongs to a module
+            node->data.fee.in_module = 1;
+            node->data.fee.m_module = cfunc->m_module;
+        } else {
+            // The function is a class method
+            node->data.fee.in_module = 0;
+            if (cfunc->m_self) {
+                // It's not a static method, has __self__
+                node->data.fee.tp_name = cfunc->m_self->ob_type->tp_name;
+            } else {
+                // It's a static method, does not have __self__
+                node->data.fee.tp_name = NULL;
+            }
+        }
+    }
+}
+
+// Count a finished call of the function and decide whether to log it.
+// The first call_budget calls are logged, after that only one of every
+// call_sample_ratio calls is. The dropped calls are summed up per function
+static int check_call_budget(TracerObject* self, int what, PyCodeObject* code, PyObject* arg, int64_t ts, int64_t dur)
+{
+    struct EventNode node;
+    struct FuncNameEntry* entry = NULL;
+    uint64_t extra_calls = 0;
+
+    set_fee_function(&node, what, code, arg);
+    entry = get_func_name_entry(&node, &self->call_counts);
+    entry->calls += 1;
+    if (entry->calls <= (uint64_t)self->call_budget) {
+        return 1;
+    }
+
+    extra_calls = entry->calls - self->call_budget;
+    if (self->call_sample_ratio > 0 && extra_calls % self->call_sample_ratio == 0) {
+        return 1;
+    }
+
+    entry->dropped += 1;
+    entry->dropped_dur += dur;
+    entry->last_dropped_ts = ts + dur;
+
+    return 0;
+}
+
+// A call of the function starts, for the stats
+static void enter_func_stats(TracerObject* self, int what, PyCodeObject* code, PyObject* arg)
+{
+    struct EventNode node;
+
+    set_fee_function(&node, what, code, arg);
+    get_func_name_entry(&node, &self->func_stats)->active_calls += 1;
+}
+
+// Add a finished call of the function to the stats. Like cProfile, the
+// total only counts the outermost frame of a recursive function. The
+// frames are counted for all the threads together
+static void update_func_stats(TracerObject* self, int what, PyCodeObject* code, PyObject* arg, int64_t dur, int64_t self_dur)
+{
+    struct EventNode node;
+    struct FuncNameEntry* entry = NULL;
+
+    set_fee_function(&node, what, code, arg);
+    entry = get_func_name_entry(&node, &self->func_stats);
+    if (entry->calls == 0 || dur < entry->min_dur) {
+        entry->min_dur = dur;
+    }
+    if (dur > entry->max_dur) {
+        entry->max_dur = dur;
+    }
+    entry->calls += 1;
+    // The stats could start in the middle of the call
+    if (entry->active_calls > 0) {
+        entry->active_calls -= 1;
+    }
+    if (entry->active_calls == 0) {
+        entry->total_dur += dur;
+    }
+    entry->self_dur += self_dur;
+}
+
+// Whether the events come from the profile function, rather than from
+// sys.monitoring or the sampler
+static inline int uses_profile_function(TracerObject* self)
+{
+    return !CHECK_FLAG(self->check_flags, SNAPTRACE_USE_MONITORING) && !self->sampler;
+}
+
 // =============================================================================
 // Tracing function, triggered when FEE
 // =============================================================================
@@ -202,6 +633,12 @@ snaptrace_tracefuncdisabled(PyObject* obj, PyFrameObject* frame, int what, PyObj
 {
     TracerObject* self = (TracerObject*) obj;
     if (self->collecting) {
+        if (!uses_profile_function(self)) {
+            // sys.monitoring or the sampler takes care of this thread,
+            // the profile function is not needed anymore
+            PyEval_SetProfile(NULL, NULL);
+            return 0;
+        }
         PyEval_SetProfile(snaptrace_tracefunc, obj);
         return snaptrace_tracefunc(obj, frame, what, arg);
     }
@@ -225,6 +662,7 @@ snaptrace_tracefunc(PyObject* obj, PyFrameObject* frame, int what, PyObject* arg
         int is_return = (what == PyTrace_RETURN || what == PyTrace_C_RETURN || what == PyTrace_C_EXCEPTION);
         int is_python = (what == PyTrace_CALL || what == PyTrace_RETURN);
         int is_c = (what == PyTrace_C_CALL || what == PyTrace_C_RETURN || what == PyTrace_C_EXCEPTION);
+        PyCodeObject* code = is_python ? get_frame_code(frame) : NULL;
 
         if (info->paused) {
             return 0;
@@ -240,13 +678,10 @@ snaptrace_tracefunc(PyObject* obj, PyFrameObject* frame, int what, PyObject* arg
             }
         }
 
-        // Exclude Self
-        if (is_python && is_call && !CHECK_FLAG(self->check_flags, SNAPTRACE_TRACE_SELF)) {
-            PyObject* file_name = frame->f_code->co_filename;
-            if (self->lib_file_path && startswith(PyUnicode_AsUTF8(file_name), self->lib_file_path)) {
-                info->ignore_stack_depth += 1;
-                return 0;
-            }
+        // Exclude self, include/exclude files and frozen modules
+        if (is_python && is_call && check_code_ignored(self, code)) {
+            info->ignore_stack_depth += 1;
+            return 0;
         }
         
         // IMPORTANT: the C function will always be called from our python methods, 
@@ -282,50 +717,9 @@ snaptrace_tracefunc(PyObject* obj, PyFrameObject* frame, int what, PyObject* arg
             }
         }
 
-        // Check include/exclude files
-        if (CHECK_FLAG(self->check_flags, SNAPTRACE_INCLUDE_FILES | SNAPTRACE_EXCLUDE_FILES) && is_python && is_call) {
-            if (info->ignore_stack_depth == 0) {
-                PyObject* files = NULL;
-                int record = 0;
-                int is_include = CHECK_FLAG(self->check_flags, SNAPTRACE_INCLUDE_FILES);
-                if (is_include) {
-                    files = self->include_files;
-                    record = 0;
-                } else {
-                    files = self->exclude_files;
-                    record = 1;
-                }
-                Py_ssize_t length = PyList_GET_SIZE(files);
-                PyObject* name = frame->f_code->co_filename;
-                for (int i = 0; i < length; i++) {
-                    PyObject* f = PyList_GET_ITEM(files, i);
-                    if (startswith(PyUnicode_AsUTF8(name), PyUnicode_AsUTF8(f))) {
-                        record = 1 - record;
-                        break;
-                    }
-                }
-                if (record == 0) {
-                    info->ignore_stack_depth += 1;
-                    return 0;
-                }
-            } else {
-                return 0;
-            }
-        }
-
-        if (CHECK_FLAG(self->check_flags, SNAPTRACE_IGNORE_FROZEN)) {
-            if (is_python && is_call) {
-                PyObject* file_name = frame->f_code->co_filename;
-                if (startswith(PyUnicode_AsUTF8(file_name), "<frozen")) {
-                    info->ignore_stack_depth += 1;
-                    return 0;
-                }
-            }
-        }
-
         if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
             if (info->curr_task == NULL) {
-                if (is_python && is_call && (frame->f_code->co_flags & CO_COROUTINE) != 0) {
+                if (is_python && is_call && (code->co_flags & CO_COROUTINE) != 0) {
                     info->paused = 1;
                     PyObject* curr_task = PyObject_CallObject(asyncio_tasks_current_task, NULL);
                     info->paused = 0;
@@ -344,72 +738,78 @@ snaptrace_tracefunc(PyObject* obj, PyFrameObject* frame, int what, PyObject* arg
                 info->stack_top->next->prev = info->stack_top;
             }
             info->stack_top = info->stack_top->next;
-            info->stack_top->ts = get_ts();
-            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNCTION_ARGS)) {
+            info->stack_top->ts = get_thread_ts(info);
+            info->stack_top->children_dur = 0;
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_COLLECT_STATS | SNAPTRACE_STATS_ONLY)) {
+                enter_func_stats(self, what, code, arg);
+            }
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNCTION_ARGS) &&
+                    !CHECK_FLAG(self->check_flags, SNAPTRACE_STATS_ONLY)) {
                 log_func_args(info->stack_top, frame);
             }
         } else if (is_return) {
             struct FunctionNode* stack_top = info->stack_top;
             if (stack_top->prev) {
                 // if stack_top has prev, it's not the fake node so it's at least root
-                double dur = get_ts() - info->stack_top->ts;
+                int64_t dur = get_thread_ts(info) - info->stack_top->ts;
                 int log_this_entry = dur >= self->min_duration;
 
+                if (CHECK_FLAG(self->check_flags, SNAPTRACE_COLLECT_STATS | SNAPTRACE_STATS_ONLY)) {
+                    update_func_stats(self, what, code, arg, dur, dur - stack_top->children_dur);
+                    stack_top->prev->children_dur += dur;
+                    if (CHECK_FLAG(self->check_flags, SNAPTRACE_STATS_ONLY)) {
+                        log_this_entry = 0;
+                    }
+                }
+
+                if (log_this_entry && self->call_budget > 0) {
+                    log_this_entry = check_call_budget(self, what, code, arg, info->stack_top->ts, dur);
+                }
+
                 if (log_this_entry) {
-                    node = get_next_node(self);
+                    node = get_next_node(self, info);
                     node->ntype = FEE_NODE;
                     node->ts = info->stack_top->ts;
-                    node->data.fee.dur = get_ts() - info->stack_top->ts;
-                    node->tid = info->tid;
-                    node->data.fee.type = what;
+                    node->data.fee.dur = dur;
+                    node->data.fee.payload = 0;
+                    node->tid_idx = info->tid_idx;
+                    set_fee_function(node, what, code, arg);
+                    if (self->buffer_file && self->buffer_file->buffer) {
+                        note_buffer_file_node(self, node);
+                    }
+                    // Only the nodes with any of the optional data get a payload
                     if (is_python) {
-                        node->data.fee.co_name = frame->f_code->co_name;
-                        node->data.fee.co_filename = frame->f_code->co_filename;
-                        node->data.fee.co_firstlineno = frame->f_code->co_firstlineno;
-                        Py_INCREF(node->data.fee.co_name);
-                        Py_INCREF(node->data.fee.co_filename);
+                        Py_INCREF(node->data.fee.code);
                         if (stack_top->args) {
                             // steal the reference when return
-                            node->data.fee.args = stack_top->args;
                             Py_INCREF(stack_top->args);
+                            ensure_fee_payload(node)->args = stack_top->args;
                         }
                         if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_RETURN_VALUE)) {
-                            node->data.fee.retval = PyObject_Repr(arg);
+                            PyObject* retval = PyObject_Repr(arg);
+                            ensure_fee_payload(node)->retval = retval;
                         }
-                        if (!CHECK_FLAG(self->check_flags, SNAPTRACE_NOVDB) && frame->f_back) {
-                            node->data.fee.caller_lineno = PyFrame_GetLineNumber(frame->f_back);
-                        } else {
-                            node->data.fee.caller_lineno = -1;
+                        if (!CHECK_FLAG(self->check_flags, SNAPTRACE_NOVDB)) {
+                            PyFrameObject* caller = PyFrame_GetBack(frame);
+                            if (caller) {
+                                int caller_lineno = PyFrame_GetLineNumber(caller);
+                                ensure_fee_payload(node)->caller_lineno = caller_lineno;
+                                Py_DECREF(caller);
+                            }
                         }
                     } else if (is_c) {
-                        PyCFunctionObject* cfunc = (PyCFunctionObject*) arg;
-                        node->data.fee.ml_name = cfunc->m_ml->ml_name;
-                        if (cfunc->m_module) {
-                            // The function belongs to a module
-                            node->data.fee.m_module = cfunc->m_module;
-                            Py_INCREF(cfunc->m_module);
-                        } else {
-                            // The function is a class method
-                            node->data.fee.m_module = NULL;
-                            if (cfunc->m_self) {
-                                // It's not a static method, has __self__
-                                node->data.fee.tp_name = cfunc->m_self->ob_type->tp_name;
-                            } else {
-                                // It's a static method, does not have __self__
-                                node->data.fee.tp_name = NULL;
-                            }
+                        if (node->data.fee.in_module) {
+                            Py_INCREF(node->data.fee.m_module);
                         }
                         if (!CHECK_FLAG(self->check_flags, SNAPTRACE_NOVDB)) {
-                            node->data.fee.caller_lineno = PyFrame_GetLineNumber(frame);
-                        } else {
-                            node->data.fee.caller_lineno = -1;
+                            ensure_fee_payload(node)->caller_lineno = PyFrame_GetLineNumber(frame);
                         }
                     } 
 
                     if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
                         if (info->curr_task) {
-                            node->data.fee.asyncio_task = info->curr_task;
                             Py_INCREF(info->curr_task);
+                            ensure_fee_payload(node)->asyncio_task = info->curr_task;
                         }
                     }
                 }
@@ -450,7 +850,9 @@ static PyObject* snaptrace_threadtracefunc(PyObject* obj, PyObject* args)
         printf("Error when parsing arguments!\n");
         exit(1);
     }
-    snaptrace_createthreadinfo((TracerObject*) obj);
+    if (!get_thread_info((TracerObject*) obj)) {
+        snaptrace_createthreadinfo((TracerObject*) obj);
+    }
     PyEval_SetProfile(snaptrace_tracefuncdisabled, obj);
     if (!strcmp(event, "call")) {
         what = PyTrace_CALL;
@@ -463,354 +865,2310 @@ static PyObject* snaptrace_threadtracefunc(PyObject* obj, PyObject* args)
     } else {
         printf("Unexpected event type: %s\n", event);
     }
-    snaptrace_tracefuncdisabled(obj, frame, what, trace_args);
+    snaptrace_tracefuncdisabled(obj, frame, what, trace_args);
+    Py_RETURN_NONE;
+}
+
+// =============================================================================
+// sys.monitoring backend, Python 3.12+
+//
+// The tracer registers itself as the profiler tool of sys.monitoring and
+// converts the events to the profile events of snaptrace_tracefunc, so
+// both backends record the same data. The ignore verdict of a code object
+// only depends on the config, so its events return DISABLE and the
+// interpreter stops generating them for that code
+// =============================================================================
+#if PY_VERSION_HEX >= 0x030C0000
+
+PyObject* sys_monitoring = NULL;
+PyObject* sys_monitoring_disable = NULL;
+PyObject* sys_monitoring_missing = NULL;
+int sys_monitoring_tool_id = -1;
+
+// arg is NULL when the event is a call to a callable that the profile
+// function does not report, it still needs to be checked for DISABLE
+static PyObject*
+monitoring_dispatch(TracerObject* self, PyCodeObject* code, int what, PyObject* arg, int can_disable)
+{
+    if (!self->collecting) {
+        Py_RETURN_NONE;
+    }
+
+    if (check_code_ignored(self, code)) {
+        if (can_disable) {
+            Py_INCREF(sys_monitoring_disable);
+            return sys_monitoring_disable;
+        }
+        Py_RETURN_NONE;
+    }
+
+    if (!arg) {
+        Py_RETURN_NONE;
+    }
+
+    // The events come from every thread, including the ones that
+    // started before the tracer
+    if (!get_thread_info(self)) {
+        snaptrace_createthreadinfo(self);
+    }
+
+    snaptrace_tracefunc((PyObject*)self, PyEval_GetFrame(), what, arg);
+
+    Py_RETURN_NONE;
+}
+
+// The profile function reports builtin functions, and method descriptors
+// bound to their first argument
+static PyObject*
+monitoring_c_event(TracerObject* self, PyObject* const* args, int what)
+{
+    PyCodeObject* code = (PyCodeObject*)args[0];
+    PyObject* callable = args[2];
+    PyObject* arg0 = args[3];
+    PyObject* ret = NULL;
+
+    if (PyCFunction_Check(callable)) {
+        return monitoring_dispatch(self, code, what, callable, what == PyTrace_C_CALL);
+    } else if (Py_IS_TYPE(callable, &PyMethodDescr_Type) && arg0 != sys_monitoring_missing &&
+            PyObject_TypeCheck(arg0, PyDescr_TYPE(callable))) {
+        if (what == PyTrace_C_CALL) {
+            // The call only pushes the stack, bind the method on return
+            return monitoring_dispatch(self, code, what, callable, 1);
+        }
+        callable = Py_TYPE(callable)->tp_descr_get(callable, arg0, (PyObject*)Py_TYPE(arg0));
+        if (!callable) {
+            PyErr_Clear();
+            Py_RETURN_NONE;
+        }
+        ret = monitoring_dispatch(self, code, what, callable, 0);
+        Py_DECREF(callable);
+        return ret;
+    }
+
+    return monitoring_dispatch(self, code, what, NULL, what == PyTrace_C_CALL);
+}
+
+// PY_START(code, offset), PY_RESUME(code, offset)
+static PyObject*
+monitoring_py_start(PyObject* obj, PyObject* const* args, Py_ssize_t nargs)
+{
+    return monitoring_dispatch((TracerObject*)obj, (PyCodeObject*)args[0], PyTrace_CALL, Py_None, 1);
+}
+
+// PY_THROW(code, offset, exception), can't be disabled
+static PyObject*
+monitoring_py_throw(PyObject* obj, PyObject* const* args, Py_ssize_t nargs)
+{
+    return monitoring_dispatch((TracerObject*)obj, (PyCodeObject*)args[0], PyTrace_CALL, Py_None, 0);
+}
+
+// PY_RETURN(code, offset, retval), PY_YIELD(code, offset, retval)
+static PyObject*
+monitoring_py_return(PyObject* obj, PyObject* const* args, Py_ssize_t nargs)
+{
+    return monitoring_dispatch((TracerObject*)obj, (PyCodeObject*)args[0], PyTrace_RETURN, args[2], 1);
+}
+
+// PY_UNWIND(code, offset, exception), can't be disabled
+static PyObject*
+monitoring_py_unwind(PyObject* obj, PyObject* const* args, Py_ssize_t nargs)
+{
+    return monitoring_dispatch((TracerObject*)obj, (PyCodeObject*)args[0], PyTrace_RETURN, Py_None, 0);
+}
+
+// CALL(code, offset, callable, arg0)
+static PyObject*
+monitoring_call(PyObject* obj, PyObject* const* args, Py_ssize_t nargs)
+{
+    return monitoring_c_event((TracerObject*)obj, args, PyTrace_C_CALL);
+}
+
+// C_RETURN(code, offset, callable, arg0)
+static PyObject*
+monitoring_c_return(PyObject* obj, PyObject* const* args, Py_ssize_t nargs)
+{
+    return monitoring_c_event((TracerObject*)obj, args, PyTrace_C_RETURN);
+}
+
+// C_RAISE(code, offset, callable, arg0)
+static PyObject*
+monitoring_c_raise(PyObject* obj, PyObject* const* args, Py_ssize_t nargs)
+{
+    return monitoring_c_event((TracerObject*)obj, args, PyTrace_C_EXCEPTION);
+}
+
+// The name is the event name in sys.monitoring.events
+static PyMethodDef monitoring_callbacks[] = {
+    {"PY_START", (PyCFunction)(void(*)(void))monitoring_py_start, METH_FASTCALL, NULL},
+    {"PY_RESUME", (PyCFunction)(void(*)(void))monitoring_py_start, METH_FASTCALL, NULL},
+    {"PY_THROW", (PyCFunction)(void(*)(void))monitoring_py_throw, METH_FASTCALL, NULL},
+    {"PY_RETURN", (PyCFunction)(void(*)(void))monitoring_py_return, METH_FASTCALL, NULL},
+    {"PY_YIELD", (PyCFunction)(void(*)(void))monitoring_py_return, METH_FASTCALL, NULL},
+    {"PY_UNWIND", (PyCFunction)(void(*)(void))monitoring_py_unwind, METH_FASTCALL, NULL},
+    // C function events, they are not turned on with ignore_c_function
+    {"CALL", (PyCFunction)(void(*)(void))monitoring_call, METH_FASTCALL, NULL},
+    {"C_RETURN", (PyCFunction)(void(*)(void))monitoring_c_return, METH_FASTCALL, NULL},
+    {"C_RAISE", (PyCFunction)(void(*)(void))monitoring_c_raise, METH_FASTCALL, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+#define MONITORING_PYTHON_EVENTS 6
+
+// Register the callbacks of self and turn on the events. If self is NULL,
+// turn off the events and unregister the callbacks
+static int
+monitoring_set_callbacks(TracerObject* self)
+{
+    PyObject* events = PyObject_GetAttrString(sys_monitoring, "events");
+    PyObject* result = NULL;
+    long event_set = 0;
+
+    if (!events) {
+        return -1;
+    }
+
+    for (PyMethodDef* def = monitoring_callbacks; def->ml_name; def++) {
+        PyObject* event = PyObject_GetAttrString(events, def->ml_name);
+        PyObject* callback = Py_None;
+        if (!event) {
+            Py_DECREF(events);
+            return -1;
+        }
+        if (self && (def - monitoring_callbacks < MONITORING_PYTHON_EVENTS ||
+                !CHECK_FLAG(self->check_flags, SNAPTRACE_IGNORE_C_FUNCTION))) {
+            event_set |= PyLong_AsLong(event);
+            callback = PyCFunction_New(def, (PyObject*)self);
+            if (!callback) {
+                Py_DECREF(event);
+                Py_DECREF(events);
+                return -1;
+            }
+        } else {
+            Py_INCREF(callback);
+        }
+        result = PyObject_CallMethod(sys_monitoring, "register_callback", "iOO",
+                                     sys_monitoring_tool_id, event, callback);
+        Py_DECREF(event);
+        Py_DECREF(callback);
+        if (!result) {
+            Py_DECREF(events);
+            return -1;
+        }
+        Py_DECREF(result);
+    }
+    Py_DECREF(events);
+
+    result = PyObject_CallMethod(sys_monitoring, "set_events", "il", sys_monitoring_tool_id, event_set);
+    if (!result) {
+        return -1;
+    }
+    Py_DECREF(result);
+
+    return 0;
+}
+
+// Whether the profiler tool id is used by viztracer
+static int
+monitoring_tool_in_use(void)
+{
+    PyObject* tool = PyObject_CallMethod(sys_monitoring, "get_tool", "i", sys_monitoring_tool_id);
+    int in_use = 0;
+
+    if (!tool) {
+        PyErr_Clear();
+        return 0;
+    }
+    in_use = PyUnicode_Check(tool) && PyUnicode_CompareWithASCIIString(tool, "viztracer") == 0;
+    Py_DECREF(tool);
+
+    return in_use;
+}
+
+static int
+monitoring_start(TracerObject* self)
+{
+    PyObject* result = NULL;
+
+    if (!monitoring_tool_in_use()) {
+        // Raises if another profiler is using sys.monitoring
+        result = PyObject_CallMethod(sys_monitoring, "use_tool_id", "is", sys_monitoring_tool_id, "viztracer");
+        if (!result) {
+            return -1;
+        }
+        Py_DECREF(result);
+    }
+
+    if (monitoring_set_callbacks(self) < 0) {
+        return -1;
+    }
+
+    // Code disabled by a previous run could have a different verdict now
+    result = PyObject_CallMethod(sys_monitoring, "restart_events", NULL);
+    if (!result) {
+        return -1;
+    }
+    Py_DECREF(result);
+
+    return 0;
+}
+
+static void
+monitoring_stop(void)
+{
+    PyObject* result = NULL;
+
+    if (!monitoring_tool_in_use()) {
+        return;
+    }
+
+    if (monitoring_set_callbacks(NULL) < 0) {
+        PyErr_WriteUnraisable(sys_monitoring);
+    }
+
+    result = PyObject_CallMethod(sys_monitoring, "free_tool_id", "i", sys_monitoring_tool_id);
+    if (!result) {
+        PyErr_WriteUnraisable(sys_monitoring);
+    }
+    Py_XDECREF(result);
+}
+
+#endif
+
+// =============================================================================
+// Control interface with python
+// =============================================================================
+
+static PyObject*
+snaptrace_start(TracerObject* self, PyObject* args)
+{
+    if (curr_tracer) {
+        printf("Warning! Overwrite tracer! You should not have two VizTracer recording at the same time!\n");
+    } else {
+        curr_tracer = self;
+    }
+
+    if (self->sample_interval > 0) {
+        if (!self->sampler && start_sampler(self) < 0) {
+            curr_tracer = NULL;
+            return NULL;
+        }
+        PyEval_SetProfile(NULL, NULL);
+        self->collecting = 1;
+    } else if (CHECK_FLAG(self->check_flags, SNAPTRACE_USE_MONITORING)) {
+#if PY_VERSION_HEX >= 0x030C0000
+        if (monitoring_start(self) < 0) {
+            curr_tracer = NULL;
+            return NULL;
+        }
+        PyEval_SetProfile(NULL, NULL);
+#endif
+        self->collecting = 1;
+    } else {
+        self->collecting = 1;
+        PyEval_SetProfile(snaptrace_tracefunc, (PyObject*) self);
+    }
+
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+snaptrace_stop(TracerObject* self, PyObject* args)
+{
+    if (self) {
+        struct ThreadInfo* info = get_thread_info(self);
+        stop_sampler(self);
+        self->collecting = 0;
+
+        info->curr_stack_depth = 0;
+        info->ignore_stack_depth = 0;
+        info->paused = 0;
+        clear_stack(&info->stack_top);
+    }
+    curr_tracer = NULL;
+#if PY_VERSION_HEX >= 0x030C0000
+    if (self && CHECK_FLAG(self->check_flags, SNAPTRACE_USE_MONITORING)) {
+        monitoring_stop();
+    }
+#endif
+    PyEval_SetProfile(NULL, NULL);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+snaptrace_pause(PyObject* self, PyObject* args)
+{
+    if (curr_tracer->collecting) {
+        PyGILState_STATE state = PyGILState_Ensure();
+        struct ThreadInfo* info = get_thread_info((TracerObject*)self);
+
+        if (!info) {
+            // A thread that sys.monitoring has not reported yet
+            info = snaptrace_createthreadinfo((TracerObject*)self);
+        }
+
+        if (!info->paused) {
+            // With sys.monitoring, the ignored functions are never
+            // counted, the paused flag is enough
+            if (uses_profile_function((TracerObject*)self)) {
+                PyEval_SetProfile(NULL, NULL);
+                // When we enter this function, viztracer.pause and
+                // tracer.pause both have been called. We need to
+                // reduce the ignore_stack_depth to simulate the
+                // returns from these two functions
+                info->ignore_stack_depth -= 2;
+            }
+            info->paused = 1;
+        }
+        PyGILState_Release(state);
+    }
+
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+snaptrace_resume(PyObject* self, PyObject* args)
+{
+    if (curr_tracer->collecting) {
+        PyGILState_STATE state = PyGILState_Ensure();
+        struct ThreadInfo* info = get_thread_info((TracerObject*)self);
+
+        if (info && info->paused) {
+            if (uses_profile_function((TracerObject*)self)) {
+                PyEval_SetProfile(snaptrace_tracefunc, self);
+                // When we enter this function, viztracer.pause and
+                // tracer.pause both have been called but not recorded.
+                // It seems like C function tracer.pause's return will not
+                // be recorded.
+                // We need to increment the ignore_stack_depth to simulate the
+                // call of the function
+                info->ignore_stack_depth += 1;
+            }
+            info->paused = 0;
+        }
+        PyGILState_Release(state);
+    }
+
+    Py_RETURN_NONE;
+}
+
+// =============================================================================
+// Load and dump the buffers
+// =============================================================================
+
+struct LoadContext {
+    PyObject* pid;
+    PyObject* cat_fee;
+    PyObject* cat_instant;
+    PyObject* ph_I;
+    PyObject* ph_X;
+    PyObject* ph_C;
+    PyObject* ph_M;
+    // task id -> task name, only used with LOG_ASYNC
+    PyObject* task_dict;
+    struct FuncNameTable func_names;
+    // Load the timestamps as int ns instead of float us
+    int integer_ts;
+};
+
+struct BufferIterator {
+    TracerObject* tracer;
+    int buffer_count;
+    struct EventBuffer** buffers;
+    struct EventNode** currs;
+    unsigned long total_entries;
+    unsigned long counter;
+    unsigned long prev_counter;
+};
+
+static void init_load_context(TracerObject* self, struct LoadContext* ctx)
+{
+    if (self->fix_pid > 0) {
+        ctx->pid = PyLong_FromLong(self->fix_pid);
+    } else {
+#if _WIN32
+        ctx->pid = PyLong_FromLong(GetCurrentProcessId());
+#else
+        ctx->pid = PyLong_FromLong(getpid());
+#endif
+    }
+    ctx->cat_fee = PyUnicode_FromString("FEE");
+    ctx->cat_instant = PyUnicode_FromString("INSTANT");
+    ctx->ph_I = PyUnicode_FromString("i");
+    ctx->ph_X = PyUnicode_FromString("X");
+    ctx->ph_C = PyUnicode_FromString("C");
+    ctx->ph_M = PyUnicode_FromString("M");
+    ctx->task_dict = PyDict_New();
+    func_name_table_init(&ctx->func_names);
+    ctx->integer_ts = 0;
+}
+
+static void free_load_context(struct LoadContext* ctx)
+{
+    Py_DECREF(ctx->pid);
+    Py_DECREF(ctx->cat_fee);
+    Py_DECREF(ctx->cat_instant);
+    Py_DECREF(ctx->ph_I);
+    Py_DECREF(ctx->ph_X);
+    Py_DECREF(ctx->ph_C);
+    Py_DECREF(ctx->ph_M);
+    Py_DECREF(ctx->task_dict);
+    func_name_table_clear(&ctx->func_names);
+}
+
+// The timestamps are int ns in the buffer, and float us in the report
+// unless the integer timestamps are asked for
+static inline PyObject* load_ts(struct LoadContext* ctx, int64_t ts)
+{
+    if (ctx->integer_ts) {
+        return PyLong_FromLongLong(ts);
+    }
+    return PyFloat_FromDouble(ts / 1000.0);
+}
+
+// The raw events come with the timestamps in us, like the report
+static void raw_ts_to_ns(PyObject* dict, const char* key)
+{
+    PyObject* value = PyDict_GetItemString(dict, key);
+    if (value && (PyFloat_Check(value) || PyLong_Check(value))) {
+        double us = PyFloat_AsDouble(value);
+        PyObject* ns = NULL;
+        if (us == -1.0 && PyErr_Occurred()) {
+            PyErr_Clear();
+            return;
+        }
+        ns = PyLong_FromLongLong((long long)(us * 1000 + (us >= 0 ? 0.5 : -0.5)));
+        PyDict_SetItemString(dict, key, ns);
+        Py_DECREF(ns);
+    }
+}
+
+static PyObject* build_metadata(struct LoadContext* ctx, PyObject* tid, const char* name, PyObject* value)
+{
+    PyObject* dict = PyDict_New();
+    PyObject* args = PyDict_New();
+    PyObject* name_string = PyUnicode_FromString(name);
+
+    PyDict_SetItemString(dict, "ph", ctx->ph_M);
+    PyDict_SetItemString(dict, "pid", ctx->pid);
+    PyDict_SetItemString(dict, "tid", tid);
+    PyDict_SetItemString(dict, "name", name_string);
+    Py_DECREF(name_string);
+    PyDict_SetItemString(args, "name", value);
+    PyDict_SetItemString(dict, "args", args);
+    Py_DECREF(args);
+
+    return dict;
+}
+
+// Append the process name and thread names to lst
+static void load_metadata(TracerObject* self, struct LoadContext* ctx, PyObject* lst)
+{
+    //    Process Name
+    {
+        PyObject* current_process_method = PyObject_GetAttrString(multiprocessing_module, "current_process");
+        if (!current_process_method) {
+            perror("Failed to access multiprocessing.current_process()");
+            exit(-1);
+        }
+        PyObject* current_process = PyObject_CallObject(current_process_method, NULL);
+        if (!current_process) {
+            perror("Failed to access multiprocessing.current_process()");
+            exit(-1);
+        }
+        PyObject* process_name = PyObject_GetAttrString(current_process, "name");
+
+        Py_DECREF(current_process_method);
+        Py_DECREF(current_process);
+        PyObject* dict = build_metadata(ctx, ctx->pid, "process_name", process_name);
+        Py_DECREF(process_name);
+        PyList_Append(lst, dict);
+        Py_DECREF(dict);
+    }
+
+    //    Thread Name
+    struct MetadataNode* metadata_node = self->metadata_head;
+    while (metadata_node) {
+        PyObject* tid = PyLong_FromLong(metadata_node->tid);
+        PyObject* dict = build_metadata(ctx, tid, "thread_name", metadata_node->name);
+        Py_DECREF(tid);
+        PyList_Append(lst, dict);
+        Py_DECREF(dict);
+        metadata_node = metadata_node->next;
+    }
+}
+
+// Append the names of the asyncio tasks we met in the buffer to lst
+static void load_task_metadata(struct LoadContext* ctx, PyObject* lst)
+{
+    Py_ssize_t pos = 0;
+    PyObject* key = NULL;
+    PyObject* value = NULL;
+    while (PyDict_Next(ctx->task_dict, &pos, &key, &value)) {
+        PyObject* dict = build_metadata(ctx, key, "thread_name", value);
+        PyList_Append(lst, dict);
+        Py_DECREF(dict);
+    }
+}
+
+// Append a counter of the dropped calls for every function that is over
+// the call budget to lst, and start counting again
+static void load_dropped_calls(TracerObject* self, struct LoadContext* ctx, PyObject* lst)
+{
+    struct FuncNameTable* table = &self->call_counts;
+
+    for (Py_ssize_t i = 0; i < table->capacity; i++) {
+        struct FuncNameEntry* entry = table->entries + i;
+        if (entry->name && entry->dropped > 0) {
+            PyObject* dict = PyDict_New();
+            PyObject* args = PyDict_New();
+            PyObject* name = PyUnicode_FromFormat("dropped calls of %U", entry->name);
+            PyObject* ts = load_ts(ctx, entry->last_dropped_ts);
+            PyObject* calls = PyLong_FromUnsignedLongLong(entry->dropped);
+            // The args are not converted with ts, so the unit is in the
+            // name and it's always us
+            PyObject* dur = PyFloat_FromDouble(entry->dropped_dur / 1000.0);
+            PyDict_SetItemString(args, "calls", calls);
+            PyDict_SetItemString(args, "dur_us", dur);
+            PyDict_SetItemString(dict, "ph", ctx->ph_C);
+            PyDict_SetItemString(dict, "pid", ctx->pid);
+            // The calls could be from any thread, the counter is on the
+            // track of the process
+            PyDict_SetItemString(dict, "tid", ctx->pid);
+            PyDict_SetItemString(dict, "ts", ts);
+            PyDict_SetItemString(dict, "name", name);
+            PyDict_SetItemString(dict, "args", args);
+            PyList_Append(lst, dict);
+            Py_DECREF(calls);
+            Py_DECREF(dur);
+            Py_DECREF(ts);
+            Py_DECREF(name);
+            Py_DECREF(args);
+            Py_DECREF(dict);
+        }
+    }
+
+    func_name_table_clear(table);
+}
+
+// Get the tid to report for the node. If we are logging async, the
+// events in a task are reported with a made up tid for the task
+static long get_node_tid(TracerObject* self, struct LoadContext* ctx, struct EventNode* node)
+{
+    PyObject* asyncio_task = NULL;
+
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC) && node->ntype == FEE_NODE && node->data.fee.payload) {
+        asyncio_task = get_fee_payload(node->data.fee.payload)->asyncio_task;
+    }
+    if (asyncio_task == NULL) {
+        return self->tids[node->tid_idx];
+    }
+
+    long task_tid = ((long)asyncio_task) & 0xffffff;
+    PyObject* task_id = PyLong_FromLong(task_tid);
+    if (!PyDict_Contains(ctx->task_dict, task_id)) {
+        PyObject* task_name = NULL;
+        if (PyObject_HasAttrString(asyncio_task, "get_name")) {
+            PyObject* task_name_method = PyObject_GetAttrString(asyncio_task, "get_name");
+            task_name = PyObject_CallObject(task_name_method, NULL);
+            Py_DECREF(task_name_method);
+        } else {
+            task_name = PyUnicode_FromString("Task");
+        }
+
+        PyDict_SetItem(ctx->task_dict, task_id, task_name);
+        Py_DECREF(task_name);
+    }
+    Py_DECREF(task_id);
+
+    return task_tid;
+}
+
+static inline int get_fee_caller_lineno(struct EventNode* node)
+{
+    return node->data.fee.payload ? get_fee_payload(node->data.fee.payload)->caller_lineno : -1;
+}
+
+// Return a new reference of the args of a FEE node, or NULL if there's none
+static PyObject* get_fee_args(struct EventNode* node)
+{
+    PyObject* arg_dict = NULL;
+    struct FEEPayload* payload = NULL;
+    if (!node->data.fee.payload) {
+        return NULL;
+    }
+    payload = get_fee_payload(node->data.fee.payload);
+    if (payload->args) {
+        arg_dict = payload->args;
+        Py_INCREF(arg_dict);
+    }
+    if (payload->retval) {
+        if (!arg_dict) {
+            arg_dict = PyDict_New();
+        }
+        PyDict_SetItemString(arg_dict, "return_value", payload->retval);
+    }
+    return arg_dict;
+}
+
+// Convert the node to a Chrome Trace Event Format dict, new reference
+static PyObject* load_event_node(TracerObject* self, struct LoadContext* ctx, struct EventNode* node)
+{
+    PyObject* dict = PyDict_New();
+    PyObject* name = NULL;
+    PyObject* tid = PyLong_FromLong(get_node_tid(self, ctx, node));
+    PyObject* ts = load_ts(ctx, node->ts);
+
+    PyDict_SetItemString(dict, "pid", ctx->pid);
+    PyDict_SetItemString(dict, "tid", tid);
+    Py_DECREF(tid);
+    PyDict_SetItemString(dict, "ts", ts);
+    Py_DECREF(ts);
+
+    switch (node->ntype) {
+    case FEE_NODE:
+        name = get_name_from_fee_node(node, &ctx->func_names);
+
+        PyObject* dur = load_ts(ctx, node->data.fee.dur);
+        PyDict_SetItemString(dict, "dur", dur);
+        Py_DECREF(dur);
+        PyDict_SetItemString(dict, "name", name);
+        Py_DECREF(name);
+
+        if (get_fee_caller_lineno(node) >= 0) {
+            PyObject* caller_lineno = PyLong_FromLong(get_fee_caller_lineno(node));
+            PyDict_SetItemString(dict, "caller_lineno", caller_lineno);
+            Py_DECREF(caller_lineno);
+        }
+
+        PyObject* arg_dict = get_fee_args(node);
+        if (arg_dict) {
+            PyDict_SetItemString(dict, "args", arg_dict);
+            Py_DECREF(arg_dict);
+        }
+
+        PyDict_SetItemString(dict, "ph", ctx->ph_X);
+        PyDict_SetItemString(dict, "cat", ctx->cat_fee);
+        break;
+    case INSTANT_NODE:
+        PyDict_SetItemString(dict, "ph", ctx->ph_I);
+        PyDict_SetItemString(dict, "cat", ctx->cat_instant);
+        PyDict_SetItemString(dict, "name", node->data.instant.name);
+        PyDict_SetItemString(dict, "s", node->data.instant.scope);
+        break;
+    case COUNTER_NODE:
+        PyDict_SetItemString(dict, "ph", ctx->ph_C);
+        PyDict_SetItemString(dict, "name", node->data.counter.name);
+        PyDict_SetItemString(dict, "args", node->data.counter.args);
+        break;
+    case OBJECT_NODE:
+        PyDict_SetItemString(dict, "ph", node->data.object.ph);
+        PyDict_SetItemString(dict, "id", node->data.object.id);
+        PyDict_SetItemString(dict, "name", node->data.object.name);
+        if (!(node->data.object.args == Py_None)) {
+            PyDict_SetItemString(dict, "args", node->data.object.args);
+        }
+        break;
+    case RAW_NODE:
+        // We still need to tid from node and we need the pid
+        tid = PyLong_FromLong(self->tids[node->tid_idx]);
+
+        Py_DECREF(dict);
+        dict = node->data.raw;
+
+        PyDict_SetItemString(dict, "pid", ctx->pid);
+        PyDict_SetItemString(dict, "tid", tid);
+        Py_DECREF(tid);
+        if (ctx->integer_ts) {
+            // The dict belongs to the user and could be logged again,
+            // convert a copy of it
+            dict = PyDict_Copy(dict);
+            raw_ts_to_ns(dict, "ts");
+            raw_ts_to_ns(dict, "dur");
+        } else {
+            Py_INCREF(dict);
+        }
+        break;
+    default:
+        printf("Unknown Node Type!\n");
+        exit(1);
+    }
+
+    return dict;
+}
+
+// Iterate through the shared buffer and all the per-thread buffers.
+// A buffer is in the order the events are recorded, which is not the order
+// of ts, a function is recorded when it returns but with the ts of its
+// start. Picking the earliest head every time only interleaves the
+// buffers, the events are not sorted by ts
+static void buffer_iter_init(TracerObject* self, struct BufferIterator* it)
+{
+    it->tracer = self;
+    it->buffer_count = 1;
+    it->total_entries = 0;
+    it->counter = 0;
+    it->prev_counter = 0;
+    for (struct EventBuffer* buffer = self->thread_buffers; buffer; buffer = buffer->next) {
+        it->buffer_count += 1;
+    }
+    it->buffers = (struct EventBuffer**) PyMem_Calloc(it->buffer_count, sizeof(struct EventBuffer*));
+    it->currs = (struct EventNode**) PyMem_Calloc(it->buffer_count, sizeof(struct EventNode*));
+    if (!it->buffers || !it->currs) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    it->buffers[0] = &self->buffer;
+    {
+        int idx = 1;
+        for (struct EventBuffer* buffer = self->thread_buffers; buffer; buffer = buffer->next) {
+            it->buffers[idx++] = buffer;
+        }
+    }
+    for (int i = 0; i < it->buffer_count; i++) {
+        it->currs[i] = it->buffers[i]->nodes + it->buffers[i]->head_idx;
+        it->total_entries += event_buffer_count(it->buffers[i]);
+    }
+}
+
+static struct EventNode* buffer_iter_next(struct BufferIterator* it)
+{
+    struct EventNode* node = NULL;
+    int node_idx = -1;
+    for (int i = 0; i < it->buffer_count; i++) {
+        if (it->currs[i] != it->buffers[i]->nodes + it->buffers[i]->tail_idx) {
+            if (!node || it->currs[i]->ts < node->ts) {
+                node = it->currs[i];
+                node_idx = i;
+            }
+        }
+    }
+    if (!node) {
+        return NULL;
+    }
+
+    it->currs[node_idx] = it->currs[node_idx] + 1;
+    if (it->currs[node_idx] == it->buffers[node_idx]->nodes + it->buffers[node_idx]->size) {
+        it->currs[node_idx] = it->buffers[node_idx]->nodes;
+    }
+
+    it->counter += 1;
+    if (it->counter - it->prev_counter > 10000 && (it->counter - it->prev_counter) / ((1 + it->total_entries)/100) > 0) {
+        verbose_printf(it->tracer, 1, "Loading data, %lu / %lu\r", it->counter, it->total_entries);
+        it->prev_counter = it->counter;
+    }
+
+    return node;
+}
+
+// All the nodes are consumed, the buffers are empty after this
+static void buffer_iter_finish(struct BufferIterator* it)
+{
+    for (int i = 0; i < it->buffer_count; i++) {
+        it->buffers[i]->tail_idx = it->buffers[i]->head_idx;
+        sync_buffer_header(it->buffers[i]);
+    }
+    PyMem_FREE(it->buffers);
+    PyMem_FREE(it->currs);
+    it->buffers = NULL;
+    it->currs = NULL;
+}
+
+// The raw events could be functions too, like the ones from log_sparse.
+// Their names are added with None as the location, which is unknown here
+static void add_raw_function(PyObject* functions, PyObject* dict)
+{
+    PyObject* ph = PyDict_GetItemString(dict, "ph");
+    PyObject* name = PyDict_GetItemString(dict, "name");
+
+    if (ph && name && PyUnicode_Check(ph) && PyUnicode_CompareWithASCIIString(ph, "X") == 0 &&
+            !PyDict_Contains(functions, name)) {
+        PyDict_SetItem(functions, name, Py_None);
+    }
+}
+
+// The location of every python function in the loaded events, from the
+// function name table. It's only as big as the number of functions, so
+// the report does not need to parse the names of all the events
+static void load_function_locations(struct LoadContext* ctx, PyObject* functions)
+{
+    struct FuncNameTable* table = &ctx->func_names;
+
+    for (Py_ssize_t i = 0; i < table->capacity; i++) {
+        struct FuncNameEntry* entry = table->entries + i;
+        if (!entry->name || !entry->ref || !PyCode_Check(entry->ref)) {
+            continue;
+        }
+        PyCodeObject* code = (PyCodeObject*) entry->ref;
+        PyObject* location = Py_BuildValue("(Oi)", code->co_filename, code->co_firstlineno);
+        PyDict_SetItem(functions, entry->name, location);
+        Py_DECREF(location);
+    }
+}
+
+static PyObject*
+snaptrace_load(TracerObject* self, PyObject* args)
+{
+    PyObject* lst = PyList_New(0);
+    PyObject* functions = NULL;
+    struct LoadContext ctx;
+    struct BufferIterator it;
+    struct EventNode* node = NULL;
+    int integer_ts = 0;
+    int with_functions = 0;
+
+    if (!PyArg_ParseTuple(args, "|pp", &integer_ts, &with_functions)) {
+        Py_DECREF(lst);
+        return NULL;
+    }
+
+    init_load_context(self, &ctx);
+    ctx.integer_ts = integer_ts;
+    if (with_functions) {
+        functions = PyDict_New();
+    }
+
+    // == Load the metadata first ==
+    load_metadata(self, &ctx, lst);
+
+    buffer_iter_init(self, &it);
+    while ((node = buffer_iter_next(&it))) {
+        PyObject* dict = load_event_node(self, &ctx, node);
+        if (functions && node->ntype == RAW_NODE) {
+            add_raw_function(functions, dict);
+        }
+        clear_node(node);
+        PyList_Append(lst, dict);
+        Py_DECREF(dict);
+    }
+    buffer_iter_finish(&it);
+
+    // Task Name if using LOG_ASYNC
+    load_task_metadata(&ctx, lst);
+    load_dropped_calls(self, &ctx, lst);
+
+    verbose_printf(self, 1, "Loading finish                                        \n");
+
+    if (functions) {
+        load_function_locations(&ctx, functions);
+        free_load_context(&ctx);
+        PyObject* ret = PyTuple_Pack(2, lst, functions);
+        Py_DECREF(lst);
+        Py_DECREF(functions);
+        return ret;
+    }
+
+    free_load_context(&ctx);
+    return lst;
+}
+
+// The columns of loadcolumnar(), one row per event. They are bytearrays
+// so they can be read as typed arrays without a copy
+struct Columns {
+    PyObject* ts;
+    PyObject* dur;
+    PyObject* tid;
+    PyObject* pid;
+    PyObject* name_id;
+    PyObject* ph;
+    PyObject* caller_lineno;
+    // The function names, and the name -> id dict
+    PyObject* names;
+    PyObject* name_ids;
+};
+
+static PyObject* new_column(Py_ssize_t rows, size_t itemsize)
+{
+    return PyByteArray_FromStringAndSize(NULL, (Py_ssize_t)(rows * itemsize));
+}
+
+#define COLUMN(columns, field, type) ((type*)PyByteArray_AS_STRING((columns)->field))
+
+static uint32_t get_column_name_id(struct Columns* columns, PyObject* name)
+{
+    PyObject* id = PyDict_GetItem(columns->name_ids, name);
+    if (id) {
+        return (uint32_t)PyLong_AsUnsignedLong(id);
+    }
+    uint32_t new_id = (uint32_t)PyList_GET_SIZE(columns->names);
+    id = PyLong_FromUnsignedLong(new_id);
+    PyDict_SetItem(columns->name_ids, name, id);
+    Py_DECREF(id);
+    PyList_Append(columns->names, name);
+    return new_id;
+}
+
+// Pop key from the dict of an event as an int, the raw events could have
+// a float there
+static int64_t pop_event_int(PyObject* dict, const char* key)
+{
+    int64_t val = 0;
+    PyObject* obj = PyDict_GetItemString(dict, key);
+    if (!obj) {
+        return 0;
+    }
+    if (PyFloat_Check(obj)) {
+        val = (int64_t)PyFloat_AS_DOUBLE(obj);
+    } else {
+        val = PyLong_AsLongLong(obj);
+        if (val == -1 && PyErr_Occurred()) {
+            PyErr_Clear();
+            val = 0;
+        }
+    }
+    PyDict_DelItemString(dict, key);
+    return val;
+}
+
+// Fill the row of an event that is not a function entry, from its dict.
+// Return the keys that are not in the columns, or NULL if there's none
+static PyObject* load_column_dict(struct Columns* columns, Py_ssize_t row, PyObject* dict)
+{
+    PyObject* name = PyDict_GetItemString(dict, "name");
+    PyObject* ph = PyDict_GetItemString(dict, "ph");
+
+    if (name && PyUnicode_Check(name)) {
+        Py_INCREF(name);
+        PyDict_DelItemString(dict, "name");
+    } else {
+        name = PyUnicode_FromString("");
+    }
+    COLUMN(columns, name_id, uint32_t)[row] = get_column_name_id(columns, name);
+    Py_DECREF(name);
+
+    COLUMN(columns, ph, uint8_t)[row] = 0;
+    if (ph && PyUnicode_Check(ph)) {
+        if (PyUnicode_GET_LENGTH(ph) > 0) {
+            COLUMN(columns, ph, uint8_t)[row] = (uint8_t)PyUnicode_READ_CHAR(ph, 0);
+        }
+        PyDict_DelItemString(dict, "ph");
+    }
+
+    COLUMN(columns, ts, int64_t)[row] = pop_event_int(dict, "ts");
+    COLUMN(columns, dur, int64_t)[row] = pop_event_int(dict, "dur");
+    COLUMN(columns, tid, uint64_t)[row] = (uint64_t)pop_event_int(dict, "tid");
+    COLUMN(columns, pid, int64_t)[row] = pop_event_int(dict, "pid");
+    COLUMN(columns, caller_lineno, int32_t)[row] = -1;
+
+    if (PyDict_Size(dict) == 0) {
+        return NULL;
+    }
+    Py_INCREF(dict);
+    return dict;
+}
+
+static PyObject*
+snaptrace_loadcolumnar(TracerObject* self, PyObject* Py_UNUSED(args))
+{
+    struct LoadContext ctx;
+    struct BufferIterator it;
+    struct Columns columns;
+    struct EventNode* node = NULL;
+    PyObject* events = PyList_New(0);
+    PyObject* extras = PyDict_New();
+    PyObject* ret = NULL;
+    Py_ssize_t rows = 0;
+    int64_t pid = 0;
+
+    init_load_context(self, &ctx);
+    // Everything is in int ns in the columns
+    ctx.integer_ts = 1;
+    pid = PyLong_AsLongLong(ctx.pid);
+
+    load_metadata(self, &ctx, events);
+
+    buffer_iter_init(self, &it);
+    columns.ts = new_column(it.total_entries, sizeof(int64_t));
+    columns.dur = new_column(it.total_entries, sizeof(int64_t));
+    columns.tid = new_column(it.total_entries, sizeof(uint64_t));
+    columns.pid = new_column(it.total_entries, sizeof(int64_t));
+    columns.name_id = new_column(it.total_entries, sizeof(uint32_t));
+    columns.ph = new_column(it.total_entries, sizeof(uint8_t));
+    columns.caller_lineno = new_column(it.total_entries, sizeof(int32_t));
+    columns.names = PyList_New(0);
+    columns.name_ids = PyDict_New();
+
+    while ((node = buffer_iter_next(&it))) {
+        PyObject* extra = NULL;
+        if (node->ntype == FEE_NODE) {
+            struct FuncNameEntry* entry = get_func_name_entry(node, &ctx.func_names);
+            // The id is 1 based in the entry, 0 means there's none yet
+            if (entry->id == 0) {
+                entry->id = get_column_name_id(&columns, entry->name) + 1;
+            }
+            COLUMN(&columns, ts, int64_t)[rows] = node->ts;
+            COLUMN(&columns, dur, int64_t)[rows] = node->data.fee.dur;
+            COLUMN(&columns, tid, uint64_t)[rows] = (uint64_t)get_node_tid(self, &ctx, node);
+            COLUMN(&columns, pid, int64_t)[rows] = pid;
+            COLUMN(&columns, name_id, uint32_t)[rows] = entry->id - 1;
+            COLUMN(&columns, ph, uint8_t)[rows] = 'X';
+            COLUMN(&columns, caller_lineno, int32_t)[rows] = get_fee_caller_lineno(node);
+            PyObject* arg_dict = get_fee_args(node);
+            if (arg_dict) {
+                extra = PyDict_New();
+                PyDict_SetItemString(extra, "args", arg_dict);
+                Py_DECREF(arg_dict);
+            }
+        } else {
+            PyObject* dict = load_event_node(self, &ctx, node);
+            extra = load_column_dict(&columns, rows, dict);
+            Py_DECREF(dict);
+        }
+        if (extra) {
+            PyObject* row = PyLong_FromSsize_t(rows);
+            PyDict_SetItem(extras, row, extra);
+            Py_DECREF(row);
+            Py_DECREF(extra);
+        }
+        clear_node(node);
+        rows++;
+    }
+    buffer_iter_finish(&it);
+
+    load_task_metadata(&ctx, events);
+    load_dropped_calls(self, &ctx, events);
+
+    verbose_printf(self, 1, "Loading finish                                        \n");
+
+    PyByteArray_Resize(columns.ts, rows * sizeof(int64_t));
+    PyByteArray_Resize(columns.dur, rows * sizeof(int64_t));
+    PyByteArray_Resize(columns.tid, rows * sizeof(uint64_t));
+    PyByteArray_Resize(columns.pid, rows * sizeof(int64_t));
+    PyByteArray_Resize(columns.name_id, rows * sizeof(uint32_t));
+    PyByteArray_Resize(columns.ph, rows * sizeof(uint8_t));
+    PyByteArray_Resize(columns.caller_lineno, rows * sizeof(int32_t));
+
+    ret = Py_BuildValue("{sNsNsNsNsNsNsNsNsNsN}",
+                        "ts", columns.ts,
+                        "dur", columns.dur,
+                        "tid", columns.tid,
+                        "pid", columns.pid,
+                        "name_id", columns.name_id,
+                        "ph", columns.ph,
+                        "caller_lineno", columns.caller_lineno,
+                        "names", columns.names,
+                        "extras", extras,
+                        "events", events);
+    Py_DECREF(columns.name_ids);
+    free_load_context(&ctx);
+    return ret;
+}
+
+// Binary trace file, all numbers are in native byte order
+//   header: "VTB\0", u32 0x01020304(byte order mark), u32 version, i64 pid
+//   records, each starts with a u8 type
+//     'S': string table entry, u32 id, u32 length, utf-8 bytes. A later
+//          entry with the same id replaces the earlier one
+//     'X': FEE event, i64 ts(ns), i64 dur(ns), u64 tid, u32 name id,
+//          i32 caller_lineno(-1 if unavailable), u32 length, json args
+//     'J': any other event, u32 length, json of the event
+#define SNAPTRACE_DUMP_VERSION 2
+#define SNAPTRACE_DUMP_CHUNK_SIZE (1 << 20)
+
+// A growable byte buffer that the records are encoded to. It's allocated
+// with malloc() because the spill writer frees it without the GIL
+struct DumpChunk {
+    char* data;
+    size_t size;
+    size_t capacity;
+    struct DumpChunk* next;
+};
+
+// The state to encode events to the binary trace format
+struct DumpEncoder {
+    TracerObject* tracer;
+    struct LoadContext ctx;
+    // The id of a function name in the string table is saved in its entry
+    // of ctx.func_names
+    uint32_t last_name_id;
+};
+
+static struct DumpChunk* new_dump_chunk(size_t capacity)
+{
+    struct DumpChunk* chunk = (struct DumpChunk*) malloc(sizeof(struct DumpChunk));
+    if (!chunk) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    chunk->data = (char*) malloc(capacity);
+    if (!chunk->data) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    chunk->size = 0;
+    chunk->capacity = capacity;
+    chunk->next = NULL;
+    return chunk;
+}
+
+static void free_dump_chunk(struct DumpChunk* chunk)
+{
+    free(chunk->data);
+    free(chunk);
+}
+
+static void chunk_write(struct DumpChunk* chunk, const void* data, size_t size)
+{
+    if (chunk->size + size > chunk->capacity) {
+        size_t capacity = chunk->capacity * 2;
+        while (capacity < chunk->size + size) {
+            capacity *= 2;
+        }
+        chunk->data = (char*) realloc(chunk->data, capacity);
+        if (!chunk->data) {
+            printf("Out of memory!\n");
+            exit(1);
+        }
+        chunk->capacity = capacity;
+    }
+    memcpy(chunk->data + chunk->size, data, size);
+    chunk->size += size;
+}
+
+static inline void chunk_write_u8(struct DumpChunk* chunk, uint8_t val) { chunk_write(chunk, &val, sizeof(val)); }
+static inline void chunk_write_u32(struct DumpChunk* chunk, uint32_t val) { chunk_write(chunk, &val, sizeof(val)); }
+static inline void chunk_write_i32(struct DumpChunk* chunk, int32_t val) { chunk_write(chunk, &val, sizeof(val)); }
+static inline void chunk_write_u64(struct DumpChunk* chunk, uint64_t val) { chunk_write(chunk, &val, sizeof(val)); }
+static inline void chunk_write_i64(struct DumpChunk* chunk, int64_t val) { chunk_write(chunk, &val, sizeof(val)); }
+
+// Write u32 length + json of obj. Write length 0 if obj is NULL. If obj
+// can't be converted to json, length 0 is written so the record is still
+// valid, and -1 is returned with the exception set
+static int chunk_write_json(struct DumpChunk* chunk, PyObject* obj)
+{
+    PyObject* json_str = NULL;
+    const char* data = NULL;
+    Py_ssize_t length = 0;
+    int ret = 0;
+
+    if (obj) {
+        json_str = PyObject_CallFunctionObjArgs(json_dumps, obj, NULL);
+        if (json_str) {
+            data = PyUnicode_AsUTF8AndSize(json_str, &length);
+        }
+        if (!data) {
+            length = 0;
+            ret = -1;
+        }
+    }
+    chunk_write_u32(chunk, (uint32_t)length);
+    if (length > 0) {
+        chunk_write(chunk, data, length);
+    }
+    Py_XDECREF(json_str);
+    return ret;
+}
+
+static int chunk_write_json_list(struct DumpChunk* chunk, PyObject* lst)
+{
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(lst); i++) {
+        chunk_write_u8(chunk, 'J');
+        if (chunk_write_json(chunk, PyList_GET_ITEM(lst, i)) < 0) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+static void init_dump_encoder(TracerObject* self, struct DumpEncoder* enc)
+{
+    enc->tracer = self;
+    init_load_context(self, &enc->ctx);
+    enc->last_name_id = 0;
+}
+
+static void free_dump_encoder(struct DumpEncoder* enc)
+{
+    free_load_context(&enc->ctx);
+}
+
+static void encode_header(struct DumpEncoder* enc, struct DumpChunk* chunk)
+{
+    chunk_write(chunk, "VTB\0", 4);
+    chunk_write_u32(chunk, 0x01020304);
+    chunk_write_u32(chunk, SNAPTRACE_DUMP_VERSION);
+    chunk_write_i64(chunk, PyLong_AsLongLong(enc->ctx.pid));
+}
+
+static int encode_event_node(struct DumpEncoder* enc, struct DumpChunk* chunk, struct EventNode* node)
+{
+    int error = 0;
+
+    if (node->ntype == FEE_NODE) {
+        struct FuncNameEntry* entry = get_func_name_entry(node, &enc->ctx.func_names);
+        uint32_t name_id = entry->id;
+        if (name_id == 0) {
+            Py_ssize_t length = 0;
+            const char* data = PyUnicode_AsUTF8AndSize(entry->name, &length);
+            name_id = ++enc->last_name_id;
+            entry->id = name_id;
+            chunk_write_u8(chunk, 'S');
+            chunk_write_u32(chunk, name_id);
+            chunk_write_u32(chunk, (uint32_t)length);
+            chunk_write(chunk, data, length);
+        }
+
+        chunk_write_u8(chunk, 'X');
+        chunk_write_i64(chunk, node->ts);
+        chunk_write_i64(chunk, node->data.fee.dur);
+        chunk_write_u64(chunk, (uint64_t)get_node_tid(enc->tracer, &enc->ctx, node));
+        chunk_write_u32(chunk, name_id);
+        chunk_write_i32(chunk, get_fee_caller_lineno(node));
+        PyObject* arg_dict = get_fee_args(node);
+        error = chunk_write_json(chunk, arg_dict);
+        Py_XDECREF(arg_dict);
+    } else {
+        PyObject* dict = load_event_node(enc->tracer, &enc->ctx, node);
+        chunk_write_u8(chunk, 'J');
+        error = chunk_write_json(chunk, dict);
+        Py_DECREF(dict);
+    }
+
+    return error;
+}
+
+static int fwrite_dump_chunk(FILE* fptr, struct DumpChunk* chunk)
+{
+    size_t size = chunk->size;
+    chunk->size = 0;
+    if (fwrite(chunk->data, 1, size, fptr) != size) {
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject*
+snaptrace_dump(TracerObject* self, PyObject* args)
+{
+    const char* filename = NULL;
+    int append = 0;
+    FILE* fptr = NULL;
+    struct DumpEncoder enc;
+    struct DumpChunk* chunk = NULL;
+    struct BufferIterator it;
+    struct EventNode* node = NULL;
+    PyObject* metadata = NULL;
+    int error = 0;
+    int io_error = 0;
+
+    if (!PyArg_ParseTuple(args, "s|p", &filename, &append)) {
+        return NULL;
+    }
+
+    fptr = fopen(filename, append ? "ab" : "wb");
+    if (!fptr) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+        return NULL;
+    }
+
+    init_dump_encoder(self, &enc);
+    chunk = new_dump_chunk(SNAPTRACE_DUMP_CHUNK_SIZE);
+
+    // When appending to a spill file, the header is already there
+    if (!append) {
+        encode_header(&enc, chunk);
+    }
+
+    metadata = PyList_New(0);
+    load_metadata(self, &enc.ctx, metadata);
+    error = chunk_write_json_list(chunk, metadata);
+    Py_DECREF(metadata);
+
+    buffer_iter_init(self, &it);
+    while (!error && (node = buffer_iter_next(&it))) {
+        error = encode_event_node(&enc, chunk, node);
+        clear_node(node);
+        if (chunk->size >= SNAPTRACE_DUMP_CHUNK_SIZE && !io_error) {
+            io_error = fwrite_dump_chunk(fptr, chunk);
+        }
+    }
+    if (error) {
+        // Drop whatever is left so the buffers stay consistent
+        while ((node = buffer_iter_next(&it))) {
+            clear_node(node);
+        }
+    }
+    buffer_iter_finish(&it);
+
+    if (!error) {
+        metadata = PyList_New(0);
+        load_task_metadata(&enc.ctx, metadata);
+        load_dropped_calls(self, &enc.ctx, metadata);
+        error = chunk_write_json_list(chunk, metadata);
+        Py_DECREF(metadata);
+    }
+
+    if (!io_error) {
+        io_error = fwrite_dump_chunk(fptr, chunk);
+    }
+
+    verbose_printf(self, 1, "Dumping finish                                        \n");
+    free_dump_chunk(chunk);
+    free_dump_encoder(&enc);
+
+    if ((io_error || ferror(fptr)) && !error) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+        error = 1;
+    }
+    fclose(fptr);
+
+    if (error) {
+        return NULL;
+    }
+
+    Py_RETURN_NONE;
+}
+
+// =============================================================================
+// Spill the buffers to disk
+// =============================================================================
+
+// With a spill file, when a buffer is full we encode the oldest segment of
+// it to the binary trace format instead of overwriting the oldest event.
+// The encoded chunk is handed to a writer thread which only does file IO,
+// so it never needs the GIL. The file is a valid binary trace by itself,
+// Tracer.dump() could append the rest of the events to it
+#define SNAPTRACE_SPILL_MAX_PENDING 4
+
+struct SpillState {
+    char* filename;
+    // Unbuffered, so a forked child never flushes the parent's data
+    FILE* fptr;
+    long pid;
+    int busy;
+    int error;
+    struct DumpEncoder encoder;
+    // The segment is moved here before encoding
+    struct EventNode* segment;
+    long segment_size;
+#if !_WIN32
+    pthread_t writer;
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
+    struct DumpChunk* pending_head;
+    struct DumpChunk* pending_tail;
+    // Chunks in the queue or being written
+    int pending_count;
+    int stopping;
+#endif
+};
+
+static long get_current_pid(void)
+{
+#if _WIN32
+    return GetCurrentProcessId();
+#else
+    return getpid();
+#endif
+}
+
+#if !_WIN32
+static void* spill_writer_main(void* arg)
+{
+    struct SpillState* spill = arg;
+    struct DumpChunk* chunk = NULL;
+    int error = 0;
+
+    pthread_mutex_lock(&spill->lock);
+    while (1) {
+        while (!spill->pending_head && !spill->stopping) {
+            pthread_cond_wait(&spill->cond, &spill->lock);
+        }
+        if (!spill->pending_head) {
+            break;
+        }
+        chunk = spill->pending_head;
+        spill->pending_head = chunk->next;
+        if (!spill->pending_head) {
+            spill->pending_tail = NULL;
+        }
+        pthread_mutex_unlock(&spill->lock);
+
+        error = fwrite_dump_chunk(spill->fptr, chunk);
+        free_dump_chunk(chunk);
+
+        pthread_mutex_lock(&spill->lock);
+        if (error) {
+            spill->error = 1;
+        }
+        spill->pending_count -= 1;
+        pthread_cond_broadcast(&spill->cond);
+    }
+    pthread_mutex_unlock(&spill->lock);
+
+    return NULL;
+}
+#endif
+
+// Hand the chunk over to the writer, it owns the chunk after this
+static void spill_submit(struct SpillState* spill, struct DumpChunk* chunk)
+{
+#if _WIN32
+    // There's no writer thread on Windows, just write it here
+    if (fwrite_dump_chunk(spill->fptr, chunk) < 0) {
+        spill->error = 1;
+    }
+    free_dump_chunk(chunk);
+#else
+    pthread_mutex_lock(&spill->lock);
+    // Wait for the writer if it falls behind, so the memory usage is bounded
+    while (spill->pending_count >= SNAPTRACE_SPILL_MAX_PENDING) {
+        pthread_cond_wait(&spill->cond, &spill->lock);
+    }
+    if (spill->pending_tail) {
+        spill->pending_tail->next = chunk;
+    } else {
+        spill->pending_head = chunk;
+    }
+    spill->pending_tail = chunk;
+    spill->pending_count += 1;
+    pthread_cond_broadcast(&spill->cond);
+    pthread_mutex_unlock(&spill->lock);
+#endif
+}
+
+static struct SpillState* open_spill(TracerObject* self, const char* filename)
+{
+    struct SpillState* spill = NULL;
+    struct DumpChunk* chunk = NULL;
+    FILE* fptr = fopen(filename, "wb");
+
+    if (!fptr) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+        return NULL;
+    }
+    setvbuf(fptr, NULL, _IONBF, 0);
+
+    spill = (struct SpillState*) PyMem_Calloc(1, sizeof(struct SpillState));
+    if (!spill) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    spill->filename = PyMem_Calloc(strlen(filename) + 1, sizeof(char));
+    if (!spill->filename) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    strcpy(spill->filename, filename);
+    spill->fptr = fptr;
+    spill->pid = get_current_pid();
+    spill->busy = 0;
+    spill->error = 0;
+    init_dump_encoder(self, &spill->encoder);
+    // The buffer has an extra slot, so at most buffer_size - 1 events
+    spill->segment_size = (self->buffer_size - 1) / 4;
+    if (spill->segment_size < 1) {
+        spill->segment_size = 1;
+    }
+    spill->segment = (struct EventNode*) PyMem_Calloc(spill->segment_size, sizeof(struct EventNode));
+    if (!spill->segment) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+
+    chunk = new_dump_chunk(64);
+    encode_header(&spill->encoder, chunk);
+    if (fwrite_dump_chunk(fptr, chunk) < 0) {
+        spill->error = 1;
+    }
+    free_dump_chunk(chunk);
+
+#if !_WIN32
+    spill->pending_head = NULL;
+    spill->pending_tail = NULL;
+    spill->pending_count = 0;
+    spill->stopping = 0;
+    pthread_mutex_init(&spill->lock, NULL);
+    pthread_cond_init(&spill->cond, NULL);
+    if (pthread_create(&spill->writer, NULL, spill_writer_main, spill)) {
+        perror("Failed to create spill writer thread");
+        exit(-1);
+    }
+#endif
+
+    return spill;
+}
+
+// Write everything left to the spill file and close it. Return -1 with
+// an exception set if some of the data failed to be written
+static int close_spill(TracerObject* self)
+{
+    struct SpillState* spill = self->spill;
+    int error = 0;
+
+    if (!spill) {
+        return 0;
+    }
+    self->spill = NULL;
+
+    if (spill->pid == get_current_pid()) {
+        // Names of the asyncio tasks in the spilled events
+        struct DumpChunk* chunk = new_dump_chunk(256);
+        PyObject* metadata = PyList_New(0);
+        load_task_metadata(&spill->encoder.ctx, metadata);
+        if (chunk_write_json_list(chunk, metadata) < 0) {
+            PyErr_Clear();
+        }
+        Py_DECREF(metadata);
+        spill_submit(spill, chunk);
+#if !_WIN32
+        pthread_mutex_lock(&spill->lock);
+        spill->stopping = 1;
+        pthread_cond_broadcast(&spill->cond);
+        pthread_mutex_unlock(&spill->lock);
+        pthread_join(spill->writer, NULL);
+        pthread_mutex_destroy(&spill->lock);
+        pthread_cond_destroy(&spill->cond);
+#endif
+        error = spill->error;
+    }
+    // Otherwise we are in a forked child, the writer thread does not exist
+    // and the file belongs to the parent, just let it go
+
+    if (error) {
+        PyErr_Format(PyExc_OSError, "Failed to write spill file %s", spill->filename);
+    }
+    fclose(spill->fptr);
+    free_dump_encoder(&spill->encoder);
+    PyMem_FREE(spill->segment);
+    PyMem_FREE(spill->filename);
+    PyMem_FREE(spill);
+
+    return error ? -1 : 0;
+}
+
+// Spill the oldest segment of a full buffer. Return -1 if we can't spill,
+// then the caller should overwrite the oldest event as usual
+static int spill_event_buffer(TracerObject* self, struct EventBuffer* buffer)
+{
+    struct SpillState* spill = self->spill;
+    struct DumpChunk* chunk = NULL;
+    long count = spill->segment_size;
+    PyObject* err_type = NULL;
+    PyObject* err_value = NULL;
+    PyObject* err_traceback = NULL;
+
+    if (spill->busy || spill->pid != get_current_pid()) {
+        return -1;
+    }
+    if (count > buffer->size - 1) {
+        count = buffer->size - 1;
+    }
+    if (count <= 0) {
+        return -1;
+    }
+
+    spill->busy = 1;
+
+    // Move the segment out of the buffer first. Encoding could run python
+    // code, which might log events to this buffer again
+    for (long i = 0; i < count; i++) {
+        spill->segment[i] = buffer->nodes[buffer->head_idx];
+        buffer->head_idx = buffer->head_idx + 1;
+        if (buffer->head_idx >= buffer->size) {
+            buffer->head_idx = 0;
+        }
+    }
+
+    // We could be in the middle of an exception
+    PyErr_Fetch(&err_type, &err_value, &err_traceback);
+    chunk = new_dump_chunk(count * 64);
+    for (long i = 0; i < count; i++) {
+        if (encode_event_node(&spill->encoder, chunk, spill->segment + i) < 0) {
+            PyErr_WriteUnraisable(NULL);
+        }
+        clear_node(spill->segment + i);
+    }
+    spill_submit(spill, chunk);
+    PyErr_Restore(err_type, err_value, err_traceback);
+
+    spill->busy = 0;
+
+    return 0;
+}
+
+static PyObject*
+snaptrace_setspill(TracerObject* self, PyObject* args)
+{
+    const char* filename = NULL;
+
+    if (!PyArg_ParseTuple(args, "z", &filename)) {
+        return NULL;
+    }
+
+    if (!filename) {
+        if (close_spill(self) < 0) {
+            return NULL;
+        }
+    } else if (!self->spill || self->spill->pid != get_current_pid() || strcmp(self->spill->filename, filename) != 0) {
+        if (close_spill(self) < 0) {
+            return NULL;
+        }
+        self->spill = open_spill(self, filename);
+        if (!self->spill) {
+            return NULL;
+        }
+    }
+
+    Py_RETURN_NONE;
+}
+
+// =============================================================================
+// Map the buffer to a file
+// =============================================================================
+
+// With a buffer file, the shared buffer is a shared mapping of the file
+// instead of anonymous memory. The OS writes the pages back to the file
+// even if the process is killed, so the events before a segfault or an
+// OOM kill can be recovered from it. The nodes only have the pointers to
+// the code objects, so the name of a function is appended to the file the
+// first time we log it, keyed by the pointers, and so are the tids
+
+#define SNAPTRACE_BUFFER_FILE_VERSION 1
+
+// All the buffer files of the process, so we can deal with fork
+static struct BufferFile* buffer_files = NULL;
+
+// Copy the live nodes of the buffer to the same indices of nodes
+static void copy_live_nodes(struct EventBuffer* buffer, struct EventNode* nodes)
+{
+    if (buffer->tail_idx >= buffer->head_idx) {
+        memcpy(nodes + buffer->head_idx, buffer->nodes + buffer->head_idx,
+               (buffer->tail_idx - buffer->head_idx) * sizeof(struct EventNode));
+    } else {
+        memcpy(nodes + buffer->head_idx, buffer->nodes + buffer->head_idx,
+               (buffer->size - buffer->head_idx) * sizeof(struct EventNode));
+        memcpy(nodes, buffer->nodes, buffer->tail_idx * sizeof(struct EventNode));
+    }
+}
+
+static void unmap_buffer_file(struct BufferFile* bf)
+{
+#if _WIN32
+    UnmapViewOfFile(bf->header);
+    CloseHandle(bf->mapping);
+#else
+    munmap(bf->header, bf->map_size);
+#endif
+    bf->header = NULL;
+}
+
+static struct BufferFile* open_buffer_file(TracerObject* self, const char* filename)
+{
+    struct EventBuffer* buffer = &self->buffer;
+    struct BufferFile* bf = NULL;
+    struct BufferFileHeader* header = NULL;
+    struct EventNode* nodes = NULL;
+    size_t map_size = sizeof(struct BufferFileHeader) + buffer->size * sizeof(struct EventNode);
+    FILE* fptr = fopen(filename, "w+b");
+
+    if (!fptr) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+        return NULL;
+    }
+    // The records should reach the OS as soon as they are written
+    setvbuf(fptr, NULL, _IONBF, 0);
+
+    bf = (struct BufferFile*) PyMem_Calloc(1, sizeof(struct BufferFile));
+    if (!bf) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+
+    // The file is sparse, the blocks are only allocated when they are written
+#if _WIN32
+    if (_chsize_s(_fileno(fptr), map_size) == 0) {
+        bf->mapping = CreateFileMapping((HANDLE) _get_osfhandle(_fileno(fptr)), NULL, PAGE_READWRITE,
+                                        (DWORD) ((uint64_t) map_size >> 32), (DWORD) (map_size & 0xffffffff), NULL);
+        if (bf->mapping) {
+            header = MapViewOfFile(bf->mapping, FILE_MAP_ALL_ACCESS, 0, 0, map_size);
+            if (!header) {
+                CloseHandle(bf->mapping);
+            }
+        }
+    }
+    if (!header) {
+        PyErr_SetExcFromWindowsErrWithFilename(PyExc_OSError, 0, filename);
+        PyMem_FREE(bf);
+        fclose(fptr);
+        return NULL;
+    }
+#else
+    if (ftruncate(fileno(fptr), map_size) == 0) {
+        header = mmap(NULL, map_size, PROT_READ | PROT_WRITE, MAP_SHARED, fileno(fptr), 0);
+        if (header == MAP_FAILED) {
+            header = NULL;
+        }
+    }
+    if (!header) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+        PyMem_FREE(bf);
+        fclose(fptr);
+        return NULL;
+    }
+#endif
+    if (fseek(fptr, 0, SEEK_END) != 0) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+        bf->header = header;
+        bf->map_size = map_size;
+        unmap_buffer_file(bf);
+        PyMem_FREE(bf);
+        fclose(fptr);
+        return NULL;
+    }
+
+    memcpy(header->magic, "VTR\0", 4);
+    header->bom = 0x01020304;
+    header->version = SNAPTRACE_BUFFER_FILE_VERSION;
+    header->node_size = sizeof(struct EventNode);
+    header->pid = get_current_pid();
+    header->size = buffer->size;
+    header->pointer_size = sizeof(void*);
+
+    // Move the events we already have to the file
+    nodes = (struct EventNode*) (header + 1);
+    copy_live_nodes(buffer, nodes);
+    free_event_nodes(buffer->nodes, buffer->size);
+    buffer->nodes = nodes;
+    buffer->header = header;
+    sync_buffer_header(buffer);
+
+    bf->filename = PyMem_Calloc(strlen(filename) + 1, sizeof(char));
+    if (!bf->filename) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    strcpy(bf->filename, filename);
+    bf->fptr = fptr;
+    bf->header = header;
+    bf->map_size = map_size;
+    bf->buffer = buffer;
+    func_name_table_init(&bf->names);
+    bf->tid_count = 0;
+    bf->fork_copy = NULL;
+    bf->next = buffer_files;
+    buffer_files = bf;
+
+    return bf;
+}
+
+static void close_buffer_file(TracerObject* self)
+{
+    struct BufferFile* bf = self->buffer_file;
+    struct BufferFile** prev = &buffer_files;
+
+    if (!bf) {
+        return;
+    }
+    self->buffer_file = NULL;
+
+    while (*prev != bf) {
+        prev = &(*prev)->next;
+    }
+    *prev = bf->next;
+
+    if (bf->buffer) {
+        // Move the events back to the memory. The file keeps them too, so
+        // they are still there if we never get to save them
+        struct EventBuffer* buffer = bf->buffer;
+        struct EventNode* nodes = alloc_event_nodes(buffer->size);
+        copy_live_nodes(buffer, nodes);
+        buffer->nodes = nodes;
+        buffer->header = NULL;
+        unmap_buffer_file(bf);
+    }
+    // Otherwise we are in a forked child, the mapping is already gone and
+    // the file belongs to the parent
+
+    fclose(bf->fptr);
+    func_name_table_clear(&bf->names);
+    PyMem_FREE(bf->filename);
+    PyMem_FREE(bf);
+}
+
+// Make sure the file has the name and the tid of the FEE node. A failed
+// write only costs us the name in a recovered trace, so it's ignored
+static void note_buffer_file_node(TracerObject* self, struct EventNode* node)
+{
+    struct BufferFile* bf = self->buffer_file;
+    struct FuncNameEntry* entry = NULL;
+    struct DumpChunk* chunk = NULL;
+    const char* name = NULL;
+    Py_ssize_t length = 0;
+
+    if (node->tid_idx >= bf->tid_count) {
+        chunk = new_dump_chunk(64);
+        for (; bf->tid_count < self->tid_count; bf->tid_count++) {
+            chunk_write_u8(chunk, 'T');
+            chunk_write_u32(chunk, bf->tid_count);
+            chunk_write_u64(chunk, self->tids[bf->tid_count]);
+        }
+        fwrite_dump_chunk(bf->fptr, chunk);
+        free_dump_chunk(chunk);
+    }
+
+    entry = get_func_name_entry(node, &bf->names);
+    if (entry->id) {
+        return;
+    }
+    entry->id = 1;
+
+    name = PyUnicode_AsUTF8AndSize(entry->name, &length);
+    if (!name) {
+        PyErr_Clear();
+        return;
+    }
+    chunk = new_dump_chunk(32 + length);
+    chunk_write_u8(chunk, 'N');
+    chunk_write_u64(chunk, (uint64_t) (uintptr_t) entry->key);
+    chunk_write_u64(chunk, (uint64_t) (uintptr_t) entry->owner);
+    chunk_write_u32(chunk, (uint32_t) length);
+    chunk_write(chunk, name, length);
+    fwrite_dump_chunk(bf->fptr, chunk);
+    free_dump_chunk(chunk);
+}
+
+#if !_WIN32
+// A forked child shares the mapping with its parent, so it would write to
+// the buffer of the parent. Copy the live nodes out before forking and
+// give the copy to the child instead
+static void buffer_file_prepare_fork(void)
+{
+    for (struct BufferFile* bf = buffer_files; bf; bf = bf->next) {
+        if (bf->buffer) {
+            bf->fork_copy = alloc_event_nodes(bf->buffer->size);
+            copy_live_nodes(bf->buffer, bf->fork_copy);
+        }
+    }
+}
+
+static void buffer_file_parent_fork(void)
+{
+    for (struct BufferFile* bf = buffer_files; bf; bf = bf->next) {
+        if (bf->fork_copy) {
+            free_event_nodes(bf->fork_copy, bf->buffer->size);
+            bf->fork_copy = NULL;
+        }
+    }
+}
+
+static void buffer_file_child_fork(void)
+{
+    for (struct BufferFile* bf = buffer_files; bf; bf = bf->next) {
+        if (bf->fork_copy) {
+            unmap_buffer_file(bf);
+            bf->buffer->nodes = bf->fork_copy;
+            bf->buffer->header = NULL;
+            bf->buffer = NULL;
+            bf->fork_copy = NULL;
+        }
+    }
+}
+#endif
+
+static PyObject*
+snaptrace_setbufferfile(TracerObject* self, PyObject* args)
+{
+    const char* filename = NULL;
+
+    if (!PyArg_ParseTuple(args, "z", &filename)) {
+        return NULL;
+    }
+
+    if (self->buffer_file && (!filename || !self->buffer_file->buffer || strcmp(self->buffer_file->filename, filename) != 0)) {
+        close_buffer_file(self);
+    }
+
+    if (filename && !self->buffer_file) {
+        self->buffer_file = open_buffer_file(self, filename);
+        if (!self->buffer_file) {
+            return NULL;
+        }
+    }
+
     Py_RETURN_NONE;
 }
 
 // =============================================================================
-// Control interface with python
+// Sample the stacks
 // =============================================================================
 
-static PyObject*
-snaptrace_start(TracerObject* self, PyObject* args)
-{
-    if (curr_tracer) {
-        printf("Warning! Overwrite tracer! You should not have two VizTracer recording at the same time!\n");
-    } else {
-        curr_tracer = self;
-    }
+// Instead of tracing every function call, a sampling thread wakes up every
+// sample_interval and walks the frames of all the threads. A function that
+// stays on the stack of a thread through consecutive samples is taken as one
+// call, and it's logged as a normal FEE node once it's gone from the stack.
+// The filters that work on code objects cut the stack at the first ignored
+// function, just like the profile function ignores everything it calls
+
+struct SampledThread {
+    // threading.get_ident() of the thread
+    unsigned long ident;
+    // The tid in the report, the native id if we know it
+    unsigned long tid;
+    uint32_t tid_idx;
+    int seen;
+    int depth;
+    int capacity;
+    // From the outermost function to the innermost one, with references
+    PyCodeObject** codes;
+    int64_t* starts;
+    struct SampledThread* next;
+};
 
-    self->collecting = 1;
-    PyEval_SetProfile(snaptrace_tracefunc, (PyObject*) self);
+struct SamplerState {
+    // Borrowed, the tracer stops the sampler before it's freed
+    TracerObject* tracer;
+    long pid;
+    double interval;
+    // Only changed and checked with the GIL held
+    int running;
+#if _WIN32
+    HANDLE thread;
+#else
+    pthread_t thread;
+#endif
+    struct SampledThread* threads;
+    // Scratch space to walk the frames
+    PyCodeObject** stack;
+    int stack_capacity;
+};
 
-    Py_RETURN_NONE;
+static void sampler_sleep(double ns)
+{
+#if _WIN32
+    DWORD ms = (DWORD)(ns / 1e6);
+    Sleep(ms > 0 ? ms : 1);
+#else
+    struct timespec t;
+    t.tv_sec = (time_t)(ns / 1e9);
+    t.tv_nsec = (long)(ns - (double)t.tv_sec * 1e9);
+    nanosleep(&t, NULL);
+#endif
 }
 
-static PyObject*
-snaptrace_stop(TracerObject* self, PyObject* args)
+static void grow_code_array(PyCodeObject*** codes, int64_t** starts, int* capacity, int size)
 {
-    if (self) {
-        struct ThreadInfo* info = get_thread_info(self);
-        self->collecting = 0;
-
-        info->curr_stack_depth = 0;
-        info->ignore_stack_depth = 0;
-        info->paused = 0;
-        clear_stack(&info->stack_top);
+    if (size <= *capacity) {
+        return;
+    }
+    while (*capacity < size) {
+        *capacity = *capacity ? *capacity * 2 : 64;
+    }
+    *codes = PyMem_Realloc(*codes, *capacity * sizeof(PyCodeObject*));
+    if (starts) {
+        *starts = PyMem_Realloc(*starts, *capacity * sizeof(int64_t));
+    }
+    if (!*codes || (starts && !*starts)) {
+        printf("Out of memory!\n");
+        exit(1);
     }
-    curr_tracer = NULL;
-    PyEval_SetProfile(NULL, NULL);
-
-    Py_RETURN_NONE;
 }
 
-static PyObject*
-snaptrace_pause(PyObject* self, PyObject* args)
+// The innermost function of the thread is gone from the stack, log it
+static void pop_sampled_function(TracerObject* self, struct SampledThread* thread, int64_t now)
 {
-    if (curr_tracer->collecting) {
-        PyGILState_STATE state = PyGILState_Ensure();
-        struct ThreadInfo* info = get_thread_info((TracerObject*)self);
-
-        if (!info->paused) {
-            PyEval_SetProfile(NULL, NULL);
-            // When we enter this function, viztracer.pause and
-            // tracer.pause both have been called. We need to
-            // reduce the ignore_stack_depth to simulate the
-            // returns from these two functions
-            info->ignore_stack_depth -= 2;
-            info->paused = 1;
+    PyCodeObject* code = NULL;
+    int64_t dur = 0;
+
+    thread->depth -= 1;
+    code = thread->codes[thread->depth];
+    dur = now - thread->starts[thread->depth];
+
+    if (dur >= self->min_duration) {
+        struct EventNode* node = get_next_node(self, NULL);
+        node->ntype = FEE_NODE;
+        node->ts = thread->starts[thread->depth];
+        node->tid_idx = thread->tid_idx;
+        node->data.fee.type = PyTrace_RETURN;
+        node->data.fee.dur = dur;
+        node->data.fee.payload = 0;
+        // The node takes our reference
+        node->data.fee.code = code;
+        if (self->buffer_file && self->buffer_file->buffer) {
+            note_buffer_file_node(self, node);
         }
-        PyGILState_Release(state);
+    } else {
+        Py_DECREF(code);
     }
-
-    Py_RETURN_NONE;
 }
 
-static PyObject*
-snaptrace_resume(PyObject* self, PyObject* args)
+static struct SampledThread* get_sampled_thread(struct SamplerState* sampler, unsigned long ident)
 {
-    if (curr_tracer->collecting) {
-        PyGILState_STATE state = PyGILState_Ensure();
-        struct ThreadInfo* info = get_thread_info((TracerObject*)self);
+    struct SampledThread* thread = sampler->threads;
+    PyObject* active = NULL;
 
-        if (info->paused) {
-            PyEval_SetProfile(snaptrace_tracefunc, self);
-            // When we enter this function, viztracer.pause and
-            // tracer.pause both have been called but not recorded.
-            // It seems like C function tracer.pause's return will not
-            // be recorded.
-            // We need to increment the ignore_stack_depth to simulate the
-            // call of the function
-            info->ignore_stack_depth += 1;
-            info->paused = 0;
+    while (thread) {
+        if (thread->ident == ident) {
+            return thread;
         }
-        PyGILState_Release(state);
+        thread = thread->next;
     }
 
-    Py_RETURN_NONE;
+    thread = (struct SampledThread*) PyMem_Calloc(1, sizeof(struct SampledThread));
+    if (!thread) {
+        printf("Out of memory!\n");
+        exit(1);
+    }
+    thread->ident = ident;
+    thread->tid = ident;
+
+    // Use the native id and the name of the thread if it's a threading.Thread
+    active = PyObject_GetAttrString(threading_module, "_active");
+    if (active && PyDict_Check(active)) {
+        PyObject* key = PyLong_FromUnsignedLong(ident);
+        // Borrowed
+        PyObject* thread_object = PyDict_GetItem(active, key);
+        Py_DECREF(key);
+        if (thread_object) {
+            PyObject* native_id = PyObject_GetAttrString(thread_object, "native_id");
+            PyObject* name = PyObject_GetAttrString(thread_object, "name");
+            if (native_id && PyLong_Check(native_id)) {
+                thread->tid = PyLong_AsUnsignedLong(native_id);
+            }
+            Py_XDECREF(native_id);
+            if (name) {
+                add_thread_metadata(sampler->tracer, thread->tid, name);
+            }
+        }
+    }
+    Py_XDECREF(active);
+    PyErr_Clear();
+
+    thread->tid_idx = get_tid_index(sampler->tracer, thread->tid);
+    thread->next = sampler->threads;
+    sampler->threads = thread;
+
+    return thread;
 }
 
-static PyObject*
-snaptrace_load(TracerObject* self, PyObject* args)
+// Log all the functions left on the stack of the thread and free it
+static void free_sampled_thread(TracerObject* self, struct SampledThread* thread, int64_t now)
 {
-    PyObject* lst = PyList_New(0);
-    struct EventNode* curr = self->buffer + self->buffer_head_idx;
-    PyObject* pid = NULL;
-    PyObject* cat_fee = PyUnicode_FromString("FEE");
-    PyObject* cat_instant = PyUnicode_FromString("INSTANT");
-    PyObject* ph_B = PyUnicode_FromString("B");
-    PyObject* ph_E = PyUnicode_FromString("E");
-    PyObject* ph_I = PyUnicode_FromString("i");
-    PyObject* ph_X = PyUnicode_FromString("X");
-    PyObject* ph_C = PyUnicode_FromString("C");
-    PyObject* ph_M = PyUnicode_FromString("M");
-    unsigned long counter = 0;
-    unsigned long prev_counter = 0;
-    struct MetadataNode* metadata_node = NULL;
-    PyObject* task_dict = NULL;
-    PyObject* func_name_dict = PyDict_New();
+    while (thread->depth > 0) {
+        pop_sampled_function(self, thread, now);
+    }
+    PyMem_FREE(thread->codes);
+    PyMem_FREE(thread->starts);
+    PyMem_FREE(thread);
+}
 
-    if (self->fix_pid > 0) {
-        pid = PyLong_FromLong(self->fix_pid);
-    } else {
-#if _WIN32
-        pid = PyLong_FromLong(GetCurrentProcessId());
-#else
-        pid = PyLong_FromLong(getpid());
-#endif
+// Called by the sampling thread with the GIL held
+static void take_sample(struct SamplerState* sampler)
+{
+    TracerObject* self = sampler->tracer;
+    PyThreadState* curr = PyThreadState_Get();
+    PyThreadState* tstate = PyInterpreterState_ThreadHead(PyThreadState_GetInterpreter(curr));
+    struct SampledThread** prev = NULL;
+    int64_t now = get_ts();
+
+    for (struct SampledThread* thread = sampler->threads; thread; thread = thread->next) {
+        thread->seen = 0;
     }
 
-    // == Load the metadata first ==
-    //    Process Name
-    {
-        PyObject* dict = PyDict_New();
-        PyObject* args = PyDict_New();
-        PyObject* process_name_string = PyUnicode_FromString("process_name");
-        PyObject* current_process_method = PyObject_GetAttrString(multiprocessing_module, "current_process");
-        if (!current_process_method) {
-            perror("Failed to access multiprocessing.current_process()");
-            exit(-1);
+    for (; tstate; tstate = PyThreadState_Next(tstate)) {
+        struct SampledThread* thread = NULL;
+        PyFrameObject* frame = NULL;
+        int depth = 0;
+        int common = 0;
+
+        if (tstate == curr) {
+            continue;
         }
-        PyObject* current_process = PyObject_CallObject(current_process_method, NULL);
-        if (!current_process_method) {
-            perror("Failed to access multiprocessing.current_process()");
-            exit(-1);
+
+        // Walk from the innermost frame. The code objects are alive as
+        // the threads can't run while we hold the GIL
+        frame = PyThreadState_GetFrame(tstate);
+        while (frame) {
+            PyFrameObject* back = PyFrame_GetBack(frame);
+            grow_code_array(&sampler->stack, NULL, &sampler->stack_capacity, depth + 1);
+            sampler->stack[depth++] = get_frame_code(frame);
+            Py_DECREF(frame);
+            frame = back;
         }
-        PyObject* process_name = PyObject_GetAttrString(current_process, "name");
 
-        Py_DECREF(current_process_method);
-        PyDict_SetItemString(dict, "ph", ph_M);
-        PyDict_SetItemString(dict, "pid", pid);
-        PyDict_SetItemString(dict, "tid", pid);
-        PyDict_SetItemString(dict, "name", process_name_string);
-        Py_DECREF(process_name_string);
-        PyDict_SetItemString(args, "name", process_name);
-        PyDict_SetItemString(dict, "args", args);
-        Py_DECREF(args);
-        Py_DECREF(process_name);
-        PyList_Append(lst, dict);
-    }
+        // Reverse it to start from the outermost one, and cut the stack
+        // at the first function that we should not trace
+        for (int i = 0; i < depth / 2; i++) {
+            PyCodeObject* code = sampler->stack[i];
+            sampler->stack[i] = sampler->stack[depth - 1 - i];
+            sampler->stack[depth - 1 - i] = code;
+        }
+        for (int i = 0; i < depth; i++) {
+            if (check_code_ignored(self, sampler->stack[i]) ||
+                    (CHECK_FLAG(self->check_flags, SNAPTRACE_MAX_STACK_DEPTH) && i >= self->max_stack_depth)) {
+                depth = i;
+                break;
+            }
+        }
 
-    
-    //    Thread Name
-    metadata_node = self->metadata_head;
-    while (metadata_node) {
-        PyObject* dict = PyDict_New();
-        PyObject* args = PyDict_New();
-        PyObject* tid = PyLong_FromLong(metadata_node->tid);
-        PyObject* thread_name_string = PyUnicode_FromString("thread_name");
+        if (depth == 0) {
+            continue;
+        }
 
-        PyDict_SetItemString(dict, "ph", ph_M);
-        PyDict_SetItemString(dict, "pid", pid);
-        PyDict_SetItemString(dict, "tid", tid);
-        Py_DECREF(tid);
-        PyDict_SetItemString(dict, "name", thread_name_string);
-        Py_DECREF(thread_name_string);
-        PyDict_SetItemString(args, "name", metadata_node->name);
-        PyDict_SetItemString(dict, "args", args);
-        Py_DECREF(args);
-        metadata_node = metadata_node->next;
-        PyList_Append(lst, dict);
+        thread = get_sampled_thread(sampler, tstate->thread_id);
+        thread->seen = 1;
+
+        while (common < thread->depth && common < depth && thread->codes[common] == sampler->stack[common]) {
+            common++;
+        }
+        while (thread->depth > common) {
+            pop_sampled_function(self, thread, now);
+        }
+        grow_code_array(&thread->codes, &thread->starts, &thread->capacity, depth);
+        for (int i = common; i < depth; i++) {
+            thread->codes[i] = sampler->stack[i];
+            Py_INCREF(thread->codes[i]);
+            thread->starts[i] = now;
+        }
+        thread->depth = depth;
     }
 
-    // Task Name if using LOG_ASYNC
-    // We need to make up some thread id for the task
-    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
-        task_dict = PyDict_New();
+    // The threads that are gone or not running any traced function
+    prev = &sampler->threads;
+    while (*prev) {
+        struct SampledThread* thread = *prev;
+        if (thread->seen) {
+            prev = &thread->next;
+        } else {
+            *prev = thread->next;
+            free_sampled_thread(self, thread, now);
+        }
     }
+}
 
-    while (curr != self->buffer + self->buffer_tail_idx) {
-        struct EventNode* node = curr;
-        PyObject* dict = PyDict_New();
-        PyObject* name = NULL;
-        PyObject* tid = PyLong_FromLong(node->tid);
-        PyObject* ts = PyFloat_FromDouble(node->ts / 1000);
+#if _WIN32
+static DWORD WINAPI sampler_main(LPVOID arg)
+#else
+static void* sampler_main(void* arg)
+#endif
+{
+    struct SamplerState* sampler = arg;
+    PyGILState_STATE state = PyGILState_Ensure();
 
-        PyDict_SetItemString(dict, "pid", pid);
-        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
-            if (curr->data.fee.asyncio_task == NULL) {
-                PyDict_SetItemString(dict, "tid", tid);
-            } else {
-                PyObject* task_id = PyLong_FromLong(((long)curr->data.fee.asyncio_task) & 0xffffff);
-                PyDict_SetItemString(dict, "tid", task_id);
-                if (!PyDict_Contains(task_dict, task_id)) {
-                    PyObject* task_name = NULL;
-                    if (PyObject_HasAttrString(curr->data.fee.asyncio_task, "get_name")) {
-                        PyObject* task_name_method = PyObject_GetAttrString(curr->data.fee.asyncio_task, "get_name");
-                        task_name = PyObject_CallObject(task_name_method, NULL);
-                        Py_DECREF(task_name_method);
-                    } else {
-                        task_name = PyUnicode_FromString("Task");
-                    }
-                    
-                    PyDict_SetItem(task_dict, task_id, task_name);
-                    Py_DECREF(task_name);
-                }
-                Py_DECREF(task_id);
-            }
-        } else {
-            PyDict_SetItemString(dict, "tid", tid);
+    while (sampler->running) {
+        Py_BEGIN_ALLOW_THREADS
+        sampler_sleep(sampler->interval);
+        Py_END_ALLOW_THREADS
+        if (sampler->running) {
+            take_sample(sampler);
         }
-        Py_DECREF(tid);
-        PyDict_SetItemString(dict, "ts", ts);
-        Py_DECREF(ts);
+    }
 
-        switch (node->ntype) {
-        case FEE_NODE:
-            name = get_name_from_fee_node(node, func_name_dict);
+    PyGILState_Release(state);
 
-            PyObject* dur = PyFloat_FromDouble(node->data.fee.dur / 1000);
-            PyDict_SetItemString(dict, "dur", dur);
-            Py_DECREF(dur);
-            PyDict_SetItemString(dict, "name", name);
-            Py_DECREF(name);
+#if _WIN32
+    return 0;
+#else
+    return NULL;
+#endif
+}
 
-            if (node->data.fee.caller_lineno >= 0) {
-                PyObject* caller_lineno = PyLong_FromLong(node->data.fee.caller_lineno);
-                PyDict_SetItemString(dict, "caller_lineno", caller_lineno);
-                Py_DECREF(caller_lineno);
-            }
+static int start_sampler(TracerObject* self)
+{
+    struct SamplerState* sampler = (struct SamplerState*) PyMem_Calloc(1, sizeof(struct SamplerState));
+    if (!sampler) {
+        PyErr_NoMemory();
+        return -1;
+    }
 
-            PyObject* arg_dict = NULL;
-            if (node->data.fee.args) {
-                arg_dict = node->data.fee.args;
-                Py_INCREF(arg_dict);
-            }
-            if (node->data.fee.retval) {
-                if (!arg_dict) {
-                    arg_dict = PyDict_New();
-                }
-                PyDict_SetItemString(arg_dict, "return_value", node->data.fee.retval);
-            }
-            if (arg_dict) {
-                PyDict_SetItemString(dict, "args", arg_dict);
-                Py_DECREF(arg_dict);
-            }
+#if PY_VERSION_HEX < 0x03070000
+    PyEval_InitThreads();
+#endif
 
-            PyDict_SetItemString(dict, "ph", ph_X);
-            PyDict_SetItemString(dict, "cat", cat_fee);
-            break;
-        case INSTANT_NODE:
-            PyDict_SetItemString(dict, "ph", ph_I);
-            PyDict_SetItemString(dict, "cat", cat_instant);
-            PyDict_SetItemString(dict, "name", node->data.instant.name);
-            PyDict_SetItemString(dict, "s", node->data.instant.scope);
-            break;
-        case COUNTER_NODE:
-            PyDict_SetItemString(dict, "ph", ph_C);
-            PyDict_SetItemString(dict, "name", node->data.counter.name);
-            PyDict_SetItemString(dict, "args", node->data.counter.args);
-            break;
-        case OBJECT_NODE:
-            PyDict_SetItemString(dict, "ph", node->data.object.ph);
-            PyDict_SetItemString(dict, "id", node->data.object.id);
-            PyDict_SetItemString(dict, "name", node->data.object.name);
-            if (!(node->data.object.args == Py_None)) {
-                PyDict_SetItemString(dict, "args", node->data.object.args);
-            }
-            break;
-        case RAW_NODE:
-            // We still need to tid from node and we need the pid
-            tid = PyLong_FromLong(node->tid);
+    sampler->tracer = self;
+    sampler->pid = get_current_pid();
+    sampler->interval = self->sample_interval;
+    sampler->running = 1;
 
-            Py_DECREF(dict);
-            dict = node->data.raw;
+#if _WIN32
+    sampler->thread = CreateThread(NULL, 0, sampler_main, sampler, 0, NULL);
+    if (!sampler->thread) {
+#else
+    if (pthread_create(&sampler->thread, NULL, sampler_main, sampler) != 0) {
+#endif
+        PyMem_FREE(sampler);
+        PyErr_SetString(PyExc_RuntimeError, "Failed to start the sampling thread");
+        return -1;
+    }
 
-            PyDict_SetItemString(dict, "pid", pid);
-            PyDict_SetItemString(dict, "tid", tid);
-            Py_DECREF(tid);
+    self->sampler = sampler;
 
-            Py_INCREF(dict);
-            break;
-        default:
-            printf("Unknown Node Type!\n");
-            exit(1);
-        }
-        clear_node(node);
-        PyList_Append(lst, dict);
-        curr = curr + 1;
-        if (curr == self->buffer + self->buffer_size) {
-            curr = self->buffer;
-        }
+    return 0;
+}
 
-        counter += 1;
-        if (counter - prev_counter > 10000 && (counter - prev_counter) / ((1 + self->total_entries)/100) > 0) {
-            verbose_printf(self, 1, "Loading data, %lu / %lu\r", counter, self->total_entries);
-            prev_counter = counter;
-        }
+static void stop_sampler(TracerObject* self)
+{
+    struct SamplerState* sampler = self->sampler;
+    int64_t now = get_ts();
+
+    if (!sampler) {
+        return;
     }
 
-    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
-        Py_ssize_t pos = 0;
-        PyObject* key = NULL;
-        PyObject* value = NULL;
-        while (PyDict_Next(task_dict, &pos, &key, &value)) {
-            PyObject* dict = PyDict_New();
-            PyObject* args = PyDict_New();
-            PyObject* tid = key;
-            PyObject* thread_name_string = PyUnicode_FromString("thread_name");
-
-            PyDict_SetItemString(dict, "ph", ph_M);
-            PyDict_SetItemString(dict, "pid", pid);
-            PyDict_SetItemString(dict, "tid", tid);
-            Py_DECREF(tid);
-            PyDict_SetItemString(dict, "name", thread_name_string);
-            Py_DECREF(thread_name_string);
-            PyDict_SetItemString(args, "name", value);
-            PyDict_SetItemString(dict, "args", args);
-            Py_DECREF(args);
-            PyList_Append(lst, dict);
+    self->sampler = NULL;
+    sampler->running = 0;
+
+    // A forked child does not have the sampling thread
+    if (sampler->pid == get_current_pid()) {
+        // The sampling thread needs the GIL to find out it should stop
+        Py_BEGIN_ALLOW_THREADS
+#if _WIN32
+        WaitForSingleObject(sampler->thread, INFINITE);
+        CloseHandle(sampler->thread);
+#else
+        pthread_join(sampler->thread, NULL);
+#endif
+        Py_END_ALLOW_THREADS
+    }
+
+    // The functions still on the stacks end when the sampling stops
+    while (sampler->threads) {
+        struct SampledThread* thread = sampler->threads;
+        sampler->threads = thread->next;
+        free_sampled_thread(self, thread, now);
+    }
+
+    PyMem_FREE(sampler->stack);
+    PyMem_FREE(sampler);
+}
+
+static PyObject*
+snaptrace_getstats(TracerObject* self, PyObject* args)
+{
+    struct FuncNameTable* table = &self->func_stats;
+    PyObject* stats = PyDict_New();
+
+    for (Py_ssize_t i = 0; i < table->capacity; i++) {
+        struct FuncNameEntry* entry = table->entries + i;
+        if (entry->name) {
+            // In us like the timestamps in the report
+            PyObject* stat = Py_BuildValue("{s:K,s:d,s:d,s:d,s:d}",
+                                           "calls", (unsigned long long)entry->calls,
+                                           "total", entry->total_dur / 1000.0,
+                                           "self", entry->self_dur / 1000.0,
+                                           "min", entry->min_dur / 1000.0,
+                                           "max", entry->max_dur / 1000.0);
+            if (!stat) {
+                Py_DECREF(stats);
+                return NULL;
+            }
+            PyDict_SetItem(stats, entry->name, stat);
+            Py_DECREF(stat);
         }
     }
 
-    verbose_printf(self, 1, "Loading finish                                        \n");
-    Py_DECREF(pid);
-    Py_DECREF(cat_fee);
-    Py_DECREF(cat_instant);
-    Py_DECREF(ph_B);
-    Py_DECREF(ph_E);
-    Py_DECREF(ph_I);
-    Py_DECREF(ph_X);
-    Py_DECREF(ph_C);
-    Py_DECREF(ph_M);
-    Py_DECREF(func_name_dict);
-    self->buffer_tail_idx = self->buffer_head_idx;
-    return lst;
+    return stats;
 }
 
 static PyObject*
 snaptrace_clear(TracerObject* self, PyObject* args)
 {
-    struct EventNode* curr = self->buffer + self->buffer_head_idx;
-    while (curr != self->buffer + self->buffer_tail_idx) {
-        struct EventNode* node = curr;
-        clear_node(node);
-        curr = curr + 1;
-        if (curr == self->buffer + self->buffer_size) {
-            curr = self->buffer;
-        }
+    clear_event_buffer(&self->buffer);
+    for (struct EventBuffer* buffer = self->thread_buffers; buffer; buffer = buffer->next) {
+        clear_event_buffer(buffer);
     }
-    self->buffer_tail_idx = self->buffer_head_idx;
+    func_name_table_clear(&self->call_counts);
+    func_name_table_clear(&self->func_stats);
 
     Py_RETURN_NONE;
 }
@@ -846,9 +3204,12 @@ snaptrace_setpid(TracerObject* self, PyObject* args)
 static PyObject*
 snaptrace_getts(TracerObject* self, PyObject* args)
 {
-    double ts = get_ts();
+    // The ts could be used for an event of the thread, like VizEvent, so
+    // it's on the same clock as the functions of the thread
+    struct ThreadInfo* info = get_thread_info(self);
+    int64_t ts = info ? get_thread_ts(info) : get_ts();
 
-    return PyFloat_FromDouble(ts / 1000);
+    return PyFloat_FromDouble(ts / 1000.0);
 }
 
 static PyObject*
@@ -873,7 +3234,9 @@ snaptrace_config(TracerObject* self, PyObject* args, PyObject* kw)
     static char* kwlist[] = {"verbose", "lib_file_path", "max_stack_depth", 
             "include_files", "exclude_files", "ignore_c_function", "ignore_frozen",
             "log_func_retval", "vdb", "log_func_args", "log_async", "trace_self",
-            "min_duration",
+            "min_duration", "per_thread_buffer", "use_monitoring",
+            "sample_rate", "call_budget", "call_sample_ratio",
+            "collect_stats", "stats_only", "clock",
             NULL};
     int kw_verbose = -1;
     int kw_max_stack_depth = 0;
@@ -888,7 +3251,15 @@ snaptrace_config(TracerObject* self, PyObject* args, PyObject* kw)
     int kw_log_async = -1;
     int kw_trace_self = -1;
     double kw_min_duration = 0;
-    if (!PyArg_ParseTupleAndKeywords(args, kw, "|isiOOpppppppd", kwlist,
+    int kw_per_thread_buffer = -1;
+    int kw_use_monitoring = -1;
+    double kw_sample_rate = 0;
+    long kw_call_budget = 0;
+    long kw_call_sample_ratio = 0;
+    int kw_collect_stats = -1;
+    int kw_stats_only = -1;
+    char* kw_clock = NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "|isiOOpppppppdppdllpps", kwlist,
             &kw_verbose,
             &kw_lib_file_path,
             &kw_max_stack_depth,
@@ -901,7 +3272,15 @@ snaptrace_config(TracerObject* self, PyObject* args, PyObject* kw)
             &kw_log_func_args,
             &kw_log_async,
             &kw_trace_self,
-            &kw_min_duration)) {
+            &kw_min_duration,
+            &kw_per_thread_buffer,
+            &kw_use_monitoring,
+            &kw_sample_rate,
+            &kw_call_budget,
+            &kw_call_sample_ratio,
+            &kw_collect_stats,
+            &kw_stats_only,
+            &kw_clock)) {
         return NULL;
     }
 
@@ -967,14 +3346,76 @@ snaptrace_config(TracerObject* self, PyObject* args, PyObject* kw)
         UNSET_FLAG(self->check_flags, SNAPTRACE_TRACE_SELF);
     }
 
+    if (kw_per_thread_buffer == 1) {
+        SET_FLAG(self->check_flags, SNAPTRACE_PER_THREAD_BUFFER);
+    } else if (kw_per_thread_buffer == 0) {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_PER_THREAD_BUFFER);
+    }
+
+    if (kw_use_monitoring == 1) {
+#if PY_VERSION_HEX >= 0x030C0000
+        SET_FLAG(self->check_flags, SNAPTRACE_USE_MONITORING);
+#else
+        PyErr_SetString(PyExc_ValueError, "use_monitoring requires Python 3.12+");
+        return NULL;
+#endif
+    } else if (kw_use_monitoring == 0) {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_USE_MONITORING);
+    }
+
+    if (kw_clock) {
+        int clock = -1;
+        if (strcmp(kw_clock, "monotonic") == 0) {
+            clock = SNAPTRACE_CLOCK_MONOTONIC;
+        } else if (strcmp(kw_clock, "monotonic_raw") == 0) {
+            clock = SNAPTRACE_CLOCK_MONOTONIC_RAW;
+        } else if (strcmp(kw_clock, "tsc") == 0) {
+            clock = SNAPTRACE_CLOCK_TSC;
+        } else {
+            PyErr_Format(PyExc_ValueError, "Unknown clock %s", kw_clock);
+            return NULL;
+        }
+        if (set_clock(clock) < 0) {
+            PyErr_Format(PyExc_ValueError, "Clock %s is not available on this machine", kw_clock);
+            return NULL;
+        }
+    }
+
     if (kw_min_duration > 0) {
         // In Python code the default unit is us
         // Convert to ns which is what c Code uses
-        self->min_duration = kw_min_duration * 1000;
+        self->min_duration = (int64_t)(kw_min_duration * 1000);
     } else {
         self->min_duration = 0;
     }
 
+    if (kw_collect_stats == 1) {
+        SET_FLAG(self->check_flags, SNAPTRACE_COLLECT_STATS);
+    } else if (kw_collect_stats == 0) {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_COLLECT_STATS);
+    }
+
+    if (kw_stats_only == 1) {
+        SET_FLAG(self->check_flags, SNAPTRACE_STATS_ONLY);
+    } else if (kw_stats_only == 0) {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_STATS_ONLY);
+    }
+
+    if (kw_sample_rate > 0) {
+        // Rate is in Hz, the interval is in ns
+        self->sample_interval = 1e9 / kw_sample_rate;
+    } else {
+        self->sample_interval = 0;
+    }
+
+    if (kw_call_budget > 0) {
+        self->call_budget = kw_call_budget;
+        self->call_sample_ratio = kw_call_sample_ratio > 0 ? kw_call_sample_ratio : 0;
+    } else {
+        self->call_budget = 0;
+        self->call_sample_ratio = 0;
+    }
+
     if (kw_max_stack_depth >= 0) {
         SET_FLAG(self->check_flags, SNAPTRACE_MAX_STACK_DEPTH);       
         self->max_stack_depth = kw_max_stack_depth;
@@ -1004,6 +3445,8 @@ snaptrace_config(TracerObject* self, PyObject* args, PyObject* kw)
         UNSET_FLAG(self->check_flags, SNAPTRACE_EXCLUDE_FILES);
     }
 
+    update_code_filter(self);
+
     Py_RETURN_NONE;
 }
 
@@ -1019,10 +3462,10 @@ snaptrace_addinstant(TracerObject* self, PyObject* args)
         exit(1);
     }
 
-    node = get_next_node(self);
+    node = get_next_node(self, info);
     node->ntype = INSTANT_NODE;
-    node->tid = info->tid;
-    node->ts = get_ts();
+    node->tid_idx = info->tid_idx;
+    node->ts = get_thread_ts(info);
     node->data.instant.name = name;
     node->data.instant.scope = scope;
     Py_INCREF(name);
@@ -1065,10 +3508,10 @@ snaptrace_addcounter(TracerObject* self, PyObject* args)
         exit(1);
     }
 
-    node = get_next_node(self);
+    node = get_next_node(self, info);
     node->ntype = COUNTER_NODE;
-    node->tid = info->tid;
-    node->ts = get_ts();
+    node->tid_idx = info->tid_idx;
+    node->ts = get_thread_ts(info);
     node->data.counter.name = name;
     node->data.counter.args = counter_args;
     Py_INCREF(name);
@@ -1091,10 +3534,10 @@ snaptrace_addobject(TracerObject* self, PyObject* args)
         exit(1);
     }
 
-    node = get_next_node(self);
+    node = get_next_node(self, info);
     node->ntype = OBJECT_NODE;
-    node->tid = info->tid;
-    node->ts = get_ts();
+    node->tid_idx = info->tid_idx;
+    node->ts = get_thread_ts(info);
     node->data.object.ph = ph;
     node->data.object.id = id;
     node->data.object.name = name;
@@ -1118,8 +3561,9 @@ snaptrace_addraw(TracerObject* self, PyObject* args)
         exit(1);
     }
 
-    node = get_next_node(self);
-    node->tid = info->tid;
+    node = get_next_node(self, info);
+    node->tid_idx = info->tid_idx;
+    node->ts = get_thread_ts(info);
     node->ntype = RAW_NODE;
     node->data.raw = raw;
     Py_INCREF(raw);
@@ -1159,6 +3603,7 @@ static struct ThreadInfo* snaptrace_createthreadinfo(TracerObject* self) {
 #else
     info->tid = syscall(SYS_gettid);
 #endif
+    info->tid_idx = get_tid_index(self, info->tid);
 
 #if _WIN32
     TlsSetValue(self->dwTlsIndex, info);
@@ -1182,38 +3627,40 @@ static struct ThreadInfo* snaptrace_createthreadinfo(TracerObject* self) {
 
     Py_DECREF(current_thread_method);
 
+    add_thread_metadata(self, info->tid, thread_name);
+
+    info->curr_task = NULL;
+    info->curr_task_frame = NULL;
+
+    PyGILState_Release(state);
+
+    return info;
+}
+
+// Set the name of thread tid, the reference of name is stolen
+static void add_thread_metadata(TracerObject* self, unsigned long tid, PyObject* name)
+{
     // Check for existing node for the same tid first
     struct MetadataNode* node = self->metadata_head;
-    int found_node = 0;
 
     while (node) {
-        if (node->tid == info->tid) {
+        if (node->tid == tid) {
             Py_DECREF(node->name);
-            node->name = thread_name;
-            found_node = 1;
-            break;
+            node->name = name;
+            return;
         }
         node = node->next;
     }
 
-    if (!found_node) {
-        node = (struct MetadataNode*) PyMem_Calloc(1, sizeof(struct MetadataNode));
-        if (!node) {
-            perror("Out of memory!");
-            exit(-1);
-        }
-        node->name = thread_name;
-        node->tid = info->tid;
-        node->next = self->metadata_head;
-        self->metadata_head = node;
+    node = (struct MetadataNode*) PyMem_Calloc(1, sizeof(struct MetadataNode));
+    if (!node) {
+        perror("Out of memory!");
+        exit(-1);
     }
-
-    info->curr_task = NULL;
-    info->curr_task_frame = NULL;
-
-    PyGILState_Release(state);
-
-    return info;
+    node->name = name;
+    node->tid = tid;
+    node->next = self->metadata_head;
+    self->metadata_head = node;
 }
 
 static void snaptrace_threaddestructor(void* key) {
@@ -1259,7 +3706,6 @@ Tracer_New(PyTypeObject* type, PyObject* args, PyObject* kwargs)
             printf("Error on TLS!\n");
             exit(-1);
         }
-        QueryPerformanceFrequency(&qpc_freq); 
 #else
         if (pthread_key_create(&self->thread_key, snaptrace_threaddestructor)) {
             perror("Failed to create Tss_Key");
@@ -1274,21 +3720,30 @@ Tracer_New(PyTypeObject* type, PyObject* args, PyObject* kwargs)
         self->buffer_size += 1;
         self->collecting = 0;
         self->fix_pid = 0;
-        self->total_entries = 0;
         self->check_flags = 0;
         self->verbose = 0;
         self->lib_file_path = NULL;
         self->max_stack_depth = 0;
         self->include_files = NULL;
         self->exclude_files = NULL;
+        self->file_trie = NULL;
+        self->verdict_tag = ++code_verdict_tag;
         self->min_duration = 0;
-        self->buffer = (struct EventNode*) PyMem_Calloc(self->buffer_size, sizeof(struct EventNode));
-        if (!self->buffer) {
-            printf("Out of memory!\n");
-            exit(1);
-        }
-        self->buffer_head_idx = 0;
-        self->buffer_tail_idx = 0;
+        self->call_budget = 0;
+        self->call_sample_ratio = 0;
+        func_name_table_init(&self->call_counts);
+        func_name_table_init(&self->func_stats);
+        self->buffer.nodes = alloc_event_nodes(self->buffer_size);
+        self->buffer.size = self->buffer_size;
+        self->buffer.head_idx = 0;
+        self->buffer.tail_idx = 0;
+        self->buffer.header = NULL;
+        self->buffer.next = NULL;
+        self->thread_buffers = NULL;
+        self->spill = NULL;
+        self->buffer_file = NULL;
+        self->sample_interval = 0;
+        self->sampler = NULL;
         self->metadata_head = NULL;
         snaptrace_createthreadinfo(self);
         // Python: threading.setprofile(tracefuncdisabled)
@@ -1313,7 +3768,11 @@ Tracer_New(PyTypeObject* type, PyObject* args, PyObject* kwargs)
 static void
 Tracer_dealloc(TracerObject* self)
 {
+    stop_sampler(self);
     snaptrace_cleanup(self, NULL);
+    if (close_spill(self) < 0) {
+        PyErr_WriteUnraisable((PyObject*)self);
+    }
     if (self->lib_file_path) {
         PyMem_FREE(self->lib_file_path);
     }
@@ -1323,7 +3782,23 @@ Tracer_dealloc(TracerObject* self)
     if (self->exclude_files) {
         Py_DECREF(self->exclude_files);
     }
-    PyMem_FREE(self->buffer);
+    if (self->file_trie) {
+        prefix_trie_free(self->file_trie);
+    }
+    func_name_table_clear(&self->call_counts);
+    func_name_table_clear(&self->func_stats);
+    close_buffer_file(self);
+    PyMem_FREE(self->tids);
+    free_event_nodes(self->buffer.nodes, self->buffer.size);
+
+    struct EventBuffer* buffer = self->thread_buffers;
+    while (buffer) {
+        struct EventBuffer* next = buffer->next;
+        free_event_nodes(buffer->nodes, buffer->size);
+        PyMem_FREE(buffer);
+        buffer = next;
+    }
+    self->thread_buffers = NULL;
 
     struct MetadataNode* node = self->metadata_head;
     struct MetadataNode* prev = NULL;
@@ -1386,13 +3861,38 @@ PyInit_snaptrace(void)
         return NULL;
     }
 
+    init_clock();
+    // Nothing to free, the verdicts are numbers
+    code_verdict_index = PyUnstable_Eval_RequestCodeExtraIndex(NULL);
+#if !_WIN32
+    pthread_atfork(buffer_file_prepare_fork, buffer_file_parent_fork, buffer_file_child_fork);
+#endif
+
     threading_module = PyImport_ImportModule("threading");
     multiprocessing_module = PyImport_ImportModule("multiprocessing");
     asyncio_module = PyImport_ImportModule("asyncio");
     asyncio_tasks_module = PyImport_AddModule("asyncio.tasks");
+    {
+        PyObject* json_module = PyImport_ImportModule("json");
+        json_dumps = PyObject_GetAttrString(json_module, "dumps");
+        Py_DECREF(json_module);
+    }
     if (PyObject_HasAttrString(asyncio_tasks_module, "current_task")) {
         asyncio_tasks_current_task = PyObject_GetAttrString(asyncio_tasks_module, "current_task");
     }
+#if PY_VERSION_HEX >= 0x030C0000
+    {
+        PyObject* sys_module = PyImport_ImportModule("sys");
+        PyObject* tool_id = NULL;
+        sys_monitoring = PyObject_GetAttrString(sys_module, "monitoring");
+        Py_DECREF(sys_module);
+        sys_monitoring_disable = PyObject_GetAttrString(sys_monitoring, "DISABLE");
+        sys_monitoring_missing = PyObject_GetAttrString(sys_monitoring, "MISSING");
+        tool_id = PyObject_GetAttrString(sys_monitoring, "PROFILER_ID");
+        sys_monitoring_tool_id = PyLong_AsLong(tool_id);
+        Py_DECREF(tool_id);
+    }
+#endif
 
     return m;
 }
\ No newline at end of file
@@ -4,6 +4,9 @@
 #ifndef __SNAPTRACE_H__
 #define __SNAPTRACE_H__
 
+#include "prefixtrie.h"
+#include "eventnode.h"
+
 #define SNAPTRACE_MAX_STACK_DEPTH (1 << 0)
 #define SNAPTRACE_INCLUDE_FILES (1 << 1)
 #define SNAPTRACE_EXCLUDE_FILES (1 << 2)
@@ -14,6 +17,10 @@
 #define SNAPTRACE_IGNORE_FROZEN (1 << 7)
 #define SNAPTRACE_LOG_ASYNC (1 << 8)
 #define SNAPTRACE_TRACE_SELF (1 << 9)
+#define SNAPTRACE_PER_THREAD_BUFFER (1 << 10)
+#define SNAPTRACE_USE_MONITORING (1 << 11)
+#define SNAPTRACE_COLLECT_STATS (1 << 12)
+#define SNAPTRACE_STATS_ONLY (1 << 13)
 
 #define SET_FLAG(reg, flag) ((reg) |= (flag))
 #define UNSET_FLAG(reg, flag) ((reg) &= (~(flag)))
@@ -23,20 +30,53 @@
 struct FunctionNode {
     struct FunctionNode* next;
     struct FunctionNode* prev;
-    double ts;
+    int64_t ts;
+    // The total duration of the functions it called, only for stats
+    int64_t children_dur;
     PyObject* args;
 };
 
+// Defined in snaptrace.c, the header of a buffer file
+struct BufferFileHeader;
+
+// A circular buffer of EventNode. The tracer always has a shared one,
+// and with SNAPTRACE_PER_THREAD_BUFFER every thread gets its own
+struct EventBuffer {
+    struct EventNode* nodes;
+    long size;
+    long head_idx;
+    long tail_idx;
+    // Not NULL if the nodes are mapped from a buffer file, head_idx and
+    // tail_idx are kept in sync with it
+    struct BufferFileHeader* header;
+    struct EventBuffer* next;
+};
+
 struct ThreadInfo {
     int paused;
     int curr_stack_depth;
     int ignore_stack_depth;
     unsigned long tid;
+    // Index of tid in the tid table of the tracer
+    uint32_t tid_idx;
+    // The last timestamp of the thread, to keep them strictly increasing
+    int64_t prev_ts;
     struct FunctionNode* stack_top;
     PyObject* curr_task;
     PyFrameObject* curr_task_frame;
+    // Owned by the tracer, it outlives the thread so we can still load it
+    struct EventBuffer* buffer;
 };
 
+// Defined in snaptrace.c, the state of spilling the buffers to disk
+struct SpillState;
+
+// Defined in snaptrace.c, the state of the sampling thread
+struct SamplerState;
+
+// Defined in snaptrace.c, the state of the buffer file
+struct BufferFile;
+
 struct MetadataNode {
     unsigned long tid;
     PyObject* name;
@@ -56,19 +96,47 @@ typedef struct {
     // this value is 0, then the program gets pid before parsing,
     // otherwise it uses this pid
     long fix_pid;
-    unsigned long total_entries;
     unsigned int check_flags;
     int verbose;
     char* lib_file_path;
     int max_stack_depth;
     PyObject* include_files;
     PyObject* exclude_files;
-    double min_duration;
-    struct EventNode* buffer;
+    // include_files or exclude_files compiled to a trie
+    struct PrefixTrie* file_trie;
+    // The tag of the verdicts of the current config in the code objects,
+    // see check_code_ignored()
+    uintptr_t verdict_tag;
+    // in ns
+    int64_t min_duration;
+    // Log the first call_budget calls of every function, then one of every
+    // call_sample_ratio calls. 0 means no budget
+    long call_budget;
+    long call_sample_ratio;
+    // function -> how many calls are made and dropped
+    struct FuncNameTable call_counts;
+    // function -> call count and durations, with SNAPTRACE_COLLECT_STATS
+    struct FuncNameTable func_stats;
     long buffer_size;
-    long buffer_head_idx;
-    long buffer_tail_idx;
+    struct EventBuffer buffer;
+    // Linked list of all the per-thread buffers, including dead threads
+    struct EventBuffer* thread_buffers;
+    // Not NULL if the full buffers are spilled to a file instead of
+    // overwriting the oldest events
+    struct SpillState* spill;
+    // Not NULL if the shared buffer is mapped from a file, so it survives
+    // a crash of the process
+    struct BufferFile* buffer_file;
+    // Interval between two samples in ns, 0 if every function call is
+    // traced instead
+    double sample_interval;
+    // Not NULL while the sampling thread is running
+    struct SamplerState* sampler;
     struct MetadataNode* metadata_head;
+    // The nodes only keep an index to this table of the tids they belong to
+    unsigned long* tids;
+    uint32_t tid_count;
+    uint32_t tid_capacity;
 } TracerObject;
 
 #endif
\ No newline at end of file
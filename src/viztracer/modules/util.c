@@ -5,11 +5,40 @@
 #include <windows.h>
 #endif
 #include <Python.h>
+#include <stdint.h>
 #include <time.h>
+#include "util.h"
 
+#if defined(__x86_64__) || defined(__i386__) || defined(_M_X64) || defined(_M_IX86)
+#define SNAPTRACE_HAS_TSC
+#if _MSC_VER
+#include <intrin.h>
+#else
+#include <cpuid.h>
+#include <x86intrin.h>
+#endif
+#endif
+
+// How long to compare the tsc with the monotonic clock to get its frequency
+#define TSC_CALIBRATION_NS 10000000
+
+
+static int clock_backend = SNAPTRACE_CLOCK_MONOTONIC;
 
 #if _WIN32
-LARGE_INTEGER qpc_freq;
+static int64_t qpc_freq = 0;
+#endif
+
+// The other clocks are converted to the monotonic clock at the time they
+// are selected, so the timestamps of different processes still line up
+#ifdef CLOCK_MONOTONIC_RAW
+static int64_t raw_offset = 0;
+#endif
+
+#ifdef SNAPTRACE_HAS_TSC
+static double tsc_ns_per_tick = 0;
+static int64_t tsc_base_ns = 0;
+static uint64_t tsc_base = 0;
 #endif
 
 // Utility functions
@@ -21,22 +50,140 @@ void Print_Py(PyObject* o)
     Py_DECREF(repr);
 }
 
-double get_ts(void)
+static inline int64_t timespec_to_ns(const struct timespec* t)
 {
-    static double prev_ts = 0;
-    double curr_ts = 0;
+    return (int64_t)t->tv_sec * 1000000000 + t->tv_nsec;
+}
 
+static inline int64_t get_monotonic_ts(void)
+{
 #if _WIN32
     LARGE_INTEGER counter = {0};
     QueryPerformanceCounter(&counter);
-    curr_ts = (double) counter.QuadPart;
-    curr_ts *= 1000000000LL;
-    curr_ts /= qpc_freq.QuadPart;
+    // Split it so the multiplication does not overflow
+    return counter.QuadPart / qpc_freq * 1000000000 + counter.QuadPart % qpc_freq * 1000000000 / qpc_freq;
 #else
     struct timespec t;
     clock_gettime(CLOCK_MONOTONIC, &t);
-    curr_ts = ((double)t.tv_sec * 1e9 + t.tv_nsec);
+    return timespec_to_ns(&t);
 #endif
+}
+
+#ifdef SNAPTRACE_HAS_TSC
+// Only an invariant tsc ticks at a constant rate on all the cores
+static int tsc_is_invariant(void)
+{
+    unsigned int regs[4] = {0};
+#if _MSC_VER
+    __cpuid((int*)regs, 0x80000000);
+    if (regs[0] < 0x80000007) {
+        return 0;
+    }
+    __cpuid((int*)regs, 0x80000007);
+#else
+    if (__get_cpuid_max(0x80000000, NULL) < 0x80000007) {
+        return 0;
+    }
+    __get_cpuid(0x80000007, &regs[0], &regs[1], &regs[2], &regs[3]);
+#endif
+    return (regs[3] & (1 << 8)) != 0;
+}
+
+static int calibrate_tsc(void)
+{
+    int64_t start_ns = 0;
+    int64_t end_ns = 0;
+    uint64_t start_tsc = 0;
+    uint64_t end_tsc = 0;
+
+    if (!tsc_is_invariant()) {
+        return -1;
+    }
+
+    start_ns = get_monotonic_ts();
+    start_tsc = __rdtsc();
+    do {
+        end_ns = get_monotonic_ts();
+        end_tsc = __rdtsc();
+    } while (end_ns - start_ns < TSC_CALIBRATION_NS);
+
+    if (end_tsc <= start_tsc) {
+        return -1;
+    }
+
+    tsc_ns_per_tick = (double)(end_ns - start_ns) / (double)(end_tsc - start_tsc);
+    tsc_base_ns = end_ns;
+    tsc_base = end_tsc;
+    return 0;
+}
+#endif
+
+void init_clock(void)
+{
+#if _WIN32
+    LARGE_INTEGER freq = {0};
+    QueryPerformanceFrequency(&freq);
+    qpc_freq = freq.QuadPart;
+#endif
+}
+
+int set_clock(int clock)
+{
+    switch (clock) {
+    case SNAPTRACE_CLOCK_MONOTONIC:
+        break;
+    case SNAPTRACE_CLOCK_MONOTONIC_RAW:
+#ifdef CLOCK_MONOTONIC_RAW
+        if (clock_backend != SNAPTRACE_CLOCK_MONOTONIC_RAW) {
+            struct timespec t;
+            clock_gettime(CLOCK_MONOTONIC_RAW, &t);
+            raw_offset = get_monotonic_ts() - timespec_to_ns(&t);
+        }
+        break;
+#else
+        return -1;
+#endif
+    case SNAPTRACE_CLOCK_TSC:
+#ifdef SNAPTRACE_HAS_TSC
+        // The calibration takes a while, only do it once
+        if (tsc_ns_per_tick == 0 && calibrate_tsc() < 0) {
+            return -1;
+        }
+        break;
+#else
+        return -1;
+#endif
+    default:
+        return -1;
+    }
+    clock_backend = clock;
+    return 0;
+}
+
+int64_t get_clock_ts(void)
+{
+    switch (clock_backend) {
+#ifdef CLOCK_MONOTONIC_RAW
+    case SNAPTRACE_CLOCK_MONOTONIC_RAW: {
+        struct timespec t;
+        clock_gettime(CLOCK_MONOTONIC_RAW, &t);
+        return timespec_to_ns(&t) + raw_offset;
+    }
+#endif
+#ifdef SNAPTRACE_HAS_TSC
+    case SNAPTRACE_CLOCK_TSC:
+        return (int64_t)((double)(int64_t)(__rdtsc() - tsc_base) * tsc_ns_per_tick) + tsc_base_ns;
+#endif
+    default:
+        return get_monotonic_ts();
+    }
+}
+
+int64_t get_ts(void)
+{
+    static int64_t prev_ts = 0;
+    int64_t curr_ts = get_clock_ts();
+
     if (curr_ts <= prev_ts) {
         // We use artificial timestamp to avoid timestamp conflict.
         // 20 ns should be a safe granularity because that's normally
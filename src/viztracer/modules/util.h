@@ -5,8 +5,20 @@
 #ifndef __SNAPTRACE_UTIL_H__
 #define __SNAPTRACE_UTIL_H__
 
+#include <stdint.h>
+
+#define SNAPTRACE_CLOCK_MONOTONIC 0
+#define SNAPTRACE_CLOCK_MONOTONIC_RAW 1
+#define SNAPTRACE_CLOCK_TSC 2
+
 void Print_Py(PyObject* o);
-double get_ts(void);
+void init_clock(void);
+// Returns -1 if the clock is not available on this machine
+int set_clock(int clock);
+// Read the clock in ns, without any fixup
+int64_t get_clock_ts(void);
+// Like get_clock_ts(), but never returns the same timestamp twice
+int64_t get_ts(void);
 
 // target and prefix has to be NULL-terminated
 inline int startswith(const char* target, const char* prefix)
@@ -55,7 +55,7 @@ def patch_multiprocessing(ui, tracer: VizTracer) -> None:
     from multiprocessing.util import register_after_fork
 
     tracer.pid_suffix = True
-    tracer.output_file = os.path.join(ui.multiprocess_output_dir, "result.json")
+    tracer.output_file = os.path.join(ui.multiprocess_output_dir, ui.multiprocess_output_name)
     register_after_fork(tracer, func_after_fork)
 
     # For spawn process
@@ -70,7 +70,8 @@ def patch_multiprocessing(ui, tracer: VizTracer) -> None:
             prog = textwrap.dedent(f"""
                     from multiprocessing.spawn import spawn_main;
                     from viztracer.patch import patch_spawned_process;
-                    patch_spawned_process({ui.init_kwargs}, '{ui.multiprocess_output_dir}');
+                    patch_spawned_process({ui.init_kwargs}, '{ui.multiprocess_output_dir}',
+                                          '{ui.multiprocess_output_name}');
                     spawn_main(%s)
                     """)
             prog %= ', '.join('%s=%r' % item for item in kwds.items())
@@ -86,11 +87,13 @@ class SpawnProcess:
             self,
             viztracer_kwargs: Dict[str, Any],
             multiprocess_output_dir: str,
+            multiprocess_output_name: str,
             target: Callable,
             args: List[Any],
             kwargs: Dict[str, Any]):
         self._viztracer_kwargs = viztracer_kwargs
         self._multiprocess_output_dir = multiprocess_output_dir
+        self._multiprocess_output_name = multiprocess_output_name
         self._target = target
         self._args = args
         self._kwargs = kwargs
@@ -122,12 +125,15 @@ class SpawnProcess:
         tracer = viztracer.VizTracer(**self._viztracer_kwargs)
         tracer.start()
         tracer.pid_suffix = True
-        tracer.output_file = os.path.join(self._multiprocess_output_dir, "result.json")
+        tracer.output_file = os.path.join(self._multiprocess_output_dir, self._multiprocess_output_name)
         self._run()
         atexit._run_exitfuncs()
 
 
-def patch_spawned_process(viztracer_kwargs: Dict[str, Any], multiprocess_output_dir: str):
+def patch_spawned_process(
+        viztracer_kwargs: Dict[str, Any],
+        multiprocess_output_dir: str,
+        multiprocess_output_name: str = "result.json"):
     from multiprocessing import reduction, process  # type: ignore
     from multiprocessing.spawn import prepare
     import multiprocessing.spawn
@@ -139,7 +145,8 @@ def patch_spawned_process(viztracer_kwargs: Dict[str, Any], multiprocess_output_
                 preparation_data = reduction.pickle.load(from_parent)
                 prepare(preparation_data)
                 self = reduction.pickle.load(from_parent)
-                sp = SpawnProcess(viztracer_kwargs, multiprocess_output_dir, self._target, self._args, self._kwargs)
+                sp = SpawnProcess(viztracer_kwargs, multiprocess_output_dir, multiprocess_output_name,
+                                  self._target, self._args, self._kwargs)
                 sp._run = self.run
                 self.run = sp.run
             finally:
@@ -153,7 +160,8 @@ def patch_spawned_process(viztracer_kwargs: Dict[str, Any], multiprocess_output_
                 preparation_data = reduction.pickle.load(from_parent)
                 prepare(preparation_data)
                 self = reduction.pickle.load(from_parent)
-                sp = SpawnProcess(viztracer_kwargs, multiprocess_output_dir, self._target, self._args, self._kwargs)
+                sp = SpawnProcess(viztracer_kwargs, multiprocess_output_dir, multiprocess_output_name,
+                                  self._target, self._args, self._kwargs)
                 sp._run = self.run
                 self.run = sp.run
             finally:
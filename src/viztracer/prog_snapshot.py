@@ -173,6 +173,9 @@ class ProgSnapshot:
 
     def __init__(self, json_string=None, p=print):
         self.func_trees = {}
+        # The function events of every thread while loading
+        self._thread_events = {}
+        self._func_table = {}
         self.curr_node = None
         self.curr_frame = None
         self.first_tree = None
@@ -196,8 +199,17 @@ class ProgSnapshot:
             if not self.check_version(raw_data["viztracer_metadata"]["version"]):
                 return False
         trace_events = raw_data["traceEvents"]
+        self._thread_events = {}
+        # The function trees of the trace share the functions
+        self._func_table = {}
         for event in trace_events:
             self.load_event(event)
+        # The function trees are built at once, it's much faster
+        for pid in self._thread_events:
+            for tid, events in self._thread_events[pid].items():
+                self.func_trees[pid][tid].add_events(events)
+        self._thread_events = {}
+        self._func_table = {}
         self.first_tree = min([tree for tree in self.get_trees()], key=lambda x: x.first_ts())
         first_ts = self.first_tree.first_ts()
         self.curr_tree = self.first_tree
@@ -221,9 +233,10 @@ class ProgSnapshot:
             if pid not in self.func_trees:
                 self.func_trees[pid] = {}
             if tid not in self.func_trees[pid]:
-                self.func_trees[pid][tid] = FuncTree(pid, tid)
+                self.func_trees[pid][tid] = FuncTree(pid, tid, self._func_table)
+                self._thread_events.setdefault(pid, {})[tid] = []
 
-            self.func_trees[pid][tid].add_event(event)
+            self._thread_events[pid][tid].append(event)
         elif ph == "C":
             self.counter_events.add_event(event)
         elif ph in ["N", "D", "O"]:
@@ -2,15 +2,19 @@
 # For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
 
 from string import Template
+import hashlib
+import multiprocessing
 import os
+import queue
 import re
-import gzip
 import sys
-from typing import Any, Dict, List, Optional, Sequence, Union, TextIO
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union, TextIO
 try:
     import orjson  # type: ignore
 except ImportError:
     import json
+from . import binary_trace
+from .compression import is_compressed, open_compressed
 from .util import color_print
 
 
@@ -21,33 +25,279 @@ def get_json(data: Union[Dict, str]) -> Dict[str, Any]:
         # This is an object already
         return data
     elif isinstance(data, str):
-        with open(data, encoding="utf-8") as f:
-            json_str = f.read()
+        if binary_trace.is_binary_trace(data):
+            return binary_trace.load(data)
+        if is_compressed(data):
+            with open_compressed(data, "rt") as f:
+                json_str = f.read()
+        else:
+            with open(data, encoding="utf-8") as f:
+                json_str = f.read()
     else:
         raise TypeError("Unexpected Type{}!", type(data))
 
     try:
-        if "orjson" in sys.modules:
-            return orjson.loads(json_str)
-        else:
-            return json.loads(json_str)
+        return loads(json_str)
     except Exception as e:
         print("Unable to decode {}".format(data))
         raise e
 
 
+def loads(json_str: str) -> Any:
+    if "orjson" in sys.modules:
+        return orjson.loads(json_str)
+    return json.loads(json_str)
+
+
+def dumps(obj: Any) -> str:
+    if "orjson" in sys.modules:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
+
+# The source files read for file_info, keyed by the path, the least
+# recently used first. An entry is reused as long as the mtime and the size
+# of the file don't change, so the files are not read again for every save
+# in the process. The total length of the sources is kept under
+# SOURCE_CACHE_MAX_SIZE, reading a file again is cheap
+_source_cache: Dict[str, Tuple[int, int, List[Any]]] = {}
+_source_cache_size = 0
+SOURCE_CACHE_MAX_SIZE = 1 << 25
+# Where the functions are, keyed by the function name. None if the name
+# does not have a file in it. It's cleared when it's full
+_function_cache: Dict[str, Optional[Tuple[str, int]]] = {}
+FUNCTION_CACHE_MAX_SIZE = 1 << 16
+_function_pattern = re.compile(r".*\((.*):([0-9]*)\)")
+
+SOURCE_BUNDLE_VERSION = 1
+
+
+def get_function_location(name: str) -> Optional[Tuple[str, int]]:
+    try:
+        return _function_cache[name]
+    except KeyError:
+        pass
+    location = None
+    m = _function_pattern.match(name)
+    if m is not None and m.group(2):
+        location = (m.group(1), int(m.group(2)))
+    if len(_function_cache) >= FUNCTION_CACHE_MAX_SIZE:
+        _function_cache.clear()
+    _function_cache[name] = location
+    return location
+
+
+def read_source(file_name: str) -> List[Any]:
+    """
+    Return [content, number of lines] of a source file, raise OSError or
+    UnicodeDecodeError if it can't be read
+    """
+    global _source_cache_size
+    stat = os.stat(file_name)
+    # Put it back as the most recently used one
+    cached = _source_cache.pop(file_name, None)
+    if cached is not None:
+        if cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            _source_cache[file_name] = cached
+            return cached[2]
+        _source_cache_size -= len(cached[2][0])
+    with open(file_name, "r", encoding="utf-8") as f:
+        content = f.read()
+    source = [content, content.count("\n")]
+    _source_cache[file_name] = (stat.st_mtime_ns, stat.st_size, source)
+    _source_cache_size += len(content)
+    while _source_cache_size > SOURCE_CACHE_MAX_SIZE:
+        _, _, evicted = _source_cache.pop(next(iter(_source_cache)))
+        _source_cache_size -= len(evicted[0])
+    return source
+
+
+def get_file_info(
+        functions: Union[Iterable[str], Dict[str, Optional[Tuple[str, int]]]]) -> Dict[str, Any]:
+    """
+    Build the file_info of the report, the source of the files and where
+    the functions are in them. functions are the names of the functions,
+    or a dict from the names to the locations like Tracer.functions, so
+    only the names with an unknown(None) location need to be parsed
+    """
+    file_info: Dict[str, Any] = {"files": {}, "functions": {}}
+    file_dict = file_info["files"]
+    func_dict = file_info["functions"]
+    unreadable: Set[str] = set()
+    if not isinstance(functions, dict):
+        functions = dict.fromkeys(functions)
+    for name, location in functions.items():
+        if location is None:
+            location = get_function_location(name)
+            if location is None:
+                continue
+        file_name, lineno = location
+        if file_name not in file_dict:
+            if file_name in unreadable:
+                continue
+            try:
+                file_dict[file_name] = read_source(file_name)
+            except (OSError, UnicodeDecodeError):
+                unreadable.add(file_name)
+                continue
+        func_dict[name] = [file_name, lineno]
+    return file_info
+
+
+def load_source_bundle(path: str) -> Dict[str, str]:
+    """
+    Return the sources in a source bundle, keyed by the sha1 of the content
+    """
+    with open(path, encoding="utf-8") as f:
+        bundle = loads(f.read())
+    if bundle.get("version") != SOURCE_BUNDLE_VERSION:
+        raise ValueError(f"Unsupported source bundle version {bundle.get('version')} in {path}")
+    return bundle["sources"]
+
+
+def bundle_file_info(file_info: Dict[str, Any], bundle_path: str) -> Dict[str, Any]:
+    """
+    Move the sources in file_info to the source bundle, a side-car file
+    that keeps every source once by its content, so the traces that share
+    it only keep the hashes. Return the new file_info
+    """
+    sources: Dict[str, str] = {}
+    if os.path.exists(bundle_path):
+        sources = load_source_bundle(bundle_path)
+    hashes: Dict[str, str] = {}
+    added = False
+    for file_name, (content, _) in file_info["files"].items():
+        digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        hashes[file_name] = digest
+        if digest not in sources:
+            sources[digest] = content
+            added = True
+    if added or not os.path.exists(bundle_path):
+        # Replace the bundle at once, a trace could be reading it
+        tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(dumps({"version": SOURCE_BUNDLE_VERSION, "sources": sources}))
+        os.replace(tmp_path, bundle_path)
+    return {
+        "files": {},
+        "functions": file_info["functions"],
+        "source_bundle": {"path": os.path.abspath(bundle_path), "files": hashes}
+    }
+
+
+def resolve_source_bundle(file_info: Dict[str, Any], trace_path: str) -> Dict[str, Any]:
+    """
+    Fill the sources of a file_info that refers to a source bundle. The
+    bundle is looked up next to the trace if it was moved
+    """
+    bundle = file_info.get("source_bundle")
+    if not bundle:
+        return file_info
+    bundle_path = bundle["path"]
+    if not os.path.exists(bundle_path):
+        bundle_path = os.path.join(os.path.dirname(os.path.abspath(trace_path)), os.path.basename(bundle_path))
+    try:
+        sources = load_source_bundle(bundle_path)
+    except (OSError, ValueError):
+        color_print("WARNING", f"Unable to load the source bundle {bundle['path']}, the source code is not available")
+        return file_info
+    files = dict(file_info.get("files", {}))
+    for file_name, digest in bundle["files"].items():
+        if digest in sources:
+            content = sources[digest]
+            files[file_name] = [content, content.count("\n")]
+    file_info = {key: value for key, value in file_info.items() if key != "source_bundle"}
+    file_info["files"] = files
+    return file_info
+
+
+def print_save_banner() -> None:
+    print("==================================================")
+    print("== Starting from version 0.13.0, VizTracer will ==")
+    print("== use json as the default report file. You can ==")
+    print('== generate HTML report with "-o result.html"   ==')
+    print("==================================================")
+
+
+def print_save_hint(output_file: str) -> None:
+    print("Saving report to {} ...".format(os.path.abspath(output_file)))
+    print('Use', end=" ")
+    color_print("OKGREEN", '"vizviewer <your_report>"', end=" ")
+    print('to open the report')
+
+
+def get_html_template() -> Tuple[str, str]:
+    """
+    Return the html report before and after the json data
+    """
+    with open(os.path.join(os.path.dirname(__file__), "html/trace_viewer_embedder.html"), encoding="utf-8") as f:
+        tmpl = f.read()
+    with open(os.path.join(os.path.dirname(__file__), "html/trace_viewer_full.html"), encoding="utf-8") as f:
+        trace_viewer_full = f.read()
+    prefix, suffix = tmpl.split("$json_data", 1)
+    return Template(prefix).substitute(trace_viewer_full=trace_viewer_full), Template(suffix).substitute()
+
+
+class ChunkedJsonWriter:
+    """
+    Write a report to a file piece by piece, so the json of the whole
+    report never exists in memory. The events are written first, in
+    chunks, and then everything else in the report
+    """
+    def __init__(self, output_file: TextIO, escape_script: bool = False):
+        self.output_file = output_file
+        # In html, the json is in a <script>
+        self.escape_script = escape_script
+        self.empty = True
+        # Match the separators of dumps()
+        self.item_sep, self.key_sep = (",", ":") if "orjson" in sys.modules else (", ", ": ")
+        output_file.write(f'{{"traceEvents"{self.key_sep}[')
+
+    def write(self, data: str) -> None:
+        if self.escape_script:
+            data = data.replace("</script>", "<\\/script>")
+        self.output_file.write(data)
+
+    def write_events_json(self, events_json: str) -> None:
+        """
+        Write the json of a list of events without the brackets
+        """
+        if not events_json:
+            return
+        if not self.empty:
+            self.output_file.write(self.item_sep)
+        self.write(events_json)
+        self.empty = False
+
+    def write_events(self, events: List[Dict[str, Any]]) -> None:
+        self.write_events_json(dumps(events)[1:-1])
+
+    def finish(self, rest: Dict[str, Any]) -> None:
+        self.output_file.write("]")
+        for key, value in rest.items():
+            self.output_file.write(f"{self.item_sep}{dumps(key)}{self.key_sep}")
+            self.write(dumps(value))
+        self.output_file.write("}")
+
+
 class ReportBuilder:
     def __init__(
             self,
             data: Union[Sequence[str], Dict],
             verbose: int = 1,
             align: bool = False,
-            minimize_memory: bool = False):
+            minimize_memory: bool = False,
+            source_bundle: Optional[str] = None,
+            functions: Optional[Dict[str, Optional[Tuple[str, int]]]] = None):
         self.verbose = verbose
         self.combined_json: Dict = {}
         self.entry_number_threshold = 4000000
         self.align = align
         self.minimize_memory = minimize_memory
+        self.source_bundle = source_bundle
+        # The functions in the events, like Tracer.functions, so they
+        # don't have to be collected from the events for file_info
+        self.functions = functions
         if isinstance(data, dict):
             self.jsons = [get_json(data)]
         elif isinstance(data, (list, tuple)):
@@ -60,15 +310,46 @@ class ReportBuilder:
             return
         if not self.jsons:
             raise ValueError("Can't get report of nothing")
+        self.jsons = [self.convert_to_us(one) for one in self.jsons]
         if self.align:
             for one in self.jsons:
                 self.align_events(one["traceEvents"])
-        self.combined_json = self.jsons[0]
-        for one in self.jsons[1:]:
-            if "traceEvents" in one:
-                self.combined_json["traceEvents"].extend(one["traceEvents"])
+        # The data could be VizTracer.data, keys are added to the combined
+        # json, so don't change the original one
+        self.combined_json = dict(self.jsons[0])
+        if len(self.jsons) > 1:
+            events = list(self.combined_json["traceEvents"])
+            for one in self.jsons[1:]:
+                if "traceEvents" in one:
+                    events.extend(one["traceEvents"])
+            self.combined_json["traceEvents"] = events
+
+    @staticmethod
+    def convert_to_us(one: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        The report is always in us. Return the trace with integer
+        timestamps in ns, like VizTracer.data with integer_ts, in us.
+        The events with timestamps are copied, the trace is not changed
+        """
+        metadata = one.get("viztracer_metadata", {})
+        if metadata.get("ts_unit") != "ns":
+            return one
+        events = []
+        for event in one["traceEvents"]:
+            if "ts" in event or "dur" in event:
+                event = event.copy()
+                if "ts" in event:
+                    event["ts"] /= 1000
+                if "dur" in event:
+                    event["dur"] /= 1000
+            events.append(event)
+        converted = dict(one)
+        converted["traceEvents"] = events
+        converted["viztracer_metadata"] = {key: value for key, value in metadata.items() if key != "ts_unit"}
+        return converted
 
-    def align_events(self, original_events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    @staticmethod
+    def align_events(original_events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
         Apply an offset to all the trace events, making the start timestamp 0
         This is useful when comparing multiple runs of the same script
@@ -92,63 +373,42 @@ class ReportBuilder:
             self.combined_json["displayTimeUnit"] = display_time_unit
 
         if file_info:
-            self.combined_json["file_info"] = {"files": {}, "functions": {}}
-            pattern = re.compile(r".*\((.*):([0-9]*)\)")
-            file_dict = self.combined_json["file_info"]["files"]
-            func_dict = self.combined_json["file_info"]["functions"]
-            for event in self.combined_json["traceEvents"]:
-                if event["ph"] == 'X':
-                    if event["name"] not in func_dict:
-                        try:
-                            m = pattern.match(event["name"])
-                            if m is not None:
-                                file_name = m.group(1)
-                                lineno = int(m.group(2))
-                                if file_name not in file_dict:
-                                    with open(file_name, "r", encoding="utf-8") as f:
-                                        content = f.read()
-                                        file_dict[file_name] = [content, content.count("\n")]
-                                func_dict[event["name"]] = [file_name, lineno]
-                        except Exception:
-                            pass
+            if self.functions is not None and len(self.jsons) == 1:
+                info = get_file_info(self.functions)
+            else:
+                info = get_file_info(
+                    event["name"] for event in self.combined_json["traceEvents"] if event["ph"] == "X"
+                )
+            if self.source_bundle is not None:
+                info = bundle_file_info(info, self.source_bundle)
+            self.combined_json["file_info"] = info
+
+    def write_json(self, output_file: TextIO, escape_script: bool = False) -> None:
+        writer = ChunkedJsonWriter(output_file, escape_script=escape_script)
+        events = self.combined_json["traceEvents"]
+        chunk_size = 1000 if self.minimize_memory else 10000
+        for start in range(0, len(events), chunk_size):
+            writer.write_events(events[start:start + chunk_size])
+        writer.finish({key: value for key, value in self.combined_json.items() if key != "traceEvents"})
 
     def generate_report(
             self,
             output_file: TextIO,
             output_format: str,
             file_info: bool = True) -> None:
-        sub = {}
         if output_format == "html":
             self.prepare_json(file_info=file_info, display_time_unit="ns")
-            with open(os.path.join(os.path.dirname(__file__), "html/trace_viewer_embedder.html"), encoding="utf-8") as f:
-                tmpl = f.read()
-            with open(os.path.join(os.path.dirname(__file__), "html/trace_viewer_full.html"), encoding="utf-8") as f:
-                sub["trace_viewer_full"] = f.read()
-            if "orjson" in sys.modules:
-                sub["json_data"] = orjson.dumps(self.combined_json) \
-                                         .decode("utf-8") \
-                                         .replace("</script>", "<\\/script>")
-            else:
-                sub["json_data"] = json.dumps(self.combined_json) \
-                                       .replace("</script>", "<\\/script>")
-            output_file.write(Template(tmpl).substitute(sub))
+            prefix, suffix = get_html_template()
+            output_file.write(prefix)
+            self.write_json(output_file, escape_script=True)
+            output_file.write(suffix)
         elif output_format == "json":
             self.prepare_json(file_info=file_info)
-            if "orjson" in sys.modules:
-                output_file.write(orjson.dumps(self.combined_json).decode("utf-8"))
-            else:
-                if self.minimize_memory:
-                    json.dump(self.combined_json, output_file)  # type: ignore
-                else:
-                    output_file.write(json.dumps(self.combined_json))
+            self.write_json(output_file)
 
     def save(self, output_file: Union[str, TextIO] = "result.html", file_info: bool = True) -> None:
         if self.verbose > 0:
-            print("==================================================")
-            print("== Starting from version 0.13.0, VizTracer will ==")
-            print("== use json as the default report file. You can ==")
-            print('== generate HTML report with "-o result.html"   ==')
-            print("==================================================")
+            print_save_banner()
 
         if isinstance(output_file, str):
             file_type = output_file.split(".")[-1]
@@ -159,16 +419,200 @@ class ReportBuilder:
             elif file_type == "json":
                 with open(output_file, "w", encoding="utf-8") as f:
                     self.generate_report(f, output_format="json", file_info=file_info)
-            elif file_type == "gz":
-                with gzip.open(output_file, "wt") as f:
+            elif is_compressed(output_file):
+                with open_compressed(output_file, "wt") as f:
                     self.generate_report(f, output_format="json", file_info=file_info)
             else:
-                raise Exception("Only html, json and gz are supported")
+                raise Exception("Only html, json, gz, zst and lz4 are supported")
         else:
             self.generate_report(output_file, output_format="json", file_info=file_info)
 
         if self.verbose > 0 and isinstance(output_file, str):
-            print("Saving report to {} ...".format(os.path.abspath(output_file)))
-            print('Use', end=" ")
-            color_print("OKGREEN", '"vizviewer <your_report>"', end=" ")
-            print('to open the report')
+            print_save_hint(output_file)
+
+
+def load_event_chunks(path: str, align: bool, chunk_size: int) -> Iterator[Tuple[str, Any]]:
+    """
+    Load a report and yield ("events", json of a chunk of its traceEvents
+    without the brackets), then ("done", (the rest of the report, names of
+    the functions, number of events))
+    """
+    data = ReportBuilder.convert_to_us(get_json(path))
+    events = data.pop("traceEvents", [])
+    if align and any("ts" in event for event in events):
+        ReportBuilder.align_events(events)
+    func_names = {event["name"] for event in events if event.get("ph") == "X"}
+    for start in range(0, len(events), chunk_size):
+        yield "events", dumps(events[start:start + chunk_size])[1:-1]
+    yield "done", (data, func_names, len(events))
+
+
+# The queue to send the chunks to the main process, and the index of the
+# report whose turn it is to send, in the workers
+_chunk_queue: Any = None
+_turn: Any = None
+_turn_condition: Any = None
+
+
+def _init_combine_worker(chunk_queue: Any, turn: Any, turn_condition: Any) -> None:
+    global _chunk_queue, _turn, _turn_condition
+    _chunk_queue = chunk_queue
+    _turn = turn
+    _turn_condition = turn_condition
+
+
+def _combine_worker(idx: int, path: str, align: bool, chunk_size: int) -> None:
+    try:
+        chunks = load_event_chunks(path, align, chunk_size)
+        # The report is loaded with the others, but sent in order. The
+        # reports before it are taken by the other workers first, so the
+        # turn always comes
+        first = next(chunks)
+        with _turn_condition:
+            _turn_condition.wait_for(lambda: _turn.value == idx)
+        _chunk_queue.put((idx, *first))
+        for kind, payload in chunks:
+            _chunk_queue.put((idx, kind, payload))
+    except Exception as e:
+        _chunk_queue.put((idx, "error", f"Unable to load {path}: {e!r}"))
+
+
+class StreamingReportBuilder:
+    """
+    Combine the reports in a process pool and write the events to the output
+    as they come. The reports are loaded at the same time but sent one by
+    one, so the events are in the same order as ReportBuilder. Every worker
+    holds one report and the main process only holds a few chunks of
+    events, instead of all the reports at once
+    """
+    def __init__(
+            self,
+            files: Sequence[str],
+            verbose: int = 1,
+            align: bool = False,
+            processes: Optional[int] = None,
+            chunk_size: int = 10000,
+            source_bundle: Optional[str] = None):
+        if not files:
+            raise ValueError("Can't get report of nothing")
+        self.files = list(files)
+        self.verbose = verbose
+        self.align = align
+        self.processes = min(processes or os.cpu_count() or 1, len(self.files))
+        self.chunk_size = chunk_size
+        self.source_bundle = source_bundle
+
+    def iter_chunks(self) -> Iterator[Tuple[int, str, Any]]:
+        if self.processes <= 1:
+            for idx, path in enumerate(self.files):
+                for kind, payload in load_event_chunks(path, self.align, self.chunk_size):
+                    yield idx, kind, payload
+            return
+
+        # A bounded queue keeps the workers from getting too far ahead of us
+        chunk_queue: Any = multiprocessing.Queue(maxsize=self.processes * 2)
+        turn: Any = multiprocessing.RawValue("i", 0)
+        turn_condition = multiprocessing.Condition()
+        other_children = set(multiprocessing.active_children())
+        with multiprocessing.Pool(self.processes, initializer=_init_combine_worker,
+                                  initargs=(chunk_queue, turn, turn_condition)) as pool:
+            # The pool silently replaces a worker that dies, and the task
+            # of the worker is lost, so watch the workers themselves
+            workers = set(multiprocessing.active_children()) - other_children
+            result = pool.starmap_async(
+                _combine_worker,
+                [(idx, path, self.align, self.chunk_size) for idx, path in enumerate(self.files)],
+                chunksize=1
+            )
+            remaining = len(self.files)
+            finished = False
+            while remaining:
+                try:
+                    idx, kind, payload = chunk_queue.get(timeout=1)
+                except queue.Empty:
+                    if not workers <= set(multiprocessing.active_children()):
+                        raise RuntimeError("A worker died while combining the reports")
+                    if finished:
+                        raise RuntimeError("The workers finished without sending all the reports")
+                    if result.ready():
+                        # Raise the error of the workers, if any. Otherwise
+                        # everything is put to the queue, wait once more for
+                        # it to arrive
+                        result.get()
+                        finished = True
+                    continue
+                if kind == "error":
+                    raise ValueError(payload)
+                if kind == "done":
+                    remaining -= 1
+                    # Everything of this report is here, the next one can send
+                    with turn_condition:
+                        turn.value = idx + 1
+                        turn_condition.notify_all()
+                yield idx, kind, payload
+
+    def write_json(
+            self,
+            output_file: TextIO,
+            file_info: bool = True,
+            display_time_unit: Optional[str] = None,
+            escape_script: bool = False) -> None:
+        reports: Dict[int, Dict[str, Any]] = {}
+        func_names: Set[str] = set()
+        entries = 0
+
+        writer = ChunkedJsonWriter(output_file, escape_script=escape_script)
+        for idx, kind, payload in self.iter_chunks():
+            if kind == "events":
+                writer.write_events_json(payload)
+            elif kind == "done":
+                reports[idx], names, count = payload
+                func_names |= names
+                entries += count
+
+        if self.verbose > 0:
+            print(f"Dumping trace data, total entries: {entries}")
+
+        # Like ReportBuilder, everything else comes from the first report
+        rest = reports[0]
+        if display_time_unit is not None:
+            rest["displayTimeUnit"] = display_time_unit
+        if file_info:
+            info = get_file_info(func_names)
+            if self.source_bundle is not None:
+                info = bundle_file_info(info, self.source_bundle)
+            rest["file_info"] = info
+        writer.finish(rest)
+
+    def generate_report(
+            self,
+            output_file: TextIO,
+            output_format: str,
+            file_info: bool = True) -> None:
+        if output_format == "html":
+            prefix, suffix = get_html_template()
+            output_file.write(prefix)
+            self.write_json(output_file, file_info=file_info, display_time_unit="ns", escape_script=True)
+            output_file.write(suffix)
+        elif output_format == "json":
+            self.write_json(output_file, file_info=file_info)
+
+    def save(self, output_file: str = "result.json", file_info: bool = True) -> None:
+        if self.verbose > 0:
+            print_save_banner()
+
+        file_type = output_file.split(".")[-1]
+        if file_type == "html":
+            with open(output_file, "w", encoding="utf-8") as f:
+                self.generate_report(f, output_format="html", file_info=file_info)
+        elif file_type == "json":
+            with open(output_file, "w", encoding="utf-8") as f:
+                self.generate_report(f, output_format="json", file_info=file_info)
+        elif is_compressed(output_file):
+            with open_compressed(output_file, "wt") as f:
+                self.generate_report(f, output_format="json", file_info=file_info)
+        else:
+            raise Exception("Only html, json, gz, zst and lz4 are supported")
+
+        if self.verbose > 0:
+            print_save_hint(output_file)
@@ -4,13 +4,28 @@
 import os
 import builtins
 import gc
+import sys
+import tempfile
 from io import StringIO
-from typing import Any, Dict, Optional, Sequence, Union
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
 from .util import color_print
 from . import __version__
+from . import binary_trace
 import viztracer.snaptrace as snaptrace  # type: ignore
 
 
+# The typecodes of the columns of load_columnar()
+COLUMN_TYPES: Dict[str, Any] = {
+    "ts": "q",
+    "dur": "q",
+    "tid": "Q",
+    "pid": "q",
+    "name_id": "I",
+    "ph": "B",
+    "caller_lineno": "i"
+}
+
+
 class _VizTracer:
     def __init__(
             self,
@@ -27,7 +42,18 @@ class _VizTracer:
             log_async: bool = False,
             trace_self: bool = False,
             min_duration: float = 0,
-            vdb: bool = False):
+            vdb: bool = False,
+            per_thread_buffer: bool = False,
+            spill_to_disk: bool = False,
+            use_monitoring: bool = False,
+            sample_rate: float = 0,
+            call_budget: int = 0,
+            call_sample_ratio: int = 0,
+            collect_stats: bool = False,
+            stats_only: bool = False,
+            clock: str = "monotonic",
+            integer_ts: bool = False,
+            buffer_file: Optional[str] = None):
         self.enable = False
         self.parsed = False
         self._tracer = snaptrace.Tracer(tracer_entries)
@@ -48,8 +74,25 @@ class _VizTracer:
         self.vdb = vdb
         self.trace_self = trace_self
         self.min_duration = min_duration
+        self.per_thread_buffer = per_thread_buffer
+        self.spill_to_disk = spill_to_disk
+        self.use_monitoring = use_monitoring
+        self.sample_rate = sample_rate
+        self.call_budget = call_budget
+        self.call_sample_ratio = call_sample_ratio
+        self.collect_stats = collect_stats
+        self.stats_only = stats_only
+        self.clock = clock
+        self.integer_ts = integer_ts
+        self.buffer_file = buffer_file
+        self._spill_file: Optional[str] = None
+        self._spill_pid = 0
+        self._buffer_file_pid = 0
         self.system_print = builtins.print
         self.total_entries = 0
+        # The name of every function in data to its (file, first line),
+        # None if it's unknown. Set by parse()
+        self.functions: Optional[Dict[str, Optional[Tuple[str, int]]]] = None
         self.gc_start_args: Dict[str, int] = {}
 
     @property
@@ -198,6 +241,129 @@ class _VizTracer:
         else:
             raise ValueError("duration needs to be a float, not {}".format(min_duration))
 
+    @property
+    def per_thread_buffer(self) -> bool:
+        return self.__per_thread_buffer
+
+    @per_thread_buffer.setter
+    def per_thread_buffer(self, per_thread_buffer: bool):
+        if isinstance(per_thread_buffer, bool):
+            self.__per_thread_buffer = per_thread_buffer
+        else:
+            raise ValueError("per_thread_buffer needs to be True or False, not {}".format(per_thread_buffer))
+
+    @property
+    def spill_to_disk(self) -> bool:
+        return self.__spill_to_disk
+
+    @spill_to_disk.setter
+    def spill_to_disk(self, spill_to_disk: bool):
+        if isinstance(spill_to_disk, bool):
+            self.__spill_to_disk = spill_to_disk
+        else:
+            raise ValueError("spill_to_disk needs to be True or False, not {}".format(spill_to_disk))
+
+    @property
+    def use_monitoring(self) -> bool:
+        return self.__use_monitoring
+
+    @use_monitoring.setter
+    def use_monitoring(self, use_monitoring: bool):
+        if isinstance(use_monitoring, bool):
+            if use_monitoring and sys.version_info < (3, 12):
+                raise ValueError("use_monitoring requires sys.monitoring, which is only available on Python 3.12+")
+            self.__use_monitoring = use_monitoring
+        else:
+            raise ValueError("use_monitoring needs to be True or False, not {}".format(use_monitoring))
+
+    @property
+    def sample_rate(self) -> float:
+        return self.__sample_rate
+
+    @sample_rate.setter
+    def sample_rate(self, sample_rate: float):
+        if isinstance(sample_rate, (int, float)) and not isinstance(sample_rate, bool) and sample_rate >= 0:
+            self.__sample_rate = sample_rate
+        else:
+            raise ValueError("sample_rate needs to be a non-negative number, not {}".format(sample_rate))
+
+    @property
+    def call_budget(self) -> int:
+        return self.__call_budget
+
+    @call_budget.setter
+    def call_budget(self, call_budget: int):
+        if isinstance(call_budget, int) and not isinstance(call_budget, bool) and call_budget >= 0:
+            self.__call_budget = call_budget
+        else:
+            raise ValueError("call_budget needs to be a non-negative integer, not {}".format(call_budget))
+
+    @property
+    def call_sample_ratio(self) -> int:
+        return self.__call_sample_ratio
+
+    @call_sample_ratio.setter
+    def call_sample_ratio(self, call_sample_ratio: int):
+        if isinstance(call_sample_ratio, int) and not isinstance(call_sample_ratio, bool) and call_sample_ratio >= 0:
+            self.__call_sample_ratio = call_sample_ratio
+        else:
+            raise ValueError("call_sample_ratio needs to be a non-negative integer, not {}".format(call_sample_ratio))
+
+    @property
+    def collect_stats(self) -> bool:
+        return self.__collect_stats
+
+    @collect_stats.setter
+    def collect_stats(self, collect_stats: bool):
+        if isinstance(collect_stats, bool):
+            self.__collect_stats = collect_stats
+        else:
+            raise ValueError("collect_stats needs to be a boolean, not {}".format(collect_stats))
+
+    @property
+    def stats_only(self) -> bool:
+        return self.__stats_only
+
+    @stats_only.setter
+    def stats_only(self, stats_only: bool):
+        if isinstance(stats_only, bool):
+            self.__stats_only = stats_only
+        else:
+            raise ValueError("stats_only needs to be a boolean, not {}".format(stats_only))
+
+    @property
+    def clock(self) -> str:
+        return self.__clock
+
+    @clock.setter
+    def clock(self, clock: str):
+        if clock in ("monotonic", "monotonic_raw", "tsc"):
+            self.__clock = clock
+        else:
+            raise ValueError("clock needs to be one of monotonic, monotonic_raw or tsc, not {}".format(clock))
+
+    @property
+    def buffer_file(self) -> Optional[str]:
+        return self.__buffer_file
+
+    @buffer_file.setter
+    def buffer_file(self, buffer_file: Optional[str]):
+        if buffer_file is None or isinstance(buffer_file, str):
+            self.__buffer_file = buffer_file
+        else:
+            raise ValueError("buffer_file needs to be a path or None, not {}".format(buffer_file))
+
+    @property
+    def integer_ts(self) -> bool:
+        return self.__integer_ts
+
+    @integer_ts.setter
+    def integer_ts(self, integer_ts: bool):
+        if isinstance(integer_ts, bool):
+            self.__integer_ts = integer_ts
+        else:
+            raise ValueError("integer_ts needs to be a boolean, not {}".format(integer_ts))
+
     def start(self):
         self.enable = True
         self.parsed = False
@@ -205,6 +371,10 @@ class _VizTracer:
             self.overload_print()
         if self.include_files is not None and self.exclude_files is not None:
             raise Exception("include_files and exclude_files can't be both specified!")
+        if self.sample_rate and self.use_monitoring:
+            raise Exception("sample_rate and use_monitoring can't be both specified!")
+        if self.buffer_file is not None and self.per_thread_buffer:
+            raise Exception("buffer_file and per_thread_buffer can't be both specified!")
         self._tracer.config(
             verbose=self.verbose,
             lib_file_path=os.path.dirname(os.path.realpath(__file__)),
@@ -218,8 +388,18 @@ class _VizTracer:
             log_func_args=self.log_func_args,
             log_async=self.log_async,
             trace_self=self.trace_self,
-            min_duration=self.min_duration
+            min_duration=self.min_duration,
+            per_thread_buffer=self.per_thread_buffer,
+            use_monitoring=self.use_monitoring,
+            sample_rate=self.sample_rate,
+            call_budget=self.call_budget,
+            call_sample_ratio=self.call_sample_ratio,
+            collect_stats=self.collect_stats,
+            stats_only=self.stats_only,
+            clock=self.clock
         )
+        self._tracer.setspill(self._open_spill() if self.spill_to_disk else None)
+        self._tracer.setbufferfile(self._get_buffer_file())
         self._tracer.start()
 
     def stop(self):
@@ -238,10 +418,25 @@ class _VizTracer:
 
     def clear(self):
         self._tracer.clear()
+        spill_file = self._close_spill()
+        if spill_file is not None:
+            os.remove(spill_file)
+        if self.enable and self.spill_to_disk:
+            self._tracer.setspill(self._open_spill())
+        # A forked child loses the buffer file of its parent and gets
+        # its own here
+        self._tracer.setbufferfile(self._get_buffer_file())
 
     def cleanup(self):
         self._tracer.cleanup()
 
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Return the call count and the total, self, min and max duration(us)
+        of every function since the last clear(), with collect_stats
+        """
+        return self._tracer.getstats()
+
     def getts(self) -> float:
         return self._tracer.getts()
 
@@ -313,26 +508,74 @@ class _VizTracer:
     def _set_curr_stack_depth(self, stack_depth: int):
         self._tracer.setcurrstack(stack_depth)
 
+    def _open_spill(self) -> str:
+        # Every process needs its own spill file, a forked child can't
+        # share the one of its parent
+        if self._spill_file is None or self._spill_pid != os.getpid():
+            fd, self._spill_file = tempfile.mkstemp(prefix="viztracer_spill_", suffix=binary_trace.EXTENSION)
+            os.close(fd)
+            self._spill_pid = os.getpid()
+        return self._spill_file
+
+    def _get_buffer_file(self) -> Optional[str]:
+        if self.buffer_file is None:
+            return None
+        if "{pid}" in self.buffer_file:
+            return self.buffer_file.replace("{pid}", str(os.getpid()))
+        # Without {pid} in the path, the file belongs to the first process
+        # that uses it, the others can't share it
+        if self._buffer_file_pid == 0:
+            self._buffer_file_pid = os.getpid()
+        elif self._buffer_file_pid != os.getpid():
+            return None
+        return self.buffer_file
+
+    def _close_spill(self) -> Optional[str]:
+        """
+        Stop spilling and return the path of the spill file if there's one.
+        The caller owns the file after this
+        """
+        spill_file = self._spill_file
+        self._spill_file = None
+        self._tracer.setspill(None)
+        if spill_file is None or self._spill_pid != os.getpid():
+            return None
+        return spill_file
+
     def parse(self) -> int:
         # parse() is also performance sensitive. We could have a lot of entries
         # in buffer, so try not to add any overhead when parsing
         # We parse the buffer into Chrome Trace Event Format
         self.stop()
         if not self.parsed:
+            spill_file = self._close_spill()
+            events, self.functions = self._tracer.load(self.integer_ts, True)
             self.data = {
-                "traceEvents": self._tracer.load(),
+                "traceEvents": events,
                 "viztracer_metadata": {
                     "version": __version__
                 }
             }
+            if self.integer_ts:
+                self.data["viztracer_metadata"]["ts_unit"] = "ns"
+            if self.collect_stats or self.stats_only:
+                self.data["viztracer_stats"] = self.get_stats()
             metadata_count = 0
             for d in self.data["traceEvents"]:
                 if d["ph"] == "M":
                     metadata_count += 1
                 else:
                     break
+            if spill_file is not None:
+                # Spilled events are older than everything in the buffer
+                spilled_events = binary_trace.load(spill_file, self.integer_ts)["traceEvents"]
+                os.remove(spill_file)
+                self.data["traceEvents"][metadata_count:metadata_count] = spilled_events
+                for event in spilled_events:
+                    if event["ph"] == "X":
+                        self.functions.setdefault(event["name"], None)
             self.total_entries = len(self.data["traceEvents"]) - metadata_count
-            if self.total_entries == self.tracer_entries and self.verbose > 0:
+            if self.total_entries == self.tracer_entries and spill_file is None and self.verbose > 0:
                 print("")
                 color_print("WARNING", ("Circular buffer is full, you lost some early data, "
                                         "but you still have the most recent data."))
@@ -345,6 +588,26 @@ class _VizTracer:
 
         return self.total_entries
 
+    def load_columnar(self) -> Dict[str, Any]:
+        """
+        Load the buffer to columns, one row per event, instead of a dict for
+        every event like parse(). The buffer is empty afterwards.
+
+        ts, dur(int ns), tid, pid, name_id, ph(the code of the character)
+        and caller_lineno(-1 if unavailable) are typed memoryviews, which
+        numpy.asarray() can use without a copy. The name of an event is
+        names[name_id]. extras is a dict from the row to the rest of the
+        event, like args, if it has any. events are the metadata events and
+        the counters of the dropped calls, like parse() returns them
+        """
+        if self.spill_to_disk:
+            raise ValueError("load_columnar() can't load the events spilled to disk, use parse()")
+        self.stop()
+        result = self._tracer.loadcolumnar()
+        for key, typecode in COLUMN_TYPES.items():
+            result[key] = memoryview(result[key]).cast(typecode)
+        return result
+
     def overload_print(self):
         self.system_print = builtins.print
 
@@ -6,11 +6,14 @@ import functools
 import http.server
 import json
 import os
+import shutil
 import socketserver
 import sys
 from typing import Any, Callable, Dict, List, Optional
 
+from .compression import is_compressed, open_compressed
 from .flamegraph import FlameGraph
+from .report_builder import resolve_source_bundle
 
 
 class HttpHandler(http.server.SimpleHTTPRequestHandler):
@@ -53,6 +56,16 @@ class PerfettoHandler(HttpHandler):
             self.end_headers()
             self.wfile.write(json.dumps(self.file_info).encode("utf-8"))
             self.wfile.flush()
+        elif self.path.endswith("localtrace") and is_compressed(self.tracefile_path):
+            # Decompress on the fly, the trace could be much larger than
+            # the compressed file
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            with open_compressed(self.tracefile_path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+            self.wfile.flush()
+            self.server.trace_served = True
         elif self.path.endswith("localtrace"):
             # self.directory is used after 3.8
             # os.getcwd() is used on 3.6
@@ -88,6 +101,14 @@ class HtmlHandler(HttpHandler):
         return super().do_GET()
 
 
+def load_trace(filename: str) -> Dict[str, Any]:
+    if is_compressed(filename):
+        with open_compressed(filename, "rt") as f:
+            return json.load(f)
+    with open(filename) as f:
+        return json.load(f)
+
+
 def view(path: str, server_only: bool = False, once: bool = False, flamegraph: bool = False) -> int:
     # For official perfetto, only localhost:9001 is allowed
     port = 9001
@@ -98,20 +119,17 @@ def view(path: str, server_only: bool = False, once: bool = False, flamegraph: b
 
     Handler: Callable[..., HttpHandler]
     if flamegraph:
-        if filename.endswith("json"):
-            with open(filename) as f:
-                trace_data = json.load(f)
+        if filename.endswith("json") or is_compressed(filename):
+            trace_data = load_trace(filename)
             fg = FlameGraph(trace_data)
             fg_data = fg.dump_to_perfetto()
             Handler = functools.partial(PerfettoHandler, None, path, fg_data)
         else:
             print(f"Do not support flamegraph for file type {filename}")
             return 1
-    elif filename.endswith("json"):
-        trace_data = None
-        with open(filename) as f:
-            trace_data = json.load(f)
-            file_info = trace_data.get("file_info", {})
+    elif filename.endswith("json") or is_compressed(filename):
+        trace_data = load_trace(filename)
+        file_info = resolve_source_bundle(trace_data.get("file_info", {}), path)
         Handler = functools.partial(PerfettoHandler, file_info, path, None)
     elif filename.endswith("html"):
         Handler = functools.partial(HtmlHandler, path)
@@ -143,7 +161,7 @@ def view(path: str, server_only: bool = False, once: bool = False, flamegraph: b
 
 def viewer_main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("file", nargs=1, help="html/json/gz file to open")
+    parser.add_argument("file", nargs=1, help="html/json/gz/zst/lz4 file to open")
     parser.add_argument("--server_only", "-s", default=False, action="store_true",
                         help="Only start the server, do not open webpage")
     parser.add_argument("--once", default=False, action="store_true",
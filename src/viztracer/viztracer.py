@@ -4,14 +4,17 @@
 import os
 import multiprocessing
 import builtins
+import shutil
 import signal
 import sys
 from typing import Any, Callable, Dict, Optional, Sequence, Tuple, Union
+from . import binary_trace
 from .tracer import _VizTracer
 from .flamegraph import FlameGraph
 from .report_builder import ReportBuilder
 from .vizplugin import VizPluginBase, VizPluginManager
 from .vizevent import VizEvent
+from .util import color_print
 
 
 # This is the interface of the package. Almost all user should use this
@@ -37,6 +40,18 @@ class VizTracer(_VizTracer):
                  register_global: bool = True,
                  trace_self: bool = False,
                  min_duration: float = 0,
+                 per_thread_buffer: bool = False,
+                 spill_to_disk: bool = False,
+                 use_monitoring: bool = False,
+                 sample_rate: float = 0,
+                 call_budget: int = 0,
+                 call_sample_ratio: int = 0,
+                 collect_stats: bool = False,
+                 stats_only: bool = False,
+                 clock: str = "monotonic",
+                 integer_ts: bool = False,
+                 buffer_file: Optional[str] = None,
+                 source_bundle: Optional[str] = None,
                  output_file: str = "result.json",
                  plugins: Sequence[Union[VizPluginBase, str]] = []):
         super().__init__(
@@ -53,12 +68,24 @@ class VizTracer(_VizTracer):
             log_func_args=log_func_args,
             log_async=log_async,
             trace_self=trace_self,
-            min_duration=min_duration
+            min_duration=min_duration,
+            per_thread_buffer=per_thread_buffer,
+            spill_to_disk=spill_to_disk,
+            use_monitoring=use_monitoring,
+            sample_rate=sample_rate,
+            call_budget=call_budget,
+            call_sample_ratio=call_sample_ratio,
+            collect_stats=collect_stats,
+            stats_only=stats_only,
+            clock=clock,
+            integer_ts=integer_ts,
+            buffer_file=buffer_file
         )
         self._tracer: Any
         self.verbose = verbose
         self.pid_suffix = pid_suffix
         self.file_info = file_info
+        self.source_bundle = source_bundle
         self.output_file = output_file
         self.system_print = None
         self.log_sparse = log_sparse
@@ -148,8 +175,6 @@ class VizTracer(_VizTracer):
         if self.enable:
             enabled = True
             self.stop()
-        if not self.parsed:
-            self.parse()
         if output_file is None:
             output_file = self.output_file
         if self.pid_suffix:
@@ -157,6 +182,16 @@ class VizTracer(_VizTracer):
             output_file_parts[-2] = output_file_parts[-2] + "_" + str(os.getpid())
             output_file = ".".join(output_file_parts)
 
+        # The binary format can be written straight from the buffer, unless
+        # the plugins or the flamegraph need the parsed data or it's already
+        # parsed
+        binary_output = isinstance(output_file, str) and binary_trace.is_binary_trace(output_file)
+        direct_dump = (binary_output and not self.parsed and not save_flamegraph
+                       and not self._plugin_manager.has_plugin)
+
+        if not self.parsed and not direct_dump:
+            self.parse()
+
         self._plugin_manager.event("pre-save")
 
         if isinstance(output_file, str):
@@ -164,8 +199,29 @@ class VizTracer(_VizTracer):
             if not os.path.isdir(os.path.dirname(output_file)):
                 os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-        rb = ReportBuilder(self.data, self.verbose, minimize_memory=minimize_memory)
-        rb.save(output_file=output_file, file_info=file_info)
+        if binary_output:
+            if direct_dump:
+                spill_file = self._close_spill()
+                if spill_file is not None:
+                    # The spill file is a binary trace already, append the rest to it
+                    shutil.move(spill_file, output_file)
+                    self._tracer.dump(output_file, True)
+                else:
+                    self._tracer.dump(output_file)
+            else:
+                binary_trace.dump(self.data, output_file)
+            if self.verbose > 0:
+                print("Saving binary trace to {} ...".format(output_file))
+                print('Use', end=" ")
+                color_print("OKGREEN", '"viztracer --combine {} -o result.json"'.format(output_file), end=" ")
+                print('to convert it to json')
+        else:
+            # The plugins could change the data, then the functions in it
+            # are not known anymore
+            functions = None if self._plugin_manager.has_plugin else self.functions
+            rb = ReportBuilder(self.data, self.verbose, minimize_memory=minimize_memory,
+                               source_bundle=self.source_bundle, functions=functions)
+            rb.save(output_file=output_file, file_info=file_info)
 
         if save_flamegraph:
             self.save_flamegraph(".".join(output_file.split(".")[:-1]) + "_flamegraph.html")
@@ -199,7 +255,9 @@ class VizTracer(_VizTracer):
         return p
 
     def save_flamegraph(self, output_file: Optional[str] = None):
-        flamegraph = FlameGraph(self.data)
+        # The processes of a pool would be traced as the children of this
+        # process with log_multiprocess, build the flamegraph here
+        flamegraph = FlameGraph(self.data, processes=1)
         if output_file is None:
             name_list = self.output_file.split(".")
             output_file = ".".join(name_list[:-1]) + "_flamegraph.html"
@@ -11,6 +11,7 @@ import tempfile
 import time
 from viztracer.tracer import _VizTracer
 from viztracer import VizTracer, ignore_function, trace_and_save, get_tracer
+from viztracer.report_builder import get_json
 from .base_tmpl import BaseTmpl
 
 
@@ -97,6 +98,34 @@ class TestVizTracerBasic(BaseTmpl):
 
         shutil.rmtree("./tmp")
 
+    def test_save_binary(self):
+        def f(a, b):
+            tracer.add_func_args("a", a)
+            return fib(a) + fib(b)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracer = VizTracer(verbose=0)
+            tracer.start()
+            f(5, 3)
+            tracer.stop()
+            tracer.save(os.path.join(tmpdir, "result.vtb"))
+            events = get_json(os.path.join(tmpdir, "result.vtb"))["traceEvents"]
+
+            tracer.start()
+            f(5, 3)
+            tracer.stop()
+            tracer.parse()
+            expected = tracer.data["traceEvents"]
+            self.assertEqual(len(events), len(expected))
+            fee_events = sorted((e for e in events if e["ph"] == "X"), key=lambda e: e["ts"])
+            expected_fee_events = sorted((e for e in expected if e["ph"] == "X"), key=lambda e: e["ts"])
+            self.assertEqual([e["name"] for e in fee_events], [e["name"] for e in expected_fee_events])
+            self.assertEqual([e.get("args") for e in fee_events], [e.get("args") for e in expected_fee_events])
+
+            # Parsed data goes through the python writer
+            tracer.save(os.path.join(tmpdir, "parsed.vtb"))
+            events = get_json(os.path.join(tmpdir, "parsed.vtb"))["traceEvents"]
+            self.assertEqual(events, expected)
+
     def test_save_flamegraph(self):
         tracer = VizTracer(tracer_entries=10)
         tracer.start()
@@ -107,6 +136,18 @@ class TestVizTracerBasic(BaseTmpl):
         self.assertTrue(os.path.exists("result_flamegraph.html"))
         os.remove("result_flamegraph.html")
 
+    def test_save_binary_flamegraph(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracer = VizTracer(verbose=0)
+            tracer.start()
+            fib(5)
+            tracer.stop()
+            tracer.save(os.path.join(tmpdir, "result.vtb"), save_flamegraph=True)
+            events = get_json(os.path.join(tmpdir, "result.vtb"))["traceEvents"]
+            self.assertTrue(any("fib" in e["name"] for e in events if e["ph"] == "X"))
+            with open(os.path.join(tmpdir, "result_flamegraph.html")) as f:
+                self.assertIn("fib", f.read())
+
 
 class TestInstant(BaseTmpl):
     def test_addinstant(self):
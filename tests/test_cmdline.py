@@ -240,10 +240,54 @@ class TestCommandLineBasic(CmdlineTmpl):
                        os.path.join(example_json_dir, "different_sorts.json")],
                       expected_output_file="result.json")
 
+    def test_binary_output(self):
+        self.template(["python", "-m", "viztracer", "-o", "result.vtb", "cmdline_test.py"],
+                      expected_output_file="result.vtb", cleanup=False)
+        self.template(["python", "-m", "viztracer", "--combine", "result.vtb"],
+                      script=None, expected_output_file="result.json", expected_entries=17)
+        os.remove("result.vtb")
+
+    def test_source_bundle(self):
+        def check_func(data):
+            file_info = data["file_info"]
+            self.assertEqual(file_info["files"], {})
+            self.assertTrue(os.path.exists(file_info["source_bundle"]["path"]))
+            self.assertIn(os.path.abspath("cmdline_test.py"), file_info["source_bundle"]["files"])
+
+        self.template(["python", "-m", "viztracer", "--source_bundle", "sources.json", "cmdline_test.py"],
+                      check_func=check_func)
+        os.remove("sources.json")
+
     def test_tracer_entries(self):
         self.template(["python", "-m", "viztracer", "--tracer_entries", "1000", "cmdline_test.py"])
         self.template(["python", "-m", "viztracer", "--tracer_entries", "50", "cmdline_test.py"])
 
+    def test_per_thread_buffer(self):
+        self.template(["python", "-m", "viztracer", "--per_thread_buffer", "cmdline_test.py"])
+
+    def test_spill_to_disk(self):
+        self.template(["python", "-m", "viztracer", "--tracer_entries", "5", "--spill_to_disk", "cmdline_test.py"],
+                      expected_entries=17)
+
+    def test_sample_rate(self):
+        self.template(["python", "-m", "viztracer", "--sample_rate", "1000", "cmdline_test.py"])
+
+    def test_collect_stats(self):
+        def check_func(data):
+            self.assertTrue(any(name.startswith("fib") for name in data["viztracer_stats"]))
+
+        def check_func_stats_only(data):
+            check_func(data)
+            self.assertFalse(any(event["ph"] == "X" for event in data["traceEvents"]))
+
+        self.template(["python", "-m", "viztracer", "--collect_stats", "cmdline_test.py"], check_func=check_func)
+        self.template(["python", "-m", "viztracer", "--stats_only", "cmdline_test.py"], check_func=check_func_stats_only)
+
+    def test_clock(self):
+        if sys.platform != "win32":
+            self.template(["python", "-m", "viztracer", "--clock", "monotonic_raw", "cmdline_test.py"])
+        self.template(["python", "-m", "viztracer", "--clock", "hello", "cmdline_test.py"], success=False)
+
     def test_trace_self(self):
         def check_func(data):
             self.assertGreater(len(data["traceEvents"]), 10000)
@@ -3,6 +3,8 @@
 
 import json
 from viztracer import FlameGraph
+from viztracer.flamegraph import _FlameTree
+from viztracer.functree import FuncTree
 import os
 from .base_tmpl import BaseTmpl
 
@@ -57,3 +59,79 @@ class TestFlameGraph(BaseTmpl):
         self.assertEqual(len(fg.trees), 6)
         data = fg.dump_to_perfetto()
         self.assertEqual(len(data), 5)
+
+    def test_integer_ts(self):
+        with open(os.path.join(os.path.dirname(__file__), "data/multithread.json")) as f:
+            sample_data = json.loads(f.read())
+        fg = FlameGraph(sample_data)
+        for event in sample_data["traceEvents"]:
+            for key in ("ts", "dur"):
+                if key in event:
+                    event[key] = round(event[key] * 1000)
+        sample_data["viztracer_metadata"] = {"ts_unit": "ns"}
+        fg_ns = FlameGraph(sample_data)
+        for key, tree in fg.trees.items():
+            self.assertAlmostEqual(tree.json()["children"][0]["value"],
+                                   fg_ns.trees[key].json(fg_ns.ts_scale)["children"][0]["value"], places=2)
+
+    def test_functree(self):
+        with open(os.path.join(os.path.dirname(__file__), "data/multithread.json")) as f:
+            sample_data = json.loads(f.read())
+        threads = {}
+        for event in sample_data["traceEvents"]:
+            if event["ph"] == "X":
+                threads.setdefault((event["pid"], event["tid"]), []).append(event)
+        for (pid, tid), events in threads.items():
+            tree = FuncTree(pid, tid)
+            for event in events:
+                tree.add_event(event)
+            fast_tree = FuncTree(pid, tid)
+            fast_tree.add_events(events)
+            self.assertTrue(tree.is_same(fast_tree))
+            self.assertEqual(fast_tree.first_ts(), min(event["ts"] for event in events))
+            for node in fast_tree.inorder_traverse():
+                self.assertIsInstance(node.children, list)
+                if node.is_python:
+                    # The nodes of the same function share the parsed name
+                    self.assertIs(node.func, fast_tree.get_func_info(node.fullname))
+                    self.assertEqual(node.fullname, f"{node.funcname} ({node.filename}:{node.lineno})")
+
+    def test_processes(self):
+        with open(os.path.join(os.path.dirname(__file__), "data/multithread.json")) as f:
+            sample_data = json.loads(f.read())
+        fg = FlameGraph(sample_data, processes=1)
+        fg_pool = FlameGraph(processes=2)
+        # Build every thread in the pool
+        fg_pool.parallel_min_events = 1
+        fg_pool.parse(sample_data)
+        self.assertEqual(list(fg.trees), list(fg_pool.trees))
+        self.assertEqual(fg.dump_to_json(), fg_pool.dump_to_json())
+        self.assertEqual(fg.dump_to_perfetto(), fg_pool.dump_to_perfetto())
+
+    def test_add_calls(self):
+        calls = [
+            (0, 10, "main"),
+            (1, 3, "f"),
+            (2, 1, "g"),
+            (5, 3, "f"),
+            (6, 1, "h"),
+            (8, 1, "f"),
+            (20, 5, "main"),
+            # Starts at the same time as main, so it's not in main
+            (20, 2, "f"),
+        ]
+        tree = _FlameTree()
+        tree.add_calls(calls)
+        self.assertEqual(tree.json(), {
+            "name": "__root__", "value": 0, "children": [
+                {"name": "main", "value": 15, "children": [
+                    {"name": "f", "value": 7, "children": [
+                        {"name": "g", "value": 1, "children": []},
+                        {"name": "h", "value": 1, "children": []},
+                    ]},
+                ]},
+                {"name": "f", "value": 2, "children": []},
+            ]
+        })
+        self.assertEqual(tree.root.children["main"].count, 2)
+        self.assertEqual(tree.root.children["main"].children["f"].count, 3)
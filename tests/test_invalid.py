@@ -20,6 +20,16 @@ class TestInvalidArgs(BaseTmpl):
             "log_gc": ["hello", 1, "True"],
             "log_func_args": ["hello", 1, "True"],
             "vdb": ["hello", 1, "True"],
+            "spill_to_disk": ["hello", 1, "True"],
+            "use_monitoring": ["hello", 1, "True"],
+            "sample_rate": ["hello", -1, True],
+            "call_budget": ["hello", -1, 1.5, True],
+            "call_sample_ratio": ["hello", -1, 1.5, True],
+            "collect_stats": ["hello", 1, "True"],
+            "stats_only": ["hello", 1, "True"],
+            "clock": ["hello", 1, None],
+            "integer_ts": ["hello", 1, "True"],
+            "buffer_file": [1, True, ["result.vtbuf"]],
             "min_duration": ["0.1.0", "12", "3us"]
         }
         tracer = VizTracer()
@@ -153,6 +153,15 @@ class TestSubprocess(CmdlineTmpl):
         self.template(["viztracer", "--log_subprocess", "-o", "result.json", "cmdline_test.py"],
                       expected_output_file="result.json", script=file_parent, check_func=check_func)
 
+    def test_shm(self):
+        def check_func(data):
+            pids = set()
+            for entry in data["traceEvents"]:
+                pids.add(entry["pid"])
+            self.assertEqual(len(pids), 4)
+        self.template(["viztracer", "--log_subprocess", "--multiprocess_shm", "-o", "result.json", "cmdline_test.py"],
+                      expected_output_file="result.json", script=file_parent, check_func=check_func)
+
 
 class TestMultiprocessing(CmdlineTmpl):
     def test_os_fork(self):
@@ -194,6 +203,22 @@ class TestMultiprocessing(CmdlineTmpl):
                       check_func=check_func,
                       concurrency="multiprocessing")
 
+    def test_multiprocessing_shm(self):
+        def check_func(data):
+            fib_count = 0
+            pids = set()
+            for entry in data["traceEvents"]:
+                pids.add(entry["pid"])
+                fib_count += 1 if "fib" in entry["name"] else 0
+            self.assertGreater(len(pids), 1)
+            self.assertEqual(fib_count, 18)
+
+        self.template(["viztracer", "--log_multiprocess", "--multiprocess_shm", "-o", "result.json", "cmdline_test.py"],
+                      expected_output_file="result.json",
+                      script=file_multiprocessing,
+                      check_func=check_func,
+                      concurrency="multiprocessing")
+
     @unittest.skipIf(int(platform.python_version_tuple()[1]) >= 8
                      or "win32" in sys.platform, "Does not support Windows, Don't know why stuck on 3.8+")
     def test_multiprocessing_pool(self):
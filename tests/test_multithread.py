@@ -71,6 +71,25 @@ class TestMultithread(BaseTmpl):
         entries = tracer.parse()
         self.assertEqual(entries, 300)
 
+    def test_per_thread_buffer(self):
+        tracer = VizTracer(tracer_entries=100, per_thread_buffer=True, verbose=0)
+        tracer.start()
+
+        threads = [MyThread() for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        tracer.stop()
+        entries = tracer.parse()
+        # Every thread keeps its own 100 entries, the busy threads
+        # can't evict the entries of the main thread
+        self.assertGreater(entries, 400)
+        self.assertLessEqual(entries, 500)
+        tids = set(e["tid"] for e in tracer.data["traceEvents"] if e["ph"] == "X")
+        self.assertEqual(len(tids), 5)
+
 
 file_log_sparse = """
 import threading
@@ -2,10 +2,17 @@
 # For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
 
 
+import gzip
 import io
 import json
+import multiprocessing
 import os
-from viztracer.report_builder import ReportBuilder
+import tempfile
+import unittest
+import unittest.mock
+from viztracer import binary_trace, compression, report_builder
+from viztracer.report_builder import (ReportBuilder, StreamingReportBuilder, get_file_info, load_source_bundle,
+                                      read_source, resolve_source_bundle)
 from .base_tmpl import BaseTmpl
 
 
@@ -46,3 +53,186 @@ class TestReportBuilder(BaseTmpl):
         invalid_json_path = os.path.join(os.path.dirname(__file__), "data", "fib.py")
         with self.assertRaises(Exception):
             ReportBuilder([invalid_json_path], verbose=1)
+
+    def test_binary_trace(self):
+        json_path = os.path.join(os.path.dirname(__file__), "data", "multithread.json")
+        with open(json_path) as f:
+            data = json.loads(f.read())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vtb_path = os.path.join(tmpdir, "result.vtb")
+            binary_trace.dump(data, vtb_path)
+            rb = ReportBuilder([vtb_path], verbose=0)
+            with io.StringIO() as s:
+                rb.save(s)
+                result = json.loads(s.getvalue())
+        self.assertEqual(len(result["traceEvents"]), len(data["traceEvents"]))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vtb_path = os.path.join(tmpdir, "result.vtb")
+            binary_trace.dump(data, vtb_path)
+            ns_data = binary_trace.load(vtb_path, integer_ts=True)
+            vtb_path_ns = os.path.join(tmpdir, "result_ns.vtb")
+            binary_trace.dump(ns_data, vtb_path_ns)
+            us_data = binary_trace.load(vtb_path_ns)
+        self.assertEqual(ns_data["viztracer_metadata"]["ts_unit"], "ns")
+        for event, ns_event, us_event in zip(data["traceEvents"], ns_data["traceEvents"], us_data["traceEvents"]):
+            if "ts" in event:
+                self.assertIsInstance(ns_event["ts"], int)
+                self.assertAlmostEqual(ns_event["ts"] / 1000, event["ts"], places=3)
+                self.assertAlmostEqual(us_event["ts"], event["ts"], places=3)
+
+        invalid_path = os.path.join(os.path.dirname(__file__), "data", "multithread.json")
+        with self.assertRaises(binary_trace.BinaryTraceError):
+            binary_trace.load(invalid_path)
+
+    def test_streaming(self):
+        json_path = os.path.join(os.path.dirname(__file__), "data", "multithread.json")
+        with open(json_path) as f:
+            data = json.loads(f.read())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vtb_path = os.path.join(tmpdir, "result.vtb")
+            binary_trace.dump(data, vtb_path)
+            files = [json_path, vtb_path, json_path]
+            for align in (False, True):
+                with io.StringIO() as s:
+                    ReportBuilder(files, verbose=0, align=align).save(s)
+                    expected = json.loads(s.getvalue())
+                for processes in (1, 2):
+                    output_path = os.path.join(tmpdir, "result.json")
+                    StreamingReportBuilder(files, verbose=0, align=align, processes=processes,
+                                           chunk_size=7).save(output_path)
+                    with open(output_path) as f:
+                        # The events are in the same order
+                        self.assertEqual(json.loads(f.read()), expected)
+
+            html_path = os.path.join(tmpdir, "result.html")
+            StreamingReportBuilder(files, verbose=0).save(html_path)
+            self.assertTrue(os.path.exists(html_path))
+
+            invalid_json_path = os.path.join(os.path.dirname(__file__), "data", "fib.py")
+            with self.assertRaises(ValueError):
+                StreamingReportBuilder([json_path, invalid_json_path], verbose=0, processes=2).save(output_path)
+
+    @unittest.skipIf(multiprocessing.get_start_method() != "fork", "The workers need to be forked")
+    def test_streaming_worker_died(self):
+        json_path = os.path.join(os.path.dirname(__file__), "data", "multithread.json")
+        load_event_chunks = report_builder.load_event_chunks
+
+        def crash(path, align, chunk_size):
+            if path == "crash.json":
+                os._exit(1)
+            return load_event_chunks(path, align, chunk_size)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = os.path.join(tmpdir, "result.json")
+            with unittest.mock.patch.object(report_builder, "load_event_chunks", crash):
+                with self.assertRaises(RuntimeError):
+                    StreamingReportBuilder([json_path, "crash.json"], verbose=0, processes=2).save(output_path)
+
+    def test_chunked_write(self):
+        events = [{"ph": "X", "pid": 1, "tid": 1, "ts": i, "dur": 1, "name": f"</script> {i}"} for i in range(2500)]
+        data = {"traceEvents": events, "viztracer_metadata": {"version": "test"}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_path = os.path.join(tmpdir, "result.json")
+            ReportBuilder(json.loads(json.dumps(data)), verbose=0, minimize_memory=True).save(json_path, file_info=False)
+            with open(json_path) as f:
+                self.assertEqual(json.loads(f.read()), data)
+
+            html_path = os.path.join(tmpdir, "result.html")
+            ReportBuilder(json.loads(json.dumps(data)), verbose=0).save(html_path, file_info=False)
+            with open(html_path) as f:
+                html = f.read()
+            self.assertIn("<\\/script> 2499", html)
+            self.assertNotIn("</script> 0", html)
+
+    def test_compressed(self):
+        data = {
+            "traceEvents": [{"ph": "X", "pid": 1, "tid": 1, "ts": i, "dur": 1, "name": f"f{i}"} for i in range(1000)],
+            "viztracer_metadata": {"version": "test"}
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Small blocks so the file is made of many independently deflated blocks
+            gz_path = os.path.join(tmpdir, "blocks.gz")
+            raw = json.dumps(data).encode("utf-8")
+            with compression.ParallelGzipWriter(gz_path, block_size=1000, workers=4) as f:
+                for i in range(0, len(raw), 333):
+                    f.write(raw[i:i + 333])
+            with gzip.open(gz_path) as f:
+                self.assertEqual(f.read(), raw)
+
+            extensions = [".gz"]
+            if compression.zstandard is not None:
+                extensions.append(".zst")
+            if compression.lz4 is not None:
+                extensions.append(".lz4")
+            for ext in extensions:
+                path = os.path.join(tmpdir, "result.json" + ext)
+                ReportBuilder(json.loads(json.dumps(data)), verbose=0).save(path, file_info=False)
+                with compression.open_compressed(path) as f:
+                    self.assertEqual(json.loads(f.read()), data)
+                # A compressed report can be combined like a json one
+                output_path = os.path.join(tmpdir, "combined.json")
+                ReportBuilder([path], verbose=0).save(output_path, file_info=False)
+                with open(output_path) as f:
+                    self.assertEqual(len(json.loads(f.read())["traceEvents"]), 1000)
+
+    def test_file_info(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source_path = os.path.join(tmpdir, "source.py")
+            with open(source_path, "w") as f:
+                f.write("def f():\n    pass\n")
+            names = [f"f ({source_path}:1)", f"f ({source_path}:1)", "builtins.print", "g (not_exist.py:3)"]
+            file_info = get_file_info(names)
+            self.assertEqual(file_info["files"], {source_path: ["def f():\n    pass\n", 2]})
+            self.assertEqual(file_info["functions"], {f"f ({source_path}:1)": [source_path, 1]})
+
+            # The file is read again only when it changes
+            self.assertIs(read_source(source_path), read_source(source_path))
+            with open(source_path, "w") as f:
+                f.write("def f():\n    return 1\n")
+            os.utime(source_path, ns=(0, 0))
+            self.assertEqual(read_source(source_path), ["def f():\n    return 1\n", 2])
+
+            # The least recently used sources are dropped to keep the cache small
+            other_path = os.path.join(tmpdir, "other.py")
+            with open(other_path, "w") as f:
+                f.write("def g():\n    pass\n")
+            with unittest.mock.patch.object(report_builder, "SOURCE_CACHE_MAX_SIZE", 30):
+                source = read_source(source_path)
+                other_source = read_source(other_path)
+                self.assertIs(read_source(other_path), other_source)
+                self.assertIsNot(read_source(source_path), source)
+                self.assertEqual(read_source(source_path), source)
+
+    def test_source_bundle(self):
+        json_path = os.path.join(os.path.dirname(__file__), "data", "multithread.json")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source_path = os.path.join(tmpdir, "source.py")
+            with open(source_path, "w") as f:
+                f.write("def f():\n    pass\n")
+            bundle_path = os.path.join(tmpdir, "sources.json")
+            events = [{"ph": "X", "pid": 1, "tid": 1, "ts": 0, "dur": 1, "name": f"f ({source_path}:1)"}]
+            reports = []
+            for i in range(2):
+                output_path = os.path.join(tmpdir, f"result{i}.json")
+                ReportBuilder({"traceEvents": list(events)}, verbose=0, source_bundle=bundle_path).save(output_path)
+                with open(output_path) as f:
+                    reports.append(json.loads(f.read()))
+            StreamingReportBuilder([json_path, os.path.join(tmpdir, "result0.json")], verbose=0,
+                                   source_bundle=bundle_path).save(os.path.join(tmpdir, "combined.json"))
+
+            # Every source is kept once in the bundle
+            self.assertEqual(list(load_source_bundle(bundle_path).values()).count("def f():\n    pass\n"), 1)
+            for report in reports:
+                self.assertEqual(report["file_info"]["files"], {})
+                file_info = resolve_source_bundle(report["file_info"], output_path)
+                self.assertEqual(file_info["files"], {source_path: ["def f():\n    pass\n", 2]})
+                self.assertNotIn("source_bundle", file_info)
+
+            # The bundle is found next to the trace if it was moved with it
+            moved_dir = os.path.join(tmpdir, "moved")
+            os.mkdir(moved_dir)
+            os.rename(bundle_path, os.path.join(moved_dir, "sources.json"))
+            file_info = resolve_source_bundle(reports[0]["file_info"], os.path.join(moved_dir, "result0.json"))
+            self.assertIn(source_path, file_info["files"])
@@ -1,11 +1,20 @@
 # Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
 # For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
 
+import copy
+import gc
 import io
+import json
 import os
+import subprocess
+import sys
+import tempfile
+import textwrap
 import time
+import unittest
+import weakref
 from viztracer.tracer import _VizTracer
-from viztracer import VizTracer
+from viztracer import VizTracer, binary_trace
 from .base_tmpl import BaseTmpl
 
 
@@ -55,6 +64,75 @@ class TestCTracer(BaseTmpl):
         self.assertEqual(entries1, entries2)
         self.assertNotEqual(report1, report2)
 
+    def test_c_function_names(self):
+        tracer = _VizTracer()
+        tracer.start()
+        for _ in range(3):
+            fib(2)
+            lst = []
+            lst.append(len(lst))
+            {}.get(1)
+        tracer.stop()
+        tracer.parse()
+        names = [e["name"] for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        fib_name = f"fib ({os.path.abspath(__file__)}:{fib.__code__.co_firstlineno})"
+        self.assertEqual(names.count(fib_name), 9)
+        self.assertEqual(names.count("list.append"), 3)
+        self.assertEqual(names.count("builtins.len"), 3)
+        self.assertEqual(names.count("dict.get"), 3)
+
+    def test_c_functions(self):
+        tracer = _VizTracer()
+        tracer.start()
+        fib(2)
+        len([])
+        tracer.add_raw({"ph": "X", "name": "raw (raw.py:3)", "ts": 0, "dur": 1, "cat": "FEE"})
+        tracer.stop()
+        tracer.parse()
+        fib_name = f"fib ({os.path.abspath(__file__)}:{fib.__code__.co_firstlineno})"
+        self.assertEqual(tracer.functions[fib_name], (fib.__code__.co_filename, fib.__code__.co_firstlineno))
+        self.assertIsNone(tracer.functions["raw (raw.py:3)"])
+        self.assertNotIn("builtins.len", tracer.functions)
+
+    def test_c_load_columnar(self):
+        def run(tracer):
+            tracer.start()
+            fib(5)
+            tracer.add_instant("instant")
+            tracer.add_counter("counter", {"value": 1})
+            tracer.add_raw({"ph": "X", "name": "raw", "ts": 1.5, "dur": 2, "cat": "FEE"})
+            tracer.stop()
+
+        tracer = _VizTracer(log_func_retval=True, integer_ts=True)
+        run(tracer)
+        tracer.parse()
+        expected = [event for event in tracer.data["traceEvents"] if event["ph"] != "M"]
+
+        tracer = _VizTracer(log_func_retval=True)
+        run(tracer)
+        columns = tracer.load_columnar()
+        self.assertEqual(columns["ts"].format, "q")
+        self.assertEqual(len(columns["ts"]), len(expected))
+        self.assertTrue(all(event["ph"] == "M" for event in columns["events"]))
+        for row, event in enumerate(expected):
+            self.assertEqual(columns["tid"][row], event["tid"])
+            self.assertEqual(columns["pid"][row], event["pid"])
+            self.assertEqual(columns["names"][columns["name_id"][row]], event["name"])
+            self.assertEqual(chr(columns["ph"][row]), event["ph"])
+            self.assertEqual(columns["caller_lineno"][row], event.get("caller_lineno", -1))
+            if event["ph"] == "X" and event["name"] != "raw":
+                self.assertEqual(columns["extras"][row], {"args": event["args"]})
+        # The timestamps are in ns, the raw events are in us
+        self.assertEqual(columns["ts"][len(expected) - 1], 1500)
+        self.assertEqual(columns["dur"][len(expected) - 1], 2000)
+        self.assertTrue(all(columns["dur"][row] > 0 for row in range(len(expected)) if columns["ph"][row] == ord("X")))
+        self.assertEqual(columns["extras"][len(expected) - 1], {"cat": "FEE"})
+        # The buffer is consumed
+        self.assertEqual(len(tracer.load_columnar()["ts"]), 0)
+
+        with self.assertRaises(ValueError):
+            _VizTracer(spill_to_disk=True).load_columnar()
+
     def test_c_cleanup(self):
         tracer = _VizTracer()
         tracer.start()
@@ -74,6 +152,139 @@ class TestCircularBuffer(BaseTmpl):
         entries = tracer.parse()
         self.assertEqual(entries, 10)
 
+    def test_spill_to_disk(self):
+        # fib(10) has 177 calls
+        tracer = _VizTracer(tracer_entries=10, spill_to_disk=True)
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        spill_file = tracer._spill_file
+        self.assertTrue(os.path.exists(spill_file))
+        entries = tracer.parse()
+        self.assertEqual(entries, 177)
+        self.assertFalse(os.path.exists(spill_file))
+        ts = [e["ts"] for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(len(ts), 177)
+
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        spill_file = tracer._spill_file
+        tracer.clear()
+        self.assertFalse(os.path.exists(spill_file))
+        tracer.start()
+        fib(5)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 15)
+
+    def test_spill_to_disk_payload(self):
+        # Enough nodes with args to grow the payload pool
+        tracer = _VizTracer(tracer_entries=100, spill_to_disk=True, log_func_args=True,
+                            log_func_retval=True, vdb=True)
+        tracer.start()
+        fib(15)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 1973)
+        events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        for event in events:
+            self.assertIn("n", event["args"]["func_args"])
+            self.assertIn("return_value", event["args"])
+            self.assertIn("caller_lineno", event)
+
+    def test_spill_to_disk_binary(self):
+        tracer = VizTracer(tracer_entries=10, spill_to_disk=True, verbose=0)
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vtb_path = os.path.join(tmpdir, "result.vtb")
+            tracer.save(vtb_path)
+            data = binary_trace.load(vtb_path)
+        self.assertEqual(len([e for e in data["traceEvents"] if e["ph"] == "X"]), 177)
+
+    def test_buffer_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            buffer_path = os.path.join(tmpdir, "buffer.vtbuf")
+            tracer = _VizTracer(tracer_entries=1000, buffer_file=buffer_path)
+            tracer.start()
+            fib(10)
+            tracer.stop()
+            # The events are in the file until they are loaded
+            data = binary_trace.load(buffer_path)
+            self.assertEqual(len([e for e in data["traceEvents"] if e["name"].startswith("fib")]), 177)
+            self.assertEqual(tracer.parse(), 177)
+            self.assertEqual(binary_trace.load(buffer_path)["traceEvents"], [])
+            tracer.buffer_file = None
+            tracer.clear()
+
+    def test_buffer_file_crash(self):
+        script = textwrap.dedent("""
+            import os
+            import sys
+            from viztracer import VizTracer
+
+            def fib(n):
+                return 1 if n <= 1 else fib(n - 1) + fib(n - 2)
+
+            tracer = VizTracer(tracer_entries=1000, buffer_file=sys.argv[1], verbose=0)
+            tracer.start()
+            fib(10)
+            os.abort()
+        """)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            buffer_path = os.path.join(tmpdir, "buffer.vtbuf")
+            result = subprocess.run([sys.executable, "-c", script, buffer_path])
+            self.assertNotEqual(result.returncode, 0)
+            data = binary_trace.load(buffer_path)
+        events = [e for e in data["traceEvents"] if e["name"].startswith("fib")]
+        self.assertEqual(len(events), 177)
+
+    def test_integer_ts(self):
+        tracer = VizTracer(integer_ts=True, tracer_entries=10, spill_to_disk=True, verbose=0)
+        tracer.start()
+        with tracer.log_event("event"):
+            fib(10)
+        tracer.stop()
+        tracer.parse()
+        self.assertEqual(tracer.data["viztracer_metadata"]["ts_unit"], "ns")
+        events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(len(events), 178)
+        for event in events:
+            self.assertIsInstance(event["ts"], int)
+            self.assertIsInstance(event["dur"], int)
+        root = next(e for e in events if e["name"].startswith("event"))
+        for event in events:
+            self.assertLessEqual(root["ts"], event["ts"])
+            self.assertLessEqual(event["ts"] + event["dur"], root["ts"] + root["dur"])
+
+        root_dur = root["dur"]
+        original_data = copy.deepcopy(tracer.data)
+
+        # The report is always in us
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_path = os.path.join(tmpdir, "result.json")
+            tracer.save(json_path)
+            with open(json_path) as f:
+                data = json.load(f)
+        self.assertNotIn("ts_unit", data["viztracer_metadata"])
+        # The data of the tracer is still in ns
+        self.assertEqual(tracer.data, original_data)
+        report_root = next(e for e in data["traceEvents"] if e["name"].startswith("event"))
+        self.assertAlmostEqual(report_root["dur"], root_dur / 1000)
+
+    def test_integer_ts_raw(self):
+        tracer = _VizTracer(integer_ts=True)
+        raw = {"ph": "i", "ts": 1.5, "name": "raw", "s": "g"}
+        tracer.start()
+        tracer.add_raw(raw)
+        tracer.add_raw(raw)
+        tracer.stop()
+        tracer.parse()
+        events = [e for e in tracer.data["traceEvents"] if e.get("name") == "raw"]
+        self.assertEqual([e["ts"] for e in events], [1500, 1500])
+        # The dict of the user is not converted
+        self.assertEqual(raw["ts"], 1.5)
+
 
 class TestTracerFilter(BaseTmpl):
     def test_max_stack_depth(self):
@@ -135,6 +346,61 @@ class TestTracerFilter(BaseTmpl):
         entries = tracer.parse()
         self.assertEqual(entries, 177)
 
+    def test_many_files(self):
+        test_dir = os.path.dirname(os.path.abspath(__file__))
+        # Prefixes that share a path with this file but don't match it
+        prefixes = [os.path.join(test_dir, f"dir{i}") for i in range(50)] + [test_dir + "_other", test_dir + "/test_trace."]
+        prefixes.append(os.path.join(test_dir, "test_tracer.pyc"))
+
+        tracer = _VizTracer(include_files=prefixes)
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 0)
+
+        tracer.include_files = prefixes + [os.path.join(test_dir, "test_tracer")]
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 177)
+
+        tracer.include_files = None
+        tracer.exclude_files = prefixes
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 177)
+
+        tracer.exclude_files = prefixes + [test_dir]
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 0)
+
+    def test_dynamic_code(self):
+        namespace = {}
+        exec(compile("def f():\n    return 0\n", "<generated>", "exec"), namespace)
+        code_ref = weakref.ref(namespace["f"].__code__)
+        tracer = _VizTracer(exclude_files=["<generated>"])
+        tracer.start()
+        namespace["f"]()
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 0)
+
+        # A different tracer has a different verdict for the same code
+        other_tracer = _VizTracer()
+        other_tracer.start()
+        namespace["f"]()
+        other_tracer.stop()
+        other_tracer.parse()
+        self.assertTrue(any(e["name"].startswith("f (") for e in other_tracer.data["traceEvents"]))
+        other_tracer.clear()
+
+        # The tracer does not keep the code alive
+        del namespace
+        gc.collect()
+        self.assertIsNone(code_ref())
+
     def test_include_exclude_exception(self):
         tracer = _VizTracer(exclude_files=["./src/"], include_files=["./"])
         with self.assertRaises(Exception):
@@ -174,6 +440,147 @@ class TestTracerFilter(BaseTmpl):
         entries = tracer.parse()
         self.assertEqual(entries, 1)
 
+    def test_call_budget(self):
+        tracer = _VizTracer(call_budget=10)
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        # 10 calls and the counter of the dropped ones
+        self.assertEqual(tracer.parse(), 11)
+        counters = [e for e in tracer.data["traceEvents"] if e["ph"] == "C"]
+        self.assertEqual(len(counters), 1)
+        self.assertTrue(counters[0]["name"].startswith("dropped calls of fib"))
+        self.assertEqual(counters[0]["args"]["calls"], 167)
+        self.assertGreater(counters[0]["args"]["dur_us"], 0)
+
+        # The budget starts over after parse
+        tracer.call_sample_ratio = 10
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 10 + 16 + 1)
+
+    def test_collect_stats(self):
+        tracer = _VizTracer(collect_stats=True)
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 177)
+        stats = [v for k, v in tracer.data["viztracer_stats"].items() if k.startswith("fib")]
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["calls"], 177)
+        self.assertLessEqual(stats[0]["self"], stats[0]["total"])
+        self.assertLessEqual(stats[0]["min"], stats[0]["max"])
+        # Only the outermost call of the recursion counts for the total
+        outermost = max(e["dur"] for e in tracer.data["traceEvents"] if e["name"].startswith("fib"))
+        self.assertAlmostEqual(stats[0]["total"], outermost)
+        self.assertAlmostEqual(stats[0]["max"], stats[0]["total"])
+
+        tracer.clear()
+        self.assertEqual(tracer.get_stats(), {})
+
+    def test_stats_only(self):
+        tracer = _VizTracer(stats_only=True, log_func_args=True)
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 0)
+        stats = [v for k, v in tracer.get_stats().items() if k.startswith("fib")]
+        self.assertEqual(stats[0]["calls"], 177)
+
+    def test_clock(self):
+        for clock in ["monotonic", "monotonic_raw", "tsc"]:
+            tracer = _VizTracer(clock=clock)
+            try:
+                tracer.start()
+            except ValueError:
+                # Not every machine has every clock
+                continue
+            start = tracer.getts()
+            fib(10)
+            tracer.stop()
+            end = tracer.getts()
+            self.assertEqual(tracer.parse(), 177)
+            events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+            self.assertEqual(len(set(e["ts"] for e in events)), 177)
+            for event in events:
+                self.assertGreaterEqual(event["ts"], start)
+                self.assertLessEqual(event["ts"] + event["dur"], end)
+            tracer.clock = "monotonic"
+            tracer.start()
+            tracer.stop()
+
+    def test_thread_ts(self):
+        tracer = VizTracer(verbose=0)
+
+        def log_events():
+            for i in range(100):
+                tracer.add_instant(f"instant {i}")
+                tracer.add_counter("counter", {"value": i})
+
+        tracer.start()
+        log_events()
+        tracer.stop()
+        tracer.parse()
+        events = tracer.data["traceEvents"]
+        func = next(e for e in events if e["ph"] == "X" and e["name"].startswith("log_events"))
+        logged = [e for e in events if e["ph"] in ("i", "C")]
+        self.assertEqual(len(logged), 200)
+        for event in logged:
+            self.assertGreater(event["ts"], func["ts"])
+            self.assertLess(event["ts"], func["ts"] + func["dur"])
+
+    def test_sample_rate(self):
+        def busy(duration):
+            start = time.time()
+            while time.time() - start < duration:
+                fib(10)
+
+        tracer = _VizTracer(sample_rate=1000)
+        tracer.start()
+        busy(0.1)
+        tracer.stop()
+        tracer.parse()
+        names = [e["name"].split(" ")[0] for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(names.count("busy"), 1)
+        # busy() calls fib() thousands of times, only a few calls are sampled
+        self.assertLess(names.count("fib"), 1000)
+
+        tracer.include_files = ["./src/"]
+        tracer.start()
+        busy(0.05)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 0)
+
+    @unittest.skipIf(sys.version_info < (3, 12), "sys.monitoring is only available on Python 3.12+")
+    def test_use_monitoring(self):
+        tracer = _VizTracer(use_monitoring=True, include_files=["./src/"])
+        tracer.start()
+        fib(10)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 0)
+
+        # fib was disabled by the filter, it should be traced again
+        tracer.include_files = None
+        tracer.start()
+        fib(10)
+        lst = []
+        lst.append(1)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 178)
+
+        tracer.ignore_c_function = True
+        tracer.start()
+        fib(10)
+        lst.append(1)
+        tracer.stop()
+        self.assertEqual(tracer.parse(), 177)
+
+    @unittest.skipIf(sys.version_info >= (3, 12), "sys.monitoring is available")
+    def test_use_monitoring_unavailable(self):
+        with self.assertRaises(ValueError):
+            _VizTracer(use_monitoring=True)
+
 
 class TestTracerFeature(BaseTmpl):
     def test_log_func_retval(self):
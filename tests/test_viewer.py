@@ -3,6 +3,7 @@
 
 
 from .cmdline_tmpl import CmdlineTmpl
+import gzip
 import json
 import multiprocessing
 import os
@@ -93,6 +94,25 @@ class TestViewer(CmdlineTmpl):
         finally:
             os.remove(f.name)
 
+    @unittest.skipIf(sys.platform == "win32", "Can't send Ctrl+C reliably on Windows")
+    def test_gz(self):
+        json_script = '{"file_info": {"files": {}}, "traceEvents": []}'
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".json.gz", delete=False) as f:
+                f.write(gzip.compress(json_script.encode("utf-8")))
+            v = Viewer(f.name)
+            try:
+                v.run()
+                time.sleep(0.5)
+                resp = urllib.request.urlopen("http://127.0.0.1:9001/file_info")
+                self.assertEqual(json.loads(resp.read().decode("utf-8")), {"files": {}})
+                resp = urllib.request.urlopen("http://127.0.0.1:9001/localtrace")
+                self.assertEqual(json.loads(resp.read().decode("utf-8")), json.loads(json_script))
+            finally:
+                v.stop()
+        finally:
+            os.remove(f.name)
+
     @unittest.skipIf(sys.platform == "win32", "Can't send Ctrl+C reliably on Windows")
     def test_html(self):
         html = '<html></html>'